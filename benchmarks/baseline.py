@@ -0,0 +1,29 @@
+# coding: utf-8
+
+import json
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)['results']
+
+
+def save(path, results, meta):
+    with open(path, 'w') as f:
+        json.dump({'meta': meta, 'results': results}, f, indent=2, sort_keys=True)
+
+
+def compare(results, baseline, tolerance, min_delta):
+    """
+    every metric is a time, lower is better
+    a metric regresses when slower than baseline by more than tolerance (relative) and min_delta (seconds)
+    :return: [(name, baseline, current)] of regressions
+    """
+    regressions = []
+    for name, current in sorted(results.items()):
+        if name not in baseline:
+            continue
+        old = baseline[name]
+        if current > old * (1. + tolerance) and current - old > min_delta:
+            regressions.append((name, old, current))
+    return regressions
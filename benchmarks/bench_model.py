@@ -0,0 +1,71 @@
+# coding: utf-8
+
+import tensorflow as tf
+import numpy as np
+import time
+
+from configs import cfgs
+from detectron.models.retinanet import RetinaNet
+from datasets.voc_tfrecord_utils import get_synthetic_generator
+from benchmarks.synthetic import random_images
+from benchmarks import config
+
+
+def latency_stats(times, prefix):
+    times = np.asarray(times)
+    return {prefix + '/p50': float(np.percentile(times, 50)),
+            prefix + '/p95': float(np.percentile(times, 95)),
+            prefix + '/p99': float(np.percentile(times, 99)),
+            prefix + '/mean': float(np.mean(times))}
+
+
+def bench_inference(batch_sizes, num_runs, warmup_runs=3):
+    """
+    graph build & session init of the test graph, latency per batch size, random weights
+    """
+    results = {}
+    with tf.Graph().as_default():
+        retinanet = RetinaNet('test', restore=False)
+        results['test/build_time'] = retinanet.build_time
+        results['test/init_time'] = retinanet.init_time
+
+        rng = np.random.RandomState(0)
+        input_shape = cfgs.test_input_shape or [500, 500]
+        for batch_size in batch_sizes:
+            imgs = random_images(batch_size, input_shape, cfgs.data_format, rng)
+            for _ in range(warmup_runs):
+                retinanet.test_one_batch(imgs)
+
+            times = []
+            for _ in range(num_runs):
+                start = time.time()
+                retinanet.test_one_batch(imgs)
+                times.append(time.time() - start)
+            results.update(latency_stats(times, 'inference/batch{:d}'.format(batch_size)))
+        retinanet.sess.close()
+    return results
+
+
+def bench_train_step(batch_sizes, num_steps, warmup_steps=3):
+    """
+    graph build & session init of the train graph, step time per batch size, synthetic data
+    """
+    results = {}
+    for batch_size in batch_sizes:
+        with config.override(batch_size=batch_size, repeat_dataset=True):
+            with tf.Graph().as_default():
+                retinanet = RetinaNet('train', get_synthetic_generator(num_batches=2), restore=False)
+                results['train/batch{:d}/build_time'.format(batch_size)] = retinanet.build_time
+                results['train/batch{:d}/init_time'.format(batch_size)] = retinanet.init_time
+
+                for _ in range(warmup_steps):
+                    retinanet.sess.run(retinanet.train_op)
+                times = []
+                for _ in range(num_steps):
+                    start = time.time()
+                    retinanet.sess.run(retinanet.train_op)
+                    times.append(time.time() - start)
+                results.update(latency_stats(times, 'train/batch{:d}/step'.format(batch_size)))
+                retinanet.summary_writer.close()
+                retinanet.sess.close()
+    return results
@@ -0,0 +1,83 @@
+# coding: utf-8
+
+import tensorflow as tf
+import numpy as np
+import os, time, tempfile, shutil
+
+from configs import cfgs
+from detectron.utils import box_ops
+from detectron.utils import voc_eval
+from benchmarks import config
+from benchmarks.synthetic import write_annotations, random_detections, random_candidates, CLASS_NAMES
+
+NMS_METHODS = ['loop', 'offset', 'combined']
+
+
+def time_nms(boxes, scores, method, num_runs):
+    """
+    mean latency of box_ops.multiclass_nms with the cfgs thresholds, after one warmup run
+    :return: seconds per run, ops in the nms graph
+    """
+    num_classes = scores.shape[1]
+    with tf.Graph().as_default():
+        boxes_ph = tf.placeholder(tf.float32, [None, 4])
+        scores_ph = tf.placeholder(tf.float32, [None, num_classes])
+        nms = box_ops.multiclass_nms(boxes_ph, scores_ph, method,
+                                     cfgs.nms_max_boxes, num_classes * cfgs.nms_max_boxes,
+                                     cfgs.nms_iou_threshold, cfgs.nms_score_threshold)
+        num_ops = len(tf.get_default_graph().get_operations())
+
+        with tf.Session() as sess:
+            feed_dict = {boxes_ph: boxes, scores_ph: scores}
+            sess.run(nms, feed_dict=feed_dict)  # warmup
+            start = time.time()
+            for _ in range(num_runs):
+                sess.run(nms, feed_dict=feed_dict)
+            cost = (time.time() - start) / num_runs
+    return cost, num_ops
+
+
+def bench_nms(candidate_counts, num_runs):
+    """
+    latency of every nms method vs number of candidate boxes
+    """
+    results = {}
+    rng = np.random.RandomState(0)
+    for num_candidates in candidate_counts:
+        boxes, scores = random_candidates(num_candidates, len(CLASS_NAMES), rng)
+        for method in NMS_METHODS:
+            results['nms/{}/candidates{:d}'.format(method, num_candidates)], _ = \
+                time_nms(boxes, scores, method, num_runs)
+    return results
+
+
+def bench_voc_eval(detection_counts, num_images):
+    """
+    evaluation time vs detections per image, file-based do_python_eval and in-memory VOCEvaluator
+    annotations are synthetic xml files in a temporary directory
+    """
+    results = {}
+    rng = np.random.RandomState(0)
+    tmp_dir = tempfile.mkdtemp()
+    # annotation_cache off: time the parsing too, like a first run
+    try:
+        with config.override(eval_save_path=os.path.join(tmp_dir, 'eval'), annotation_cache=False):
+            anno_dir = os.path.join(tmp_dir, 'Annotations')
+            img_ids, ground_truth = write_annotations(anno_dir, num_images, rng)
+            for dets_per_image in detection_counts:
+                all_boxes = random_detections(ground_truth, dets_per_image, rng)
+
+                start = time.time()
+                voc_eval.write_voc_results_file(all_boxes, img_ids, cfgs.eval_save_path)
+                voc_eval.do_python_eval(img_ids, anno_dir, plot=False, num_workers=1)
+                results['voc_eval/file/dets{:d}'.format(dets_per_image)] = time.time() - start
+
+                start = time.time()
+                evaluator = voc_eval.VOCEvaluator(anno_dir)
+                for img_id, dets in zip(img_ids, all_boxes):
+                    evaluator.add_image(img_id, dets)
+                evaluator.evaluate(verbose=False)
+                results['voc_eval/memory/dets{:d}'.format(dets_per_image)] = time.time() - start
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return results
@@ -0,0 +1,20 @@
+# coding: utf-8
+
+from contextlib import contextmanager
+
+from configs import cfgs
+
+
+@contextmanager
+def override(**values):
+    """
+    set cfgs attributes for the duration of a with block, the old values come back even on exceptions
+    """
+    saved = {name: getattr(cfgs, name) for name in values}
+    try:
+        for name, value in values.items():
+            setattr(cfgs, name, value)
+        yield
+    finally:
+        for name, value in saved.items():
+            setattr(cfgs, name, value)
@@ -0,0 +1,68 @@
+# coding: utf-8
+import argparse
+import sys, os, time, platform, tempfile
+
+sys.path.append('../')
+import tensorflow as tf
+import numpy as np
+
+from benchmarks import bench_model, bench_postprocess, baseline, config
+
+# detection benchmarks on random weights & synthetic data, no dataset or checkpoint needed
+# usage: python run_benchmarks.py [--quick] [--only model,postprocess]
+#                                 [--output results.json] [--baseline baseline.json] [--save-baseline]
+parser = argparse.ArgumentParser()
+parser.add_argument('--quick', action='store_true', help='fewer runs & sizes, smoke test')
+parser.add_argument('--only', default='model,postprocess', help='comma separated groups')
+parser.add_argument('--output', default='results.json')
+parser.add_argument('--baseline', default='baseline.json')
+parser.add_argument('--save-baseline', action='store_true', help='store these results as the baseline')
+parser.add_argument('--tolerance', type=float, default=0.15, help='relative slowdown flagged as regression')
+parser.add_argument('--min-delta', type=float, default=0.002, help='seconds, smaller slowdowns are noise')
+args = parser.parse_args()
+
+groups = args.only.split(',')
+if args.quick:
+    num_runs, batch_sizes, train_batch_sizes = 5, [1, 2], [1]
+    candidate_counts, detection_counts, num_images = [1000, 5000], [10, 100], 50
+else:
+    num_runs, batch_sizes, train_batch_sizes = 50, [1, 4, 8], [1, 2, 4]
+    candidate_counts, detection_counts, num_images = [1000, 5000, 20000], [10, 100, 1000], 500
+
+results = {}
+start = time.time()
+# keep benchmark side effects out of output/
+with config.override(summary_path=os.path.join(tempfile.mkdtemp(), 'summaries')):
+    if 'model' in groups:
+        results.update(bench_model.bench_inference(batch_sizes, num_runs))
+        results.update(bench_model.bench_train_step(train_batch_sizes, max(num_runs // 5, 5)))
+    if 'postprocess' in groups:
+        results.update(bench_postprocess.bench_nms(candidate_counts, num_runs))
+        results.update(bench_postprocess.bench_voc_eval(detection_counts, num_images))
+
+meta = {'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'tensorflow': tf.__version__,
+        'numpy': np.__version__,
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'quick': args.quick,
+        'total_time': time.time() - start}
+
+print('-' * 60)
+for name, value in sorted(results.items()):
+    print('{:<45s} {:10.2f}ms'.format(name, value * 1000))
+baseline.save(args.output, results, meta)
+print('save results in:', args.output)
+
+if args.save_baseline:
+    baseline.save(args.baseline, results, meta)
+    print('save baseline in:', args.baseline)
+elif os.path.exists(args.baseline):
+    regressions = baseline.compare(results, baseline.load(args.baseline), args.tolerance, args.min_delta)
+    for name, old, current in regressions:
+        print('REGRESSION {}: {:.2f}ms -> {:.2f}ms ({:+.1f}%)'.format(
+            name, old * 1000, current * 1000, 100. * (current / old - 1.)))
+    print('{:d} regressions against {}'.format(len(regressions), args.baseline))
+    sys.exit(1 if regressions else 0)
+else:
+    print('no baseline at {}, run with --save-baseline to create one'.format(args.baseline))
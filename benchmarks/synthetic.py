@@ -0,0 +1,85 @@
+# coding: utf-8
+
+import numpy as np
+import os
+
+from detectron.utils.voc_eval import NAME_LABEL_MAP
+
+CLASS_NAMES = [cls for cls, _ in sorted(NAME_LABEL_MAP.items(), key=lambda x: x[1]) if cls != 'back_ground']
+
+XML_TEMPLATE = '<annotation><filename>{}</filename>{}</annotation>'
+OBJECT_TEMPLATE = ('<object><name>{}</name><pose>Unspecified</pose><truncated>0</truncated>'
+                   '<difficult>{:d}</difficult><bndbox><xmin>{:d}</xmin><ymin>{:d}</ymin>'
+                   '<xmax>{:d}</xmax><ymax>{:d}</ymax></bndbox></object>')
+
+
+def random_images(batch_size, input_shape, data_format, rng):
+    """
+    uint8 images as fed to RetinaNet.test_one_batch
+    """
+    if data_format == 'channels_last':
+        shape = [batch_size] + list(input_shape) + [3]
+    else:
+        shape = [batch_size, 3] + list(input_shape)
+    return rng.randint(0, 256, shape).astype(np.uint8)
+
+
+def write_annotations(anno_dir, num_images, rng, image_size=500, max_objects=5):
+    """
+    random VOC annotations, one xml per image
+    :return: image ids, ground truth per image as Gx5 [class_id, xmin, ymin, xmax, ymax]
+    """
+    if not os.path.exists(anno_dir):
+        os.makedirs(anno_dir)
+
+    img_ids, ground_truth = [], []
+    for i in range(num_images):
+        img_id = 'synthetic_{:06d}'.format(i)
+        num_objects = rng.randint(1, max_objects + 1)
+        class_id = rng.randint(0, len(CLASS_NAMES), num_objects)
+        xy1 = rng.randint(0, image_size // 2, [num_objects, 2])
+        xy2 = xy1 + rng.randint(16, image_size // 2, [num_objects, 2])
+        difficult = rng.uniform(0., 1., num_objects) < 0.1
+
+        objects = ''.join(OBJECT_TEMPLATE.format(CLASS_NAMES[c], int(d), x1, y1, x2, y2)
+                          for c, d, (x1, y1), (x2, y2) in zip(class_id, difficult, xy1, xy2))
+        with open(os.path.join(anno_dir, img_id + '.xml'), 'w') as f:
+            f.write(XML_TEMPLATE.format(img_id + '.jpg', objects))
+
+        img_ids.append(img_id)
+        ground_truth.append(np.hstack([class_id[:, np.newaxis], xy1, xy2]).astype(np.float64))
+    return img_ids, ground_truth
+
+
+def random_candidates(num_candidates, num_classes, rng):
+    """
+    nms input: Nx4 [y1, x1, y2, x2] boxes in a 500x500 image, Nxclass scores
+    """
+    yx = rng.uniform(0., 500., [num_candidates, 2])
+    hw = rng.uniform(10., 200., [num_candidates, 2])
+    boxes = np.concatenate([yx - hw / 2., yx + hw / 2.], axis=-1).astype(np.float32)
+    scores = rng.uniform(0., 1., [num_candidates, num_classes]).astype(np.float32)
+    return boxes, scores
+
+
+def random_detections(ground_truth, dets_per_image, rng, image_size=500):
+    """
+    jittered ground truth plus random boxes
+    :param ground_truth: per image Gx5 [class_id, xmin, ymin, xmax, ymax]
+    :param image_size: extent of the random boxes, None for the largest gt coordinate of each image
+    :return: per image Nx6 [category, score, xmin, ymin, xmax, ymax]
+    """
+    all_boxes = []
+    for gt in ground_truth:
+        size = image_size
+        if size is None:
+            size = max(gt[:, 3:].max(), 1.) if gt.shape[0] > 0 else 500.
+        num_random = max(dets_per_image - gt.shape[0], 0)
+        xy = rng.uniform(0., size, [num_random, 2])
+        wh = rng.uniform(10., size / 2., [num_random, 2])
+        random_dets = np.hstack([rng.randint(0, len(CLASS_NAMES), [num_random, 1]),
+                                 rng.uniform(0., 1., [num_random, 1]), xy, xy + wh])
+        gt_dets = np.hstack([gt[:, :1], rng.uniform(0.5, 1., [gt.shape[0], 1]),
+                             gt[:, 1:] + rng.normal(0., 5., gt[:, 1:].shape)])
+        all_boxes.append(np.vstack([gt_dets, random_dets])[:dets_per_image])
+    return all_boxes
@@ -7,9 +7,24 @@ checkpoint_path = root_path + '/output/checkpoints/retina'
 num_train_samples = 7412
 epochs = 100
 lr = 1e-3
-batch_size = 1
+accumulation_steps = 1  # batches whose averaged gradients make one update, effective batch = batch_size * accumulation_steps
+batch_size = 1  # per replica
+# data-parallel towers on shared weights, each reads its own shard of the tfrecord list.
+# every tower normalizes with its own batch statistics, but only the first tower updates the BatchNorm
+# moving averages: test-mode statistics see batch_size of every batch_size*num_replicas images
+num_replicas = 1
 buffer_size = 100
-steps_per_epoch = num_train_samples/batch_size
+steps_per_epoch = num_train_samples/(batch_size*num_replicas)
+# ------- input pipeline cfgs -------
+pipeline_mode = 'serial'  # 'serial' or 'parallel'
+num_parallel_reads = 4  # tfrecord shards read concurrently (parallel mode)
+num_parallel_calls = 4  # parse_fn calls run concurrently (parallel mode)
+prefetch_buffer = 2  # batches prepared ahead of training (parallel mode)
+repeat_dataset = False  # if True, one epoch is steps_per_epoch steps
+# None: full-res jpeg, 'raw': pre-resized uint8, 'jpeg': pre-resized jpeg
+# images are stored at augment_config zoom_size (or output_shape), the mode is kept in each record,
+# reading follows the record, dataset2tfrecord rewrites shards of another mode or shape
+image_cache = None
 # ------- data pre-processing cfgs -------
 data_format = 'channels_last'
 pi = 0.01
@@ -22,9 +37,32 @@ num_anchors = len(aspect_ratios) * len(anchor_size)
 alpha = 0.25
 gamma = 2.0
 weight_decay = 1e-4
+# test mode: fold BatchNorm into the conv before it, where that conv feeds only this bn: resnet stem &
+# residual branches, subnets after their first bn. fpn/p6/p7 outputs feed several bns and stay unfolded
+fold_bn = False
+share_head_weights = False  # one set of subnet conv weights for p3-p7, as in the RetinaNet paper
+share_head_bn = False  # with shared weights, also share BatchNorm instead of one per level
+# training compute: 'float32' or 'float16' (float32 master weights, bn & losses)
+# no 'bfloat16': TF1 has no CPU kernels for bfloat16 Conv2D/BiasAdd
+precision = 'float32'
+loss_scale = 'dynamic'  # float16 loss scaling, 'dynamic' or a fixed number
+# 'per_image': tf.while_loop over images, 'batched': all images at once, faster but not the same objective:
+# a best anchor shared by several gts is one positive there, per_image counts it once per gt
+loss_mode = 'per_image'
+assign_targets_in_pipeline = False  # if True, anchor targets are computed by the tf.data map stage, as in 'batched'
 nms_score_threshold = 0.8
 nms_max_boxes = 20
 nms_iou_threshold = 0.3  # 0.45
+# 'offset' & 'combined' are faster but order & cap detections differently (see benchmarks/run_benchmarks.py),
+# a checkpoint's mAP is only unchanged with 'loop' and pre_nms_top_k = None
+nms_method = 'loop'  # 'loop': nms per class, 'offset': one nms with class-offset boxes, 'combined': combined_non_max_suppression
+pre_nms_top_k = None  # candidates kept per pyramid-level before nms, None keeps all, e.g. 1000
+test_input_shape = None  # None: variable-size inference, [h, w] (e.g. [500, 500]): static input & constant anchors
+anchor_cache_size = 8  # number of input sizes whose anchors are cached
+test_batch_size = 1  # images per session run in tools/test_net.py
+test_io_threads = 4  # decode and draw/write threads in tools/test_net.py
+test_queue_size = 16  # bound of the queues between test_net stages
+test_visualize = True  # draw & write detections in tools/test_net.py, --no-vis turns it off
 
 augment_config = {
     'data_format': 'channels_last',
@@ -42,9 +80,18 @@ augment_config = {
 
 show_inter = 20
 sumr_inter = 200
+profile = False  # trace training steps: per-scope op time & memory, input wait, images/sec
+profile_inter = 100  # steps between full traces
+profile_path = root_path + '/output/profile'  # chrome timelines & report.json
 save_inter = 10000
 
+test_checkpoint = None  # checkpoint used in test mode, None for the latest one
+export_path = root_path + '/output/export'
 vis_score = 0.1
 test_save_path = root_path+'/output/test_results'
 eval_save_path = root_path+'/output/eval_results'
-use_07_metric = True 
\ No newline at end of file
+use_07_metric = True 
+streaming_eval = False  # True: test_net evaluates in memory while testing, no det_<cls>.txt files for tools/do_eval.py
+annotation_cache = True  # parsed annotations kept in eval_save_path/annotations_<dir hash>.npz, refreshed by xml mtime
+eval_workers = None  # processes for per-class AP in do_python_eval, None or 1 evaluates in-process
+coco_eval = False  # test_net also reports COCO-style AP@[.5:.95] and AP by object size
@@ -1,10 +1,14 @@
 # coding: utf-8
 import tensorflow as tf
 import numpy as np 
-import os, sys
+import os, sys, time, math
+import multiprocessing
+import cv2
 from lxml import etree
 import warnings
 from datasets.image_augmentor import augment
+from detectron.utils import anchors
+from detectron.utils import target_assigner
 from configs import cfgs
 
 class2id = {
@@ -42,7 +46,35 @@ def float_feature(values):
     return tf.train.Feature(float_list=tf.train.FloatList(value=values))
 
 
-def xml_to_example(xmlpath, imgpath):
+def resize_image_and_gt(image, gt, cache_shape, image_cache):
+    """
+    decode and resize an encoded image once at build time, rescale its ground truth
+    :param image: encoded image bytes
+    :param gt: num_boxes x 5, [ymin, ymax, xmin, xmax, id]
+    :param cache_shape: [h, w] stored image size
+    :param image_cache: 'raw' (uint8 RGB bytes) or 'jpeg' (re-encoded at cache_shape)
+    :return: image bytes, shape [h, w, 3], gt
+    """
+    # cv2 decodes BGR, tf.image.decode_jpeg gives RGB
+    img = cv2.imdecode(np.frombuffer(image, np.uint8), cv2.IMREAD_COLOR)
+    height, width = img.shape[0], img.shape[1]
+    cache_h, cache_w = cache_shape
+
+    img = cv2.resize(img, (cache_w, cache_h), interpolation=cv2.INTER_LINEAR)
+    gt = gt.copy()
+    gt[:, 0:2] *= cache_h / float(height)
+    gt[:, 2:4] *= cache_w / float(width)
+
+    if image_cache == 'raw':
+        image = np.ascontiguousarray(img[:, :, ::-1]).tobytes()
+    else:
+        image = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, 95])[1].tobytes()
+
+    shape = np.asarray([cache_h, cache_w, 3], np.int32)
+    return image, shape, gt
+
+
+def xml_to_example(xmlpath, imgpath, image_cache=None, cache_shape=None):
     xml = etree.parse(xmlpath)
     root = xml.getroot()
 
@@ -71,18 +103,109 @@ def xml_to_example(xmlpath, imgpath):
         xmax = float(bndbox.find('xmax').text)
         gt[i, :] = np.asarray([ymin, ymax, xmin, xmax, id], np.float32)
 
-    # get all features
+    # store pre-resized image, parse_fn then skips the full-res decode
+    if image_cache is not None:
+        if cache_shape is None:
+            cache_shape = _cache_shape()
+        image, shape, gt = resize_image_and_gt(image, gt, cache_shape, image_cache)
+
+    # get all features, image_cache tells parse_fn how 'image' is encoded ('' for full-res jpeg)
     features = {
         'image': bytes_feature(image),
         'shape': bytes_feature(shape.tobytes()),
-        'ground_truth': bytes_feature(gt.tobytes())
+        'ground_truth': bytes_feature(gt.tobytes()),
+        'image_cache': bytes_feature((image_cache or '').encode())
     }
 
     example = tf.train.Example(features=tf.train.Features(feature=features))
     return example
 
 
-def dataset2tfrecord(xml_dir, img_dir, output_dir, name, total_shards=5):
+def _cache_shape():
+    """
+    [h, w] of pre-resized images
+    """
+    return list(cfgs.augment_config['zoom_size'] or cfgs.augment_config['output_shape'])
+
+
+def _shard_done(tfrecord, num_examples, image_cache, cache_shape):
+    """
+    a finished shard has every example, written in the same cache mode & shape
+    """
+    if not tf.gfile.Exists(tfrecord) or _count_records(tfrecord) != num_examples:
+        return False
+    if num_examples == 0:
+        return True
+
+    first = tf.train.Example.FromString(next(tf.python_io.tf_record_iterator(tfrecord)))
+    feature = first.features.feature
+    if 'image_cache' not in feature:
+        # written before the cache mode was stored
+        return False
+    if feature['image_cache'].bytes_list.value[0].decode() != (image_cache or ''):
+        return False
+    if image_cache is not None:
+        shape = np.frombuffer(feature['shape'].bytes_list.value[0], np.int32)
+        return list(shape[:2]) == list(cache_shape)
+    return True
+
+
+def _count_records(tfrecord):
+    """
+    count examples in a tfrecord file, -1 if the file is truncated/corrupted
+    """
+    try:
+        return sum(1 for _ in tf.python_io.tf_record_iterator(tfrecord))
+    except tf.errors.DataLossError:
+        return -1
+
+
+def _write_shard(shard):
+    """
+    write one tfrecord shard, run in a worker process
+    :param shard: (shard_id, total_shards, xmlfiles, img_dir, outputname, image_cache, cache_shape)
+    :return: outputname, number of examples written (0 if skipped)
+    """
+    shard_id, total_shards, xmlfiles, img_dir, outputname, image_cache, cache_shape = shard
+
+    # resume: skip shards already fully written, in the same cache mode
+    if _shard_done(outputname, len(xmlfiles), image_cache, cache_shape):
+        print('>> shard %d/%d already done, skip' % (shard_id+1, total_shards))
+        sys.stdout.flush()
+        return outputname, 0
+
+    # write to a temp file, rename when finished, so a killed job never leaves
+    # a partial shard under the final name
+    tmpname = outputname + '.tmp'
+    with tf.python_io.TFRecordWriter(tmpname) as writer:
+        for i, xmlpath in enumerate(xmlfiles):
+            # write an example to tfrecord file
+            example = xml_to_example(xmlpath, img_dir, image_cache, cache_shape)
+            writer.write(example.SerializeToString())
+
+            # show progress
+            if (i+1) % 100 == 0 or i+1 == len(xmlfiles):
+                print('>> shard %d/%d: converted %d/%d images' %
+                      (shard_id+1, total_shards, i+1, len(xmlfiles)))
+                sys.stdout.flush()
+
+    tf.gfile.Rename(tmpname, outputname, overwrite=True)
+    return outputname, len(xmlfiles)
+
+
+def dataset2tfrecord(xml_dir, img_dir, output_dir, name, total_shards=5, num_workers=None):
+    """
+    convert VOC style xml+jpeg pairs to tfrecord shards, one worker process per shard
+    rerun with the same arguments to resume, finished shards are verified and skipped
+    images are stored pre-resized when cfgs.image_cache is set
+    workers are spawned processes: the calling script needs a __main__ guard
+    :param num_workers: number of worker processes, default min(total_shards, cpu_count)
+    :return: list of tfrecord files
+    """
+    assert cfgs.image_cache in [None, 'raw', 'jpeg']
+    if cfgs.image_cache is not None and cfgs.augment_config['keep_aspect_ratios']:
+        warnings.warn('image_cache resizes without keeping aspect ratios!', UserWarning)
+
     # check output dir
     if not tf.gfile.Exists(output_dir):
         tf.gfile.MakeDirs(output_dir)
@@ -91,54 +214,65 @@ def dataset2tfrecord(xml_dir, img_dir, output_dir, name, total_shards=5):
         if len(tf.gfile.ListDirectory(output_dir)) == 0:
             print(output_dir, 'already exist, need not create new.')
         else:
-            warnings.warn(output_dir + 'is not empty!', UserWarning)
-
-    outputfiles = []
+            warnings.warn(output_dir + ' is not empty, finished shards will be skipped!', UserWarning)
 
-    # read xml list
-    xmllist = tf.gfile.Glob(os.path.join(xml_dir, '*.xml'))
-    num_per_shard = int(math.ceil(len(xmllist)) / float(total_shards))
+    # read xml list, sorted so shards are the same across runs
+    xmllist = sorted(tf.gfile.Glob(os.path.join(xml_dir, '*.xml')))
+    num_per_shard = int(math.ceil(len(xmllist) / float(total_shards)))
 
+    shards = []
     for shard_id in range(total_shards):
         # tfrecord file name
         outputname = '%s_%05d-of-%05d.tfrecord' % (name, shard_id+1, total_shards)
         outputname = os.path.join(output_dir, outputname)
-        outputfiles.append(outputname)
 
-        with tf.python_io.TFRecordWriter(outputname) as writer:
-            # xml index range
-            start_ndx = shard_id * num_per_shard
-            end_ndx = min( (shard_id+1) * num_per_shard, len(xmllist))
+        # xml index range
+        start_ndx = shard_id * num_per_shard
+        end_ndx = min((shard_id+1) * num_per_shard, len(xmllist))
+        shards.append((shard_id, total_shards, xmllist[start_ndx:end_ndx], img_dir, outputname,
+                       cfgs.image_cache, _cache_shape()))
 
-            for i in range(start_ndx, end_ndx):
-                # show progress
-                sys.stdout.write('\r>> Converting image %d/%d shard %d/%d' % 
-                                (i+1, len(xmllist), shard_id+1, total_shards))
-                sys.stdout.flush()
+    if num_workers is None:
+        num_workers = min(total_shards, multiprocessing.cpu_count())
 
-                # write an example to tfrecord file
-                example = xml_to_example(xmllist[i], img_dir)
-                writer.write(example.SerializeToString())
+    start = time.time()
+    if num_workers <= 1:
+        results = [_write_shard(shard) for shard in shards]
+    else:
+        # spawned, not forked: forking a process with live TF runtime threads can deadlock
+        pool = multiprocessing.get_context('spawn').Pool(num_workers)
+        try:
+            results = list(pool.imap(_write_shard, shards))
+        finally:
+            pool.close()
+            pool.join()
 
-            sys.stdout.write('\n')
-            sys.stdout.flush()
+    num_written = sum(n for _, n in results)
+    print('>> converted %d/%d images in %.1fs' % (num_written, len(xmllist), time.time() - start))
 
-    return outputfiles
+    return [outputname for outputname, _ in results]
 
 
 def parse_fn(data, config):
     features = tf.parse_single_example(data, features={
         'image': tf.FixedLenFeature([], tf.string),
         'shape': tf.FixedLenFeature([], tf.string),
-        'ground_truth': tf.FixedLenFeature([], tf.string)
+        'ground_truth': tf.FixedLenFeature([], tf.string),
+        # records written before the cache mode was stored follow cfgs.image_cache
+        'image_cache': tf.FixedLenFeature([], tf.string, default_value=cfgs.image_cache or '')
     })
 
     shape = tf.decode_raw(features['shape'], tf.int32)
     gt = tf.decode_raw(features['ground_truth'], tf.float32)
-    image = tf.image.decode_jpeg(features['image'], channels=3)
     shape = tf.reshape(shape, [3])
     gt = tf.reshape(gt, [-1, 5])
-    image = tf.cast(tf.reshape(image, shape), tf.float32)
+    # decoded as the record was written, whatever cfgs.image_cache is now
+    image = tf.cond(tf.equal(features['image_cache'], 'raw'),
+                    # pre-resized uint8 pixels, no decode
+                    lambda: tf.reshape(tf.decode_raw(features['image'], tf.uint8), shape),
+                    # full-res jpeg, or jpeg pre-resized to the cache shape
+                    lambda: tf.reshape(tf.image.decode_jpeg(features['image'], channels=3), shape))
+    image = tf.cast(image, tf.float32)
 
     # image: HxWxC, gt: num_boxes x 5
     image, gt = augment(image=image,
@@ -149,22 +283,72 @@ def parse_fn(data, config):
     return image, gt
 
 
-def get_generator(tfrecords):  #, batch_size, buffer_size, config):
+def assign_targets_fn(image, ground_truth):
+    """
+    per-anchor classification and regression targets of one image, run in the map stage
+    anchors follow the same pyramid-level order as RetinaNet
+    :return: image, ground_truth, labels A, reg_targets Ax4
+    """
+    anchor_levels = anchors.get_anchors(tuple(cfgs.augment_config['output_shape']))
+    abbox_y1x1, abbox_y2x2, abbox_yx, abbox_hw = [
+        tf.constant(np.concatenate([level[i] for level in anchor_levels], axis=0)) for i in range(4)]
+
+    labels, reg_targets = target_assigner.assign_targets(
+        tf.expand_dims(ground_truth, 0), abbox_y1x1, abbox_y2x2, abbox_yx, abbox_hw)
+    return image, ground_truth, labels[0], reg_targets[0]
+
+
+def map_fn(data):
     """
-    :param tfrecords:
-    :param batch_size:
-    :param buffer_size:
-    :return:
+    parse & augment, and optionally assign targets, of one example
     """
-    # create dataset from tfrecords
-    dataset = tf.data.TFRecordDataset(tfrecords)
+    image, ground_truth = parse_fn(data, cfgs.augment_config)
+    if cfgs.assign_targets_in_pipeline:
+        return assign_targets_fn(image, ground_truth)
+    return image, ground_truth
 
-    # operations to dataset
-    dataset = (dataset.map(lambda x: parse_fn(x, cfgs.augment_config))
-        .shuffle(buffer_size=cfgs.buffer_size)
-        .batch(cfgs.batch_size, drop_remainder=True)
-        #.repeat()
-    )
+
+def get_generator(tfrecords, mode=None):  #, batch_size, buffer_size, config):
+    """
+    :param tfrecords: list of tfrecord files
+    :param mode: 'serial' or 'parallel', default cfgs.pipeline_mode
+    :return: init_op, iterator
+    """
+    if mode is None:
+        mode = cfgs.pipeline_mode
+    assert mode in ['serial', 'parallel']
+
+    if mode == 'serial':
+        # create dataset from tfrecords
+        dataset = tf.data.TFRecordDataset(tfrecords)
+
+        # operations to dataset
+        dataset = (dataset.map(map_fn)
+            .shuffle(buffer_size=cfgs.buffer_size)
+        )
+        if cfgs.repeat_dataset:
+            dataset = dataset.repeat()
+        dataset = dataset.batch(cfgs.batch_size, drop_remainder=True)
+
+    else:
+        # read shards in random order, interleaved
+        dataset = tf.data.Dataset.from_tensor_slices(tfrecords)
+        dataset = dataset.shuffle(buffer_size=len(tfrecords))
+        dataset = dataset.apply(tf.data.experimental.parallel_interleave(
+            tf.data.TFRecordDataset, cycle_length=cfgs.num_parallel_reads, sloppy=True))
+
+        # shuffle serialized examples, before the expensive decode
+        dataset = dataset.shuffle(buffer_size=cfgs.buffer_size)
+        if cfgs.repeat_dataset:
+            dataset = dataset.repeat()
+
+        # parallel decode & augment (& target assignment), fused with batching
+        dataset = dataset.apply(tf.data.experimental.map_and_batch(
+            map_fn,
+            cfgs.batch_size,
+            num_parallel_calls=cfgs.num_parallel_calls,
+            drop_remainder=True))
+        dataset = dataset.prefetch(cfgs.prefetch_buffer)
 
     # get iterator of dataset, and corresponding initializer
     iterator = tf.data.Iterator.from_structure(dataset.output_types, dataset.output_shapes)
@@ -172,6 +356,86 @@ def get_generator(tfrecords):  #, batch_size, buffer_size, config):
     return init_op, iterator
 
 
+def get_synthetic_generator(num_batches, seed=0, max_boxes=5):
+    """
+    random images & boxes in the same format as get_generator, no tfrecords needed
+    used to benchmark the model without the dataset
+    :param num_batches: batches per epoch
+    :param seed: fixed seed, every run sees the same data
+    :param max_boxes: boxes per image, 1 to max_boxes
+    :return: init_op, iterator
+    """
+    output_shape = cfgs.augment_config['output_shape']
+    pad_truth_to = cfgs.augment_config['pad_truth_to']
+    num_images = num_batches * cfgs.batch_size
+    rng = np.random.RandomState(seed)
+
+    if cfgs.data_format == 'channels_last':
+        image_shape = [num_images] + list(output_shape) + [3]
+    else:
+        image_shape = [num_images, 3] + list(output_shape)
+    images = rng.uniform(0., 255., image_shape).astype(np.float32)
+
+    # [ycenter, xcenter, h, w, class_id], padded with -1
+    ground_truth = -np.ones([num_images, pad_truth_to, 5], np.float32)
+    for i in range(num_images):
+        num_boxes = rng.randint(1, max_boxes + 1)
+        hw = rng.uniform(0.1, 0.5, [num_boxes, 2]) * output_shape
+        yx = hw / 2. + rng.uniform(0., 1., [num_boxes, 2]) * (output_shape - hw)
+        class_id = rng.randint(0, cfgs.num_classes - 1, [num_boxes, 1])
+        ground_truth[i, :num_boxes] = np.concatenate([yx, hw, class_id], axis=-1)
+
+    dataset = tf.data.Dataset.from_tensor_slices((images, ground_truth))
+    if cfgs.assign_targets_in_pipeline:
+        dataset = dataset.map(assign_targets_fn)
+    if cfgs.repeat_dataset:
+        dataset = dataset.repeat()
+    dataset = dataset.batch(cfgs.batch_size, drop_remainder=True)
+
+    iterator = tf.data.Iterator.from_structure(dataset.output_types, dataset.output_shapes)
+    init_op = iterator.make_initializer(dataset)
+    return init_op, iterator
+
+
+def benchmark_generator(tfrecords, mode=None, num_batches=None, warmup_batches=5):
+    """
+    measure throughput of the input pipeline alone
+    :param tfrecords: list of tfrecord files
+    :param mode: 'serial' or 'parallel', default cfgs.pipeline_mode
+    :param num_batches: batches to time, None means one epoch
+    :param warmup_batches: batches consumed before timing (fill buffers)
+    :return: images/sec, total seconds, number of timed batches
+    """
+    if num_batches is None and cfgs.repeat_dataset:
+        num_batches = int(cfgs.steps_per_epoch)
+
+    with tf.Graph().as_default():
+        init_op, iterator = get_generator(tfrecords, mode)
+        next_op = tf.group(iterator.get_next())
+
+        with tf.Session() as sess:
+            sess.run(init_op)
+            # a dataset shorter than the warmup ends here with nothing timed
+            warmup, count, start = 0, 0, time.time()
+            try:
+                while warmup < warmup_batches:
+                    sess.run(next_op)
+                    warmup += 1
+
+                start = time.time()
+                while num_batches is None or count < num_batches:
+                    sess.run(next_op)
+                    count += 1
+            except tf.errors.OutOfRangeError:
+                pass
+            cost = time.time() - start
+
+    images_per_sec = count * cfgs.batch_size / max(cost, 1e-8)
+    print('{} pipeline: {:d} warmup + {:d} timed batches, {:.2f}s, {:.2f} images/sec'.format(
+        mode or cfgs.pipeline_mode, warmup, count, cost, images_per_sec))
+    return images_per_sec, cost, count
+
+
 # https://cs230-stanford.github.io/tensorflow-input-data.html
 # one good order for the different transformations is:
 
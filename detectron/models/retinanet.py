@@ -6,29 +6,48 @@ import os, sys, time
 from configs import cfgs
 from detectron.nets.resnet_v1_50 import ResNet
 from detectron.utils import common
-from detectron.utils.show_box_in_tensor import draw_boxes_with_categories
-from detectron.utils.show_box_in_tensor import draw_boxes_with_categories_and_scores
+from detectron.utils import box_ops
+from detectron.utils import anchors
+from detectron.utils import target_assigner
+from detectron.utils import draw_box_in_img
+from detectron.utils.async_summary import AsyncSummaryWriter, make_summary
+from detectron.utils.profiler import StepProfiler
 
 
 class RetinaNet():
-    def __init__(self, mode, trainset=None):
+    def __init__(self, mode, trainset=None, restore=True):
         # check cfgs
         assert mode in ['train', 'test']
         assert cfgs.data_format in ['channels_first', 'channels_last']
+        assert cfgs.precision in ['float32', 'float16']
 
         # get cfgs
         self.is_training = (mode == 'train')
+        self.restore = restore  # False keeps random weights, e.g. for benchmarks
+        self.micro_step = 0  # batches trained, global_step counts updates of accumulation_steps batches
+        self.update_time = 0.  # sess.run seconds of the batches of the current update
 
         if self.is_training:
             # self.train_generator = trainset['train_generator']
-            self.train_initializer, self.train_iterator = trainset  # self.train_generator
+            # one (init_op, iterator) pair per replica, or a single pair whose batches all replicas share
+            if isinstance(trainset, list):
+                assert len(trainset) == cfgs.num_replicas
+                self.train_initializer = tf.group([init_op for init_op, _ in trainset])
+                self.train_iterators = [iterator for _, iterator in trainset]
+            else:
+                self.train_initializer, train_iterator = trainset  # self.train_generator
+                self.train_iterators = [train_iterator] * cfgs.num_replicas
 
         # build network architecture
+        start = time.time()
         self._define_inputs()  # placeholders or tf.Tensors from iterator
         self._build_detection_architecture()
+        self.build_time = time.time() - start
 
         # create session & init vars
+        start = time.time()
         self._init_session()
+        self.init_time = time.time() - start
 
         # saver & summary
         if self.is_training:
@@ -36,15 +55,25 @@ class RetinaNet():
             self._create_summary_writer(cfgs.summary_path)
             self._create_summary()
 
+            # opt-in step profiling
+            self.profiler = StepProfiler(cfgs.profile_path, cfgs.profile_inter,
+                                         cfgs.batch_size * cfgs.num_replicas * cfgs.accumulation_steps) \
+                if cfgs.profile else None
+
     def _init_session(self):
         self.sess = tf.Session()
 
         # init global variables
         self.sess.run(tf.global_variables_initializer())
+        self.sess.run(tf.local_variables_initializer())
 
         # restore
         if self.is_training:
-            restorer, ckpt_path = self._get_restorer(cfgs.root_path+'/output/checkpoints/')
+            if self.restore:
+                restorer, ckpt_path = self._get_restorer(cfgs.root_path+'/output/checkpoints/')
+            else:
+                restorer, ckpt_path = None, None
+
             if restorer is not None:
                 # restore weights
                 print('restore from: '+ckpt_path)
@@ -55,17 +84,20 @@ class RetinaNet():
 
                 # restore step & lr
                 global_step = int(ckpt_path.split("-")[-1])
-                self.current_epoch = int(global_step//cfgs.steps_per_epoch)
+                self.current_epoch = int(global_step*cfgs.accumulation_steps//cfgs.steps_per_epoch)
                 # lr = cfgs.lr * 0.96 ** (self.current_epoch//20)
                 
             else:
                 self.current_epoch = 0
 
+            # tracked in python from here on, the loop doesn't read the variable per batch
+            self.global_step_value = int(self.sess.run(self.global_step))
+
             # init data iterator
             if self.train_initializer is not None:
                 self.sess.run(self.train_initializer)
-        else:
-            ckpt_path = cfgs.root_path+'/output/checkpoints/retina-550000'
+        elif self.restore:
+            ckpt_path = cfgs.test_checkpoint or tf.train.latest_checkpoint(cfgs.root_path+'/output/checkpoints/')
             self.load_weight(ckpt_path)
 
     def _define_inputs(self):
@@ -73,7 +105,16 @@ class RetinaNet():
         shape/keep_aspect_ratio_resizer or fixed_shape_resizer
         mean order, where to do minus mean, PIXEL_STD?
         """
-        shape = [None, None, None, 3]
+        # static input size lets anchors be precomputed constants
+        if self.is_training:
+            input_shape = cfgs.augment_config['output_shape']
+        else:
+            input_shape = cfgs.test_input_shape or [None, None]
+
+        if cfgs.data_format == 'channels_last':
+            shape = [None] + list(input_shape) + [3]
+        else:
+            shape = [None, 3] + list(input_shape)
 
         # PIX_MEAN
         mean = tf.convert_to_tensor([123.68, 116.779, 103.979], dtype=tf.float32)
@@ -82,42 +123,120 @@ class RetinaNet():
         else:
             mean = tf.reshape(mean, [1, 3, 1, 1])
 
-        # train mode
+        # train mode, one batch per replica: images, ground_truth, labels, reg_targets
         if self.is_training:
-            self.images, self.ground_truth = self.train_iterator.get_next()
-            self.images.set_shape(shape)
-            self.images = self.images - mean
+            self.tower_inputs = []
+            for iterator in self.train_iterators:
+                if cfgs.assign_targets_in_pipeline:
+                    images, ground_truth, labels, reg_targets = iterator.get_next()
+                else:
+                    images, ground_truth = iterator.get_next()
+                    labels, reg_targets = None, None
+                images.set_shape(shape)
+                self.tower_inputs.append((images - mean, ground_truth, labels, reg_targets))
+            self.images, self.ground_truth, self.labels, self.reg_targets = self.tower_inputs[0]
         
         # test mode
         else:
-            self.images = tf.placeholder(tf.uint8, shape=shape, name='images')
-            self.images = tf.cast(self.images, tf.float32)
+            self.inputs = tf.placeholder(tf.uint8, shape=shape, name='images')
+            self.images = tf.cast(self.inputs, tf.float32)
             self.images = self.images - mean
             # self.ground_truth = tf.placeholder(tf.float32, [None, None, 5], name='labels')
 
     def _build_detection_architecture(self):
-        with tf.variable_scope('feature_pyramid'):
+        # mixed precision: backbone & subnets compute in float16 on float32 master weights,
+        # BatchNorm, softmax & losses stay in float32
+        compute_dtype = tf.float32
+        custom_getter = None
+        if self.is_training and cfgs.precision == 'float16':
+            compute_dtype = tf.float16
+            custom_getter = common.mixed_precision_getter
+
+        if not self.is_training:
+            self._build_tower(compute_dtype, custom_getter)
+            return
+
+        # data-parallel: one tower per replica batch, towers after the first reuse its variables,
+        # ops under tower_<i>/, independent towers run concurrently in the session's inter-op pool
+        tower_losses = []
+        for i, inputs in enumerate(self.tower_inputs):
+            self.images, self.ground_truth, self.labels, self.reg_targets = inputs
+            if i == 0:
+                tower_losses.append(self._build_tower(compute_dtype, custom_getter))
+                # BatchNorm moving statistics follow the first tower only, see cfgs.num_replicas
+                update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
+            else:
+                with tf.variable_scope(tf.get_variable_scope(), reuse=True), tf.name_scope('tower_%d' % i):
+                    tower_losses.append(self._build_tower(compute_dtype, custom_getter, postprocess=False))
+        # summaries show the first tower
+        self.images, self.ground_truth, self.labels, self.reg_targets = self.tower_inputs[0]
+
+        # back in the first tower's scope: same checkpoint & op names as a single tower
+        with tf.variable_scope('inference', auxiliary_name_scope=False), tf.name_scope('inference/'):
+            # averaged loss, its gradients are the mean of the towers' gradients
+            total_loss, self.cls_loss, self.reg_loss = [tf.add_n(list(losses)) / len(tower_losses)
+                                                        for losses in zip(*tower_losses)]
+
+            # weight regularization loss
+            fpn_l2_loss = tf.add_n([tf.nn.l2_loss(var) for var in tf.trainable_variables('feature_pyramid')])
+            sbn_l2_loss = tf.add_n([tf.nn.l2_loss(var) for var in tf.trainable_variables('subnets')])
+            self.weight_decay_loss = cfgs.weight_decay * (fpn_l2_loss + sbn_l2_loss)
+            self.loss = total_loss + self.weight_decay_loss
+
+            self.global_step = tf.get_variable(initializer=tf.constant(0), trainable=False, name='global_step')
+            # global_step counts optimizer updates, one per accumulation_steps batches
+            updates_per_epoch = cfgs.steps_per_epoch / cfgs.accumulation_steps
+            self.lr = tf.train.exponential_decay(cfgs.lr, self.global_step, 20*updates_per_epoch, 0.96, staircase=True, name='learning_rate')
+            optimizer = tf.train.MomentumOptimizer(learning_rate=self.lr, momentum=.9)
+            if compute_dtype == tf.float16:
+                # scaled loss keeps small float16 gradients from flushing to zero,
+                # steps with inf/nan gradients are skipped
+                optimizer = tf.train.experimental.MixedPrecisionLossScaleOptimizer(optimizer, cfgs.loss_scale)
+            if cfgs.accumulation_steps > 1:
+                self.accumulate_op, self.train_op = self._accumulate_gradients(optimizer, update_ops)
+            else:
+                train_op = optimizer.minimize(self.loss, global_step=self.global_step)
+                self.train_op = tf.group([update_ops, train_op])
+                self.accumulate_op = self.train_op
+            # global_step after the update: float16 updates with inf/nan gradients leave it unchanged
+            with tf.control_dependencies([self.train_op]):
+                self.updated_global_step = tf.identity(self.global_step)
+
+    def _build_tower(self, compute_dtype, custom_getter, postprocess=True):
+        """
+        network, anchors & decoding on self.images, losses in train mode
+        :param postprocess: build nms & detection outputs
+        :return: (total_loss, cls_loss, reg_loss) in train mode, weight decay excluded
+        """
+        with tf.variable_scope('feature_pyramid', custom_getter=custom_getter):
             # backbone
-            resnet = ResNet(self.images, is_training=self.is_training)
+            resnet = ResNet(tf.cast(self.images, compute_dtype), is_training=self.is_training)
             feat1, feat2, feat3 = resnet.endpoints[-3:]
             p5 = self._get_pyramid(feat3, 256)
             p4, top_down = self._get_pyramid(feat2, 256, p5)
             p3, _ = self._get_pyramid(feat1, 256, top_down)  # biggest resolution
+            # fpn & p6/p7 convs feed several bns (next level, subnets), cfgs.fold_bn leaves them unfolded
             p6 = common.bn_activation_conv(p5, 256, 3, 2, is_training=self.is_training)
             p7 = common.bn_activation_conv(p6, 256, 3, 2, is_training=self.is_training)
 
-        with tf.variable_scope('subnets'):
+        with tf.variable_scope('subnets', custom_getter=custom_getter):
             # cls and reg subnets: NxHxWxAxclass, NxHxWxAx4
-            p3_cls = self._classification_subnet(p3, 256)
-            p3_reg = self._regression_subnet(p3, 256)
-            p4_cls = self._classification_subnet(p4, 256)
-            p4_reg = self._regression_subnet(p4, 256)
-            p5_cls = self._classification_subnet(p5, 256)
-            p5_reg = self._regression_subnet(p5, 256)
-            p6_cls = self._classification_subnet(p6, 256)
-            p6_reg = self._regression_subnet(p6, 256)
-            p7_cls = self._classification_subnet(p7, 256)
-            p7_reg = self._regression_subnet(p7, 256)
+            p3_cls = self._classification_subnet(p3, 256, 'p3')
+            p3_reg = self._regression_subnet(p3, 256, 'p3')
+            p4_cls = self._classification_subnet(p4, 256, 'p4')
+            p4_reg = self._regression_subnet(p4, 256, 'p4')
+            p5_cls = self._classification_subnet(p5, 256, 'p5')
+            p5_reg = self._regression_subnet(p5, 256, 'p5')
+            p6_cls = self._classification_subnet(p6, 256, 'p6')
+            p6_reg = self._regression_subnet(p6, 256, 'p6')
+            p7_cls = self._classification_subnet(p7, 256, 'p7')
+            p7_reg = self._regression_subnet(p7, 256, 'p7')
+
+            # back to float32 before softmax & losses
+            p3_cls, p4_cls, p5_cls, p6_cls, p7_cls = [tf.cast(p, tf.float32)
+                                                      for p in [p3_cls, p4_cls, p5_cls, p6_cls, p7_cls]]
+            p3_reg, p4_reg, p5_reg, p6_reg, p7_reg = [tf.cast(p, tf.float32)
+                                                      for p in [p3_reg, p4_reg, p5_reg, p6_reg, p7_reg]]
 
             # if NCHW transpose to NHWC
             if cfgs.data_format == 'channels_first':
@@ -132,13 +251,6 @@ class RetinaNet():
                 p7_cls = tf.transpose(p7_cls, [0, 2, 3, 1])
                 p7_reg = tf.transpose(p7_reg, [0, 2, 3, 1])
 
-            # get preds' shape
-            p3shape = tf.shape(p3_cls)
-            p4shape = tf.shape(p4_cls)
-            p5shape = tf.shape(p5_cls)
-            p6shape = tf.shape(p6_cls)
-            p7shape = tf.shape(p7_cls)
-
         with tf.variable_scope('inference'):
             # cls & reg -> bbox:  NxHWAx2, NxHWAx2, NxHWAxclass
             # diff H, W for each pyramid-level
@@ -148,12 +260,13 @@ class RetinaNet():
             p6bbox_yx, p6bbox_hw, p6conf = self._get_pbbox(p6_cls, p6_reg)
             p7bbox_yx, p7bbox_hw, p7conf = self._get_pbbox(p7_cls, p7_reg)
 
-            # anchor bbox: HWAx2
-            a3bbox_y1x1, a3bbox_y2x2, a3bbox_yx, a3bbox_hw = self._get_abbox(cfgs.anchors[0], p3shape)
-            a4bbox_y1x1, a4bbox_y2x2, a4bbox_yx, a4bbox_hw = self._get_abbox(cfgs.anchors[1], p4shape)
-            a5bbox_y1x1, a5bbox_y2x2, a5bbox_yx, a5bbox_hw = self._get_abbox(cfgs.anchors[2], p5shape)
-            a6bbox_y1x1, a6bbox_y2x2, a6bbox_yx, a6bbox_hw = self._get_abbox(cfgs.anchors[3], p6shape)
-            a7bbox_y1x1, a7bbox_y2x2, a7bbox_yx, a7bbox_hw = self._get_abbox(cfgs.anchors[4], p7shape)
+            # anchor bbox: HWAx2, constants when the input size is static
+            a3bbox, a4bbox, a5bbox, a6bbox, a7bbox = anchors.anchor_tensors(self.images)
+            a3bbox_y1x1, a3bbox_y2x2, a3bbox_yx, a3bbox_hw = a3bbox
+            a4bbox_y1x1, a4bbox_y2x2, a4bbox_yx, a4bbox_hw = a4bbox
+            a5bbox_y1x1, a5bbox_y2x2, a5bbox_yx, a5bbox_hw = a5bbox
+            a6bbox_y1x1, a6bbox_y2x2, a6bbox_yx, a6bbox_hw = a6bbox
+            a7bbox_y1x1, a7bbox_y2x2, a7bbox_yx, a7bbox_hw = a7bbox
 
             # merge predictions of all pyramid-level
             pbbox_yx = tf.concat([p3bbox_yx, p4bbox_yx, p5bbox_yx, p6bbox_yx, p7bbox_yx], axis=1)
@@ -166,120 +279,247 @@ class RetinaNet():
             abbox_yx = tf.concat([a3bbox_yx, a4bbox_yx, a5bbox_yx, a6bbox_yx, a7bbox_yx], axis=0)
             abbox_hw = tf.concat([a3bbox_hw, a4bbox_hw, a5bbox_hw, a6bbox_hw, a7bbox_hw], axis=0)
 
+            # named raw head outputs, before decode & nms: NxAx4 (yx, hw deltas), NxAxclass
+            tf.identity(tf.concat([pbbox_yx, pbbox_hw], axis=-1), name='box_encodings')
+            tf.identity(pconf, name='class_logits')
+
             if self.is_training:
-                cond = lambda loss, conf_loss, pos_coord_loss, i: tf.less(i, tf.cast(cfgs.batch_size, tf.float32))
-                def body(loss, conf_loss, pos_coord_loss, i):
-                    losses = self._compute_one_image_loss(
-                            tf.squeeze(tf.gather(pbbox_yx, tf.cast(i, tf.int32))),
-                            tf.squeeze(tf.gather(pbbox_hw, tf.cast(i, tf.int32))),
-                            tf.squeeze(tf.gather(pconf, tf.cast(i, tf.int32))),
-                            abbox_y1x1,
-                            abbox_y2x2,
-                            abbox_yx,
-                            abbox_hw,
-                            tf.squeeze(tf.gather(self.ground_truth, tf.cast(i, tf.int32)))
-                        )
-                    tloss, closs, ploss = losses
-                    loss = tf.add(loss, tloss)
-                    conf_loss = tf.add(conf_loss, closs)
-                    pos_coord_loss = tf.add(pos_coord_loss, ploss)
-                    i = tf.add(i, 1.)
-                    # loss = loss + tloss,
-                    # conf_loss = conf_loss + closs,
-                    # pos_coord_loss = pos_coord_loss + ploss,
-                    # i = i + 1.
-
-                    return loss, conf_loss, pos_coord_loss, i
-                
-                i = 0.
-                loss = 0.
-                conf_loss = 0. 
-                pos_coord_loss = 0.
-                init_state = (loss, conf_loss, pos_coord_loss, i)                
-                state = tf.while_loop(cond, body, init_state)
-                
-                #total_loss, _ = state
-                total_loss = state[0] / cfgs.batch_size
-                self.cls_loss = state[1] / cfgs.batch_size
-                self.reg_loss = state[2] / cfgs.batch_size
-
-                # weight regularization loss
-                fpn_l2_loss = tf.add_n([tf.nn.l2_loss(var) for var in tf.trainable_variables('feature_pyramid')])
-                sbn_l2_loss = tf.add_n([tf.nn.l2_loss(var) for var in tf.trainable_variables('subnets')])
-                self.weight_decay_loss = cfgs.weight_decay * (fpn_l2_loss + sbn_l2_loss)
-                self.loss = total_loss + self.weight_decay_loss
-
-                self.global_step = tf.get_variable(initializer=tf.constant(0), trainable=False, name='global_step')
-                self.lr = tf.train.exponential_decay(cfgs.lr, self.global_step, 20*cfgs.steps_per_epoch, 0.96, staircase=True, name='learning_rate')
-                optimizer = tf.train.MomentumOptimizer(learning_rate=self.lr, momentum=.9)
-                train_op = optimizer.minimize(self.loss, global_step=self.global_step)
-                update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
-                self.train_op = tf.group([update_ops, train_op])
-            
+                if cfgs.assign_targets_in_pipeline:
+                    # targets come with the batch, only the loss is computed here
+                    total_loss, self.cls_loss, self.reg_loss = self._compute_loss_from_targets(
+                        pbbox_yx, pbbox_hw, pconf, self.labels, self.reg_targets)
+                elif cfgs.loss_mode == 'batched':
+                    total_loss, self.cls_loss, self.reg_loss = self._compute_batch_loss(
+                        pbbox_yx, pbbox_hw, pconf, abbox_y1x1, abbox_y2x2, abbox_yx, abbox_hw, self.ground_truth)
+                else:
+                    total_loss, self.cls_loss, self.reg_loss = self._compute_per_image_loss(
+                        pbbox_yx, pbbox_hw, pconf, abbox_y1x1, abbox_y2x2, abbox_yx, abbox_hw, self.ground_truth)
+
+                tower_losses = (total_loss, self.cls_loss, self.reg_loss)
+            if not postprocess:
+                return tower_losses
+
             # delta {pbbox_yx, pbbox_hw, pconf} 
             # decode with anchor {abbox_yx, abbox_hw}
-            # get boxes {bbox_yx, bbox_hw, id}
-            pbbox_yxt = pbbox_yx[0, ...]
-            pbbox_hwt = pbbox_hw[0, ...]
-            confidence= tf.nn.softmax(pconf[0, ...])
-            class_id = tf.argmax(confidence, axis=-1)
-            conf_mask = tf.less(class_id, cfgs.num_classes - 1)
-
-            pbbox_yxt = tf.boolean_mask(pbbox_yxt, conf_mask)
-            pbbox_hwt = tf.boolean_mask(pbbox_hwt, conf_mask)
-            confidence = tf.boolean_mask(confidence, conf_mask)[:, :cfgs.num_classes - 1]
-
-            abbox_yxt = tf.boolean_mask(abbox_yx, conf_mask)
-            abbox_hwt = tf.boolean_mask(abbox_hw, conf_mask)
-            
+            # get boxes {bbox_yx, bbox_hw, id} for each image, padded to max_detections
+            # keep pyramid-levels apart, for top-k candidates per level
+            pbbox_yx_levels = (p3bbox_yx, p4bbox_yx, p5bbox_yx, p6bbox_yx, p7bbox_yx)
+            pbbox_hw_levels = (p3bbox_hw, p4bbox_hw, p5bbox_hw, p6bbox_hw, p7bbox_hw)
+            pconf_levels = (p3conf, p4conf, p5conf, p6conf, p7conf)
+            abbox_yx_levels = [a3bbox_yx, a4bbox_yx, a5bbox_yx, a6bbox_yx, a7bbox_yx]
+            abbox_hw_levels = [a3bbox_hw, a4bbox_hw, a5bbox_hw, a6bbox_hw, a7bbox_hw]
+            scores, bbox_final, class_id, num_detections = tf.map_fn(
+                lambda x: self._postprocess_one_image(x[0], x[1], x[2], abbox_yx_levels, abbox_hw_levels),
+                (pbbox_yx_levels, pbbox_hw_levels, pconf_levels),
+                dtype=(tf.float32, tf.float32, tf.int32, tf.int32),
+                back_prop=False
+            )
+            # named outputs, the signature of exported graphs
+            scores = tf.identity(scores, name='detection_scores')
+            bbox_final = tf.identity(bbox_final, name='detection_boxes')
+            class_id = tf.identity(class_id, name='detection_classes')
+            num_detections = tf.identity(num_detections, name='num_detections')
+            self.batch_detection_pred = [scores, bbox_final, class_id, num_detections]
+
+            # valid detections of the first image
+            self.detection_pred = [scores[0, :num_detections[0]],
+                                   bbox_final[0, :num_detections[0]],
+                                   class_id[0, :num_detections[0]]]
+
+        if self.is_training:
+            return tower_losses
+
+    def _accumulate_gradients(self, optimizer, update_ops):
+        """
+        gradients of cfgs.accumulation_steps batches, averaged into one optimizer update
+        accumulators are local variables: not in checkpoints, zero after restore, kept across epochs
+        :return: accumulate_op (add this batch's gradients),
+                 train_op (add this batch's gradients, apply the average, reset, step global_step)
+        """
+        grads_and_vars = [(g, v) for g, v in optimizer.compute_gradients(self.loss) if g is not None]
+        with tf.variable_scope('gradient_accumulation'):
+            accumulators = [tf.get_variable(v.op.name.replace('/', '_'), v.get_shape(), tf.float32,
+                                            initializer=tf.zeros_initializer(), trainable=False,
+                                            collections=[tf.GraphKeys.LOCAL_VARIABLES])
+                            for _, v in grads_and_vars]
+
+        # the update reads the sums through the assign_add outputs, so it runs after this batch is added
+        accumulated = [tf.assign_add(acc, g) for acc, (g, _) in zip(accumulators, grads_and_vars)]
+        accumulate_op = tf.group([update_ops, accumulated])
+
+        apply_op = optimizer.apply_gradients(
+            [(acc / cfgs.accumulation_steps, v) for acc, (_, v) in zip(accumulated, grads_and_vars)],
+            global_step=self.global_step)
+        with tf.control_dependencies([apply_op]):
+            reset_op = tf.group([tf.assign(acc, tf.zeros_like(acc)) for acc in accumulators])
+        train_op = tf.group([update_ops, reset_op])
+        return accumulate_op, train_op
+
+    def _postprocess_one_image(self, pbbox_yx, pbbox_hw, pconf, abbox_yx, abbox_hw):
+        """
+        decode and nms predictions of one image
+        all inputs are per pyramid-level lists
+        pbbox_yx, pbbox_hw: HWAx2, pconf: HWAxclass, abbox_yx, abbox_hw: HWAx2
+        return: scores K, bbox Kx4 (yx, hw), class_id K, num_detections
+                padded to K = (num_classes-1) * nms_max_boxes, class_id of padding is -1
+        """
+        confidence = []
+        dpbbox_y1x1y2x2 = []
+        for pbbox_yxt, pbbox_hwt, pconft, abbox_yxt, abbox_hwt in zip(pbbox_yx, pbbox_hw, pconf, abbox_yx, abbox_hw):
+            conft = tf.nn.softmax(pconft)
+
+            # drop anchors predicted as background
+            class_id = tf.argmax(conft, axis=-1)
+            conf_mask = tf.cast(tf.less(class_id, cfgs.num_classes - 1), tf.float32)
+            conft = conft[:, :cfgs.num_classes - 1] * tf.expand_dims(conf_mask, axis=-1)
+
+            # keep top-k candidates of this level
+            if cfgs.pre_nms_top_k is not None:
+                top_k = tf.minimum(cfgs.pre_nms_top_k, tf.shape(conft)[0])
+                _, top_k_indices = tf.nn.top_k(tf.reduce_max(conft, axis=-1), top_k, sorted=False)
+                conft = tf.gather(conft, top_k_indices)
+                pbbox_yxt = tf.gather(pbbox_yxt, top_k_indices)
+                pbbox_hwt = tf.gather(pbbox_hwt, top_k_indices)
+                abbox_yxt = tf.gather(abbox_yxt, top_k_indices)
+                abbox_hwt = tf.gather(abbox_hwt, top_k_indices)
+
             # decode
             dpbbox_yxt = pbbox_yxt * abbox_hwt + abbox_yxt
             dpbbox_hwt = tf.exp(pbbox_hwt) * abbox_hwt
             dpbbox_y1x1 = dpbbox_yxt - dpbbox_hwt / 2.
-            dpbbox_y2x2 = dpbbox_yxt + dpbbox_hwt / 2. 
-            dpbbox_y1x1y2x2 = tf.concat([dpbbox_y1x1, dpbbox_y2x2], axis=-1)
-            
-            # select predictions that conf higher than nms_score_threshold
-            filter_mask = tf.greater_equal(confidence, cfgs.nms_score_threshold)
-
-            # do nms, get detections
-            scores = []
-            class_id = []
-            bbox = []
-            for i in range(cfgs.num_classes - 1):
-                # filter
-                scoresi = tf.boolean_mask(confidence[:, i], filter_mask[:, i])
-                bboxi = tf.boolean_mask(dpbbox_y1x1y2x2, filter_mask[:, i])
-
-                # nms
-                selected_indices = tf.image.non_max_suppression(
-                    bboxi, scoresi, cfgs.nms_max_boxes, cfgs.nms_iou_threshold, name='nms'
-                )
+            dpbbox_y2x2 = dpbbox_yxt + dpbbox_hwt / 2.
 
-                scores.append(tf.gather(scoresi, selected_indices))
-                bbox.append(tf.gather(bboxi, selected_indices))
-                class_id.append(tf.ones_like(tf.gather(scoresi, selected_indices), tf.int32) * i)
+            confidence.append(conft)
+            dpbbox_y1x1y2x2.append(tf.concat([dpbbox_y1x1, dpbbox_y2x2], axis=-1))
 
-            bbox = tf.concat(bbox, axis=0)
-            scores = tf.concat(scores, axis=0)
-            class_id = tf.concat(class_id, axis=0)
+        confidence = tf.concat(confidence, axis=0)
+        dpbbox_y1x1y2x2 = tf.concat(dpbbox_y1x1y2x2, axis=0)
 
-            # get y1x1, y2x2
-            bbox_y1x1 = bbox[:, :2]
-            bbox_y2x2 = bbox[:, 2:]
+        # select predictions that conf higher than nms_score_threshold, do nms, get detections
+        scores, bbox, class_id = box_ops.multiclass_nms(
+            dpbbox_y1x1y2x2, confidence,
+            method=cfgs.nms_method,
+            max_boxes_per_class=cfgs.nms_max_boxes,
+            max_total_boxes=(cfgs.num_classes - 1) * cfgs.nms_max_boxes,
+            iou_threshold=cfgs.nms_iou_threshold,
+            score_threshold=cfgs.nms_score_threshold
+        )
 
-            # bounding box clipping
-            input_h = tf.shape(self.images)[1]
-            input_w = tf.shape(self.images)[2]
-            bbox_y1x1_clipped = tf.maximum(tf.minimum(bbox_y1x1, [input_h, input_w]), [0, 0])
-            bbox_y2x2_clipped = tf.maximum(tf.minimum(bbox_y2x2, [input_h, input_w]), [0, 0])
+        return self._clip_and_pad_detections(scores, bbox, class_id)
 
-            # compute yx, hw
-            bbox_yx = (bbox_y2x2_clipped + bbox_y1x1_clipped) / 2.
-            bbox_hw = bbox_y2x2_clipped - bbox_y1x1_clipped
-            bbox_final = tf.concat([bbox_yx, bbox_hw], axis=-1)
-            
-            self.detection_pred = [scores, bbox_final, class_id]
+    def _clip_and_pad_detections(self, scores, bbox, class_id):
+        """
+        clip y1x1y2x2 boxes to the input image, convert to yx, hw and pad to max_detections
+        """
+        # get y1x1, y2x2
+        bbox_y1x1 = bbox[:, :2]
+        bbox_y2x2 = bbox[:, 2:]
+
+        # bounding box clipping
+        input_h = tf.cast(tf.shape(self.images)[1], tf.float32)
+        input_w = tf.cast(tf.shape(self.images)[2], tf.float32)
+        bbox_y1x1_clipped = tf.maximum(tf.minimum(bbox_y1x1, [input_h, input_w]), [0., 0.])
+        bbox_y2x2_clipped = tf.maximum(tf.minimum(bbox_y2x2, [input_h, input_w]), [0., 0.])
+
+        # compute yx, hw
+        bbox_yx = (bbox_y2x2_clipped + bbox_y1x1_clipped) / 2.
+        bbox_hw = bbox_y2x2_clipped - bbox_y1x1_clipped
+        bbox_final = tf.concat([bbox_yx, bbox_hw], axis=-1)
+
+        # pad to a fixed number of detections, so images can be batched
+        max_detections = (cfgs.num_classes - 1) * cfgs.nms_max_boxes
+        num_detections = tf.shape(scores)[0]
+        num_pad = max_detections - num_detections
+        scores = tf.pad(scores, [[0, num_pad]])
+        bbox_final = tf.pad(bbox_final, [[0, num_pad], [0, 0]])
+        class_id = tf.pad(class_id, [[0, num_pad]], constant_values=-1)
+        scores.set_shape([max_detections])
+        bbox_final.set_shape([max_detections, 4])
+        class_id.set_shape([max_detections])
+
+        return scores, bbox_final, class_id, num_detections
+
+    def _compute_per_image_loss(self, pbbox_yx, pbbox_hw, pconf,
+                                abbox_y1x1, abbox_y2x2, abbox_yx, abbox_hw,
+                                ground_truth):
+        """
+        loss of a batch, one image at a time in a tf.while_loop
+        """
+        cond = lambda loss, conf_loss, pos_coord_loss, i: tf.less(i, tf.cast(cfgs.batch_size, tf.float32))
+        def body(loss, conf_loss, pos_coord_loss, i):
+            losses = self._compute_one_image_loss(
+                    tf.squeeze(tf.gather(pbbox_yx, tf.cast(i, tf.int32))),
+                    tf.squeeze(tf.gather(pbbox_hw, tf.cast(i, tf.int32))),
+                    tf.squeeze(tf.gather(pconf, tf.cast(i, tf.int32))),
+                    abbox_y1x1,
+                    abbox_y2x2,
+                    abbox_yx,
+                    abbox_hw,
+                    tf.squeeze(tf.gather(ground_truth, tf.cast(i, tf.int32)))
+                )
+            tloss, closs, ploss = losses
+            loss = tf.add(loss, tloss)
+            conf_loss = tf.add(conf_loss, closs)
+            pos_coord_loss = tf.add(pos_coord_loss, ploss)
+            i = tf.add(i, 1.)
+            # loss = loss + tloss,
+            # conf_loss = conf_loss + closs,
+            # pos_coord_loss = pos_coord_loss + ploss,
+            # i = i + 1.
+
+            return loss, conf_loss, pos_coord_loss, i
+
+        i = 0.
+        loss = 0.
+        conf_loss = 0. 
+        pos_coord_loss = 0.
+        init_state = (loss, conf_loss, pos_coord_loss, i)                
+        state = tf.while_loop(cond, body, init_state)
+
+        #total_loss, _ = state
+        total_loss = state[0] / cfgs.batch_size
+        cls_loss = state[1] / cfgs.batch_size
+        reg_loss = state[2] / cfgs.batch_size
+        return total_loss, cls_loss, reg_loss
+
+    def _compute_batch_loss(self, pbbox_yx, pbbox_hw, pconf,
+                            abbox_y1x1, abbox_y2x2, abbox_yx, abbox_hw,
+                            ground_truth):
+        """
+        loss of a batch, targets of all images assigned at once
+        ground_truth: BxGx5, padding rows are -1
+        """
+        labels, reg_targets = target_assigner.assign_targets(
+            ground_truth, abbox_y1x1, abbox_y2x2, abbox_yx, abbox_hw)
+        return self._compute_loss_from_targets(pbbox_yx, pbbox_hw, pconf, labels, reg_targets)
+
+    def _compute_loss_from_targets(self, pbbox_yx, pbbox_hw, pconf, labels, reg_targets):
+        """
+        focal loss over positive and negative anchors, smooth l1 over positive anchors
+        both normalized by the number of positive anchors of each image, averaged over the batch
+        pbbox_yx, pbbox_hw: BxAx2, pconf: BxAxclass
+        labels: BxA, reg_targets: BxAx4, see target_assigner.assign_targets
+        """
+        pos_mask = tf.cast(tf.logical_and(labels >= 0, labels < cfgs.num_classes - 1), tf.float32)
+        valid_mask = tf.cast(labels >= 0, tf.float32)
+        num_pos = tf.maximum(tf.reduce_sum(pos_mask, axis=1), 1.)
+
+        # focal loss
+        prob = tf.nn.softmax(pconf)
+        prob = tf.reduce_sum(prob * tf.one_hot(tf.maximum(labels, 0), cfgs.num_classes), axis=-1)
+        prob = tf.clip_by_value(prob, 1e-8, 1.)
+        focal_loss = - cfgs.alpha * tf.pow(1. - prob, cfgs.gamma) * tf.log(prob)
+        conf_loss = tf.reduce_sum(focal_loss * valid_mask, axis=1) / num_pos
+
+        # smooth l1 loss
+        pbbox = tf.concat([pbbox_yx, pbbox_hw], axis=-1)
+        coord_loss = tf.reduce_sum(self._smooth_l1_loss(pbbox - reg_targets), axis=-1)
+        pos_coord_loss = tf.reduce_sum(coord_loss * pos_mask, axis=1) / num_pos
+
+        conf_loss = tf.reduce_mean(conf_loss)
+        pos_coord_loss = tf.reduce_mean(pos_coord_loss)
+        total_loss = conf_loss + pos_coord_loss
+        return total_loss, conf_loss, pos_coord_loss
 
     def _compute_one_image_loss(self, pbbox_yx, pbbox_hw, pconf, 
                                 abbox_y1x1, abbox_y2x2, abbox_yx, abbox_hw, 
@@ -294,32 +534,12 @@ class RetinaNet():
         gbbox_y1x1 = gbbox_yx - gbbox_hw / 2.
         gbbox_y2x2 = gbbox_yx + gbbox_hw / 2. 
 
-        # ti? tile
-        abbox_hwti = tf.reshape(abbox_hw, [1, -1, 2])
-        abbox_y1x1ti = tf.reshape(abbox_y1x1, [1, -1, 2])
-        abbox_y2x2ti = tf.reshape(abbox_y2x2, [1, -1, 2])
-        ashape = tf.shape(abbox_hwti)
-
-        gbbox_hwti = tf.reshape(gbbox_hw, [-1, 1, 2])
-        gbbox_y1x1ti = tf.reshape(gbbox_y1x1, [-1, 1, 2])
-        gbbox_y2x2ti = tf.reshape(gbbox_y2x2, [-1, 1, 2])
-        gshape = tf.shape(gbbox_hwti)
-
-        abbox_hwti = tf.tile(abbox_hwti, [gshape[0], 1, 1])
-        abbox_y1x1ti = tf.tile(abbox_y1x1ti, [gshape[0], 1, 1])
-        abbox_y2x2ti = tf.tile(abbox_y2x2ti, [gshape[0], 1, 1])
-        gbbox_hwti = tf.tile(gbbox_hwti, [1, ashape[1], 1])
-        gbbox_y1x1ti = tf.tile(gbbox_y1x1ti, [1, ashape[1], 1])
-        gbbox_y2x2ti = tf.tile(gbbox_y2x2ti, [1, ashape[1], 1])
-
-        gaIoU_y1x1ti = tf.maximum(abbox_y1x1ti, gbbox_y1x1ti)
-        gaIoU_y2x2ti = tf.minimum(abbox_y2x2ti, gbbox_y2x2ti)
-        gaIoU_area = tf.reduce_prod(tf.maximum(gaIoU_y2x2ti - gaIoU_y1x1ti, 0), axis=-1)
-        aarea = tf.reduce_prod(abbox_hwti, axis=-1)
-        garea = tf.reduce_prod(gbbox_hwti, axis=-1)
-        gaIoU = gaIoU_area / (aarea + garea - gaIoU_area)
-
-        best_raIdx = tf.argmax(gaIoU, axis=1)  # relative anchor index
+        # gt x anchor iou, broadcast instead of tiled copies
+        gaIoU = box_ops.pairwise_iou(gbbox_y1x1, gbbox_y2x2, abbox_y1x1, abbox_y2x2)
+        num_anchors = tf.shape(abbox_yx, out_type=tf.int64)[0]
+
+        # best anchor of each gt, best gt of each anchor
+        best_raIdx, rgIdx, best_agIoU = box_ops.argmax_matching(gaIoU)  # relative anchor index
         best_pbbox_yx = tf.gather(pbbox_yx, best_raIdx)
         best_pbbox_hw = tf.gather(pbbox_hw, best_raIdx)
         best_pconf = tf.gather(pconf, best_raIdx)
@@ -330,7 +550,7 @@ class RetinaNet():
         bestmask = tf.sort(bestmask)
         bestmask = tf.reshape(bestmask, [-1, 1])
         bestmask = tf.SparseTensor(tf.concat([bestmask, tf.zeros_like(bestmask)], axis=-1),
-                                          tf.squeeze(tf.ones_like(bestmask)), dense_shape=[ashape[1], 1])
+                                          tf.squeeze(tf.ones_like(bestmask)), dense_shape=[num_anchors, 1])
         bestmask = tf.reshape(tf.cast(tf.sparse.to_dense(bestmask), tf.float32), [-1])
 
         othermask = 1. - bestmask
@@ -342,12 +562,10 @@ class RetinaNet():
         other_abbox_yx = tf.boolean_mask(abbox_yx, othermask)
         other_abbox_hw = tf.boolean_mask(abbox_hw, othermask)
 
-        agIoU = tf.transpose(gaIoU)
-        other_agIoU = tf.boolean_mask(agIoU, othermask)
-        best_agIoU  = tf.reduce_max(other_agIoU, axis=1)
+        best_agIoU = tf.boolean_mask(best_agIoU, othermask)
+        rgIdx = tf.boolean_mask(rgIdx, othermask)
         pos_agIoU_mask = best_agIoU > 0.5
         neg_agIoU_mask = best_agIoU < 0.4
-        rgIdx = tf.argmax(other_agIoU, axis=1)
         pos_rgIdx = tf.boolean_mask(rgIdx, pos_agIoU_mask)
         pos_pbbox_yx = tf.boolean_mask(other_pbbox_yx, pos_agIoU_mask)
         pos_pbbox_hw = tf.boolean_mask(other_pbbox_hw, pos_agIoU_mask)
@@ -411,100 +629,96 @@ class RetinaNet():
         """
         prediction -> bbox: yx, hw, conf
         """
-        pconf = tf.reshape(predc, [cfgs.batch_size, -1, cfgs.num_classes])
-        pbbox = tf.reshape(predr, [cfgs.batch_size, -1, 4])
+        batch_size = tf.shape(predc)[0]
+        pconf = tf.reshape(predc, [batch_size, -1, cfgs.num_classes])
+        pbbox = tf.reshape(predr, [batch_size, -1, 4])
         pbbox_yx = pbbox[..., :2]
         pbbox_hw = pbbox[..., 2:]
         return pbbox_yx, pbbox_hw, pconf
 
-    def _get_abbox(self, size, pshape):
-        """
-        get all anchors' yx, hw
-        size: base size of anchors in this layer
-        pshape: is NHWC channel order
-        """
-        ph = tf.cast(pshape[1], tf.float32)
-        pw = tf.cast(pshape[2], tf.float32)
-
-        if cfgs.data_format == 'channels_last':
-            input_h = tf.shape(self.images)[1]
-            downsampling_rate = tf.cast(input_h, tf.float32) / ph
-        else:
-            input_h = tf.shape(self.images)[2]
-            downsampling_rate = tf.cast(input_h, tf.float32) / ph
-
-        # tl_yx, top-left yx for each anchors, YXAS
-        tl_y = tf.range(0., ph, dtype=tf.float32)
-        tl_x = tf.range(0., pw, dtype=tf.float32)
-        tl_y = tf.reshape(tl_y, [-1, 1, 1, 1]) + 0.5  # center
-        tl_x = tf.reshape(tl_x, [1, -1, 1, 1]) + 0.5
-
-        # repeat along axis, and scale back
-        tl_y = tf.tile(tl_y, [1, pshape[2], 1, 1]) * downsampling_rate
-        tl_x = tf.tile(tl_x, [pshape[1], 1, 1, 1]) * downsampling_rate
-        tl_yx = tf.concat([tl_y, tl_x], -1)
-
-        # repeat for all anchors: HxWxAx2
-        tl_yx = tf.tile(tl_yx, [1, 1, cfgs.num_anchors, 1])
-
-        # get all shapes for each anchor
-        priors = []
-        for r in cfgs.aspect_ratios:
-            for s in cfgs.anchor_size:
-                # anchor shapes
-                priors.append([s*size*(r**0.5), s*size/(r**0.5)])
-        priors = tf.convert_to_tensor(priors, tf.float32)
-        priors = tf.reshape(priors, [1, 1, -1, 2])  # 1x1xAx2
-
-        # HxWxAx2 - 1x1xAx2 -> HxWxAx2 -> HWAx2
-        abbox_y1x1 = tf.reshape(tl_yx - priors / 2., [-1, 2])
-        abbox_y2x2 = tf.reshape(tl_yx + priors / 2., [-1, 2])
-        abbox_yx = (abbox_y1x1 + abbox_y2x2) / 2.
-        abbox_hw = abbox_y2x2 - abbox_y1x1
-        return abbox_y1x1, abbox_y2x2, abbox_yx, abbox_hw
-
     def train_one_epoch(self):  # , lr
         self.is_training = True
         self.sess.run(self.train_initializer)
+        num_steps = 0
         
         while True:
-            try:
-                # get global step
-                global_step = self.sess.run(self.global_step) + 1
-
-                # train
-                if global_step == 1 or global_step % cfgs.show_inter == 0:
-                    start = time.time()
-
-                    # train a step
-                    _, cls_loss, reg_loss, total_loss \
-                    = self.sess.run([self.train_op, self.cls_loss, self.reg_loss, self.loss])  # , feed_dict={self.lr: lr}
-                    
-                    end = time.time()
+            # repeated dataset never ends, stop after one epoch of steps
+            if cfgs.repeat_dataset and num_steps >= cfgs.steps_per_epoch:
+                print('Finish one epoch!')
+                break
+            num_steps += 1
 
-                    # show infos
+            try:
+                # the optimizer updates on every accumulation_steps-th batch, other batches only add gradients
+                # a partial accumulation at the end of an epoch is carried into the next one, every update
+                # averages exactly accumulation_steps batches
+                update = (self.micro_step + 1) % cfgs.accumulation_steps == 0
+
+                # global step after this update, unless the update is skipped
+                global_step = self.global_step_value + 1
+                show = update and (global_step == 1 or global_step % cfgs.show_inter == 0)
+                summarize = update and global_step % cfgs.sumr_inter == 0
+
+                # train a step, losses & summary values come from the same run
+                fetches = {'train_op': self.train_op if update else self.accumulate_op}
+                if update:
+                    fetches['global_step'] = self.updated_global_step
+                if show:
+                    fetches.update(cls_loss=self.cls_loss, reg_loss=self.reg_loss, total_loss=self.loss)
+                if summarize:
+                    fetches['summary'] = self.summary_fetches
+
+                # traced & timed per update, the trace is the batch that applies the gradients
+                run_options, run_metadata = None, None
+                if self.profiler is not None and update:
+                    run_options, run_metadata = self.profiler.run_options(global_step)
+
+                start = time.time()
+                results = self.sess.run(fetches, options=run_options, run_metadata=run_metadata)  # , feed_dict={self.lr: lr}
+                end = time.time()
+                # counted only once the batch is in: the end of the data raises before it
+                self.micro_step += 1
+                self.update_time += end - start
+                if not update:
+                    continue
+                # the variable, not a python count: it drives the lr schedule, checkpoint names & restore
+                stepped = results['global_step'] > self.global_step_value
+                global_step = self.global_step_value = int(results['global_step'])
+                update_time, self.update_time = self.update_time, 0.
+                if not stepped:
+                    print('step {:d}: update skipped, non-finite gradients'.format(global_step + 1))
+
+                if self.profiler is not None:
+                    # the trace covers the last batch of the update, timed by itself
+                    self.profiler.add_step(global_step, update_time, run_metadata, trace_time=end - start)
+                    if show:
+                        self.summary_writer.add_scalars(
+                            {'THROUGHPUT/images_per_sec': self.profiler.images_per_sec()}, global_step)
+
+                # show infos
+                if show:
                     training_time = time.strftime('%Y-%M-%D %H:%M:%S', time.localtime(time.time()))
                     print('{} step: {:d}, cls_loss:{:.4f}, reg_loss:{:.4f}, total_loss:{:.4f}, per_cost_time:{:.4f}s' \
-                        .format(training_time, global_step, cls_loss, reg_loss, total_loss, (end - start)))
-
-                else:
-                    # train a step
-                    _ = self.sess.run(self.train_op)  # , feed_dict={self.lr: lr}
+                        .format(training_time, global_step, results['cls_loss'], results['reg_loss'],
+                                results['total_loss'], update_time))
 
                 # save
-                if global_step % cfgs.save_inter == 0:
+                if stepped and global_step % cfgs.save_inter == 0:
                     self._save_weight(cfgs.checkpoint_path)
 
-                # summary
-                if global_step % cfgs.sumr_inter == 0:
-                    summary_str = self.sess.run(self.summary_op)
-                    self.summary_writer.add_summary(summary_str, global_step=global_step)
-                    self.summary_writer.flush()
+                # summary, drawn & written in the background
+                if summarize:
+                    self.summary_writer.add(results['summary'], global_step)
 
             except tf.errors.OutOfRangeError:
                 print('Finish one epoch!')
                 break
 
+        # pending summaries are on disk before the next epoch
+        self.summary_writer.flush()
+        if self.profiler is not None:
+            self.profiler.report()
+
     def load_weight(self, ckpt_path):
         # var_list = tf.trainable_variables()
         # g_list = tf.global_variables()
@@ -516,29 +730,51 @@ class RetinaNet():
         restorer.restore(self.sess, ckpt_path)
         print('load weights from:', ckpt_path)
 
-    def test_one_batch(self, img):
+    def test_one_batch(self, imgs):
+        """
+        imgs: NxHxWx3 uint8
+        return: scores NxK, boxes NxKx4 (yx, hw), labels NxK, num_detections N
+                only the first num_detections[i] detections of image i are valid
+        """
         self.is_training = False
-        scores, boxes, labels = self.sess.run(self.detection_pred, feed_dict={self.images: img})
+        scores, boxes, labels, num_detections = self.sess.run(self.batch_detection_pred,
+                                                              feed_dict={self.inputs: imgs})
         # v_list = [var.name for var in tf.global_variables() if "moving_variance" in var.name]
         # print(v_list[-1], self.sess.run(self.sess.graph.get_tensor_by_name('subnets/batch_normalization_49/moving_variance:0')))
-        return scores, boxes, labels
-
-    def _classification_subnet(self, featmap, filters):
-        conv1 = common.bn_activation_conv(featmap, filters, 3, 1, is_training=self.is_training)
-        conv2 = common.bn_activation_conv(conv1, filters, 3, 1, is_training=self.is_training)
-        conv3 = common.bn_activation_conv(conv2, filters, 3, 1, is_training=self.is_training)
-        conv4 = common.bn_activation_conv(conv3, filters, 3, 1, is_training=self.is_training)
-        pred = common.bn_activation_conv(conv4, cfgs.num_anchors*cfgs.num_classes, 3, 1, pi_init=True, is_training=self.is_training)
+        return scores, boxes, labels, num_detections
+
+    def _classification_subnet(self, featmap, filters, level):
+        if cfgs.share_head_weights:
+            return self._shared_subnet(featmap, filters, cfgs.num_anchors*cfgs.num_classes,
+                                       'cls_subnet', level, pi_init=True)
+
+        # conv1-conv4, pred
+        blocks = [(filters, 3, 1, False)] * 4 + [(cfgs.num_anchors*cfgs.num_classes, 3, 1, True)]
+        pred = common.bn_activation_conv_chain(featmap, blocks, is_training=self.is_training)
         return pred
 
-    def _regression_subnet(self, featmap, filters):
-        conv1 = common.bn_activation_conv(featmap, filters, 3, 1, is_training=self.is_training)
-        conv2 = common.bn_activation_conv(conv1, filters, 3, 1, is_training=self.is_training)
-        conv3 = common.bn_activation_conv(conv2, filters, 3, 1, is_training=self.is_training)
-        conv4 = common.bn_activation_conv(conv3, filters, 3, 1, is_training=self.is_training)
-        pred = common.bn_activation_conv(conv4, cfgs.num_anchors*4, 3, 1, is_training=self.is_training)
+    def _regression_subnet(self, featmap, filters, level):
+        if cfgs.share_head_weights:
+            return self._shared_subnet(featmap, filters, cfgs.num_anchors*4, 'reg_subnet', level)
+
+        # conv1-conv4, pred
+        blocks = [(filters, 3, 1, False)] * 4 + [(cfgs.num_anchors*4, 3, 1, False)]
+        pred = common.bn_activation_conv_chain(featmap, blocks, is_training=self.is_training)
         return pred
 
+    def _shared_subnet(self, featmap, filters, pred_filters, scope, level, pi_init=False):
+        """
+        subnet whose conv weights are reused by every pyramid-level
+        BatchNorm is per level, unless cfgs.share_head_bn
+        """
+        with tf.variable_scope(scope, reuse=tf.AUTO_REUSE):
+            names = ['conv%d' % (i+1) for i in range(4)] + ['pred']
+            bn_names = [name + '_bn' if cfgs.share_head_bn else name + '_bn_' + level for name in names]
+            blocks = [(filters, 3, 1, False)] * 4 + [(pred_filters, 3, 1, pi_init)]
+            conv = common.bn_activation_conv_chain(featmap, blocks, is_training=self.is_training,
+                                                   names=names, bn_names=bn_names)
+        return conv
+
     def _get_pyramid(self, featmap, filters, top_feat=None):
         if top_feat is None:
             return common.bn_activation_conv(featmap, filters, 3, 1, is_training=self.is_training)
@@ -549,7 +785,7 @@ class RetinaNet():
                 feat = common.bn_activation_conv(featmap, filters, 1, 1, is_training=self.is_training)
 
                 # resize top feat
-                top_feat = tf.image.resize_bilinear(top_feat, [tf.shape(feat)[1], tf.shape(feat)[2]])
+                top_feat = tf.cast(tf.image.resize_bilinear(top_feat, [tf.shape(feat)[1], tf.shape(feat)[2]]), feat.dtype)
 
                 # add 
                 total_feat = feat + top_feat
@@ -561,7 +797,7 @@ class RetinaNet():
                 feat = tf.transpose(feat, [0, 2, 3, 1])  # NCHW->NHWC
 
                 top_feat = tf.transpose(top_feat, [0, 2, 3, 1])
-                top_feat = tf.image.resize_bilinear(top_feat, [tf.shape(feat)[1], tf.shape(feat)[2]])
+                top_feat = tf.cast(tf.image.resize_bilinear(top_feat, [tf.shape(feat)[1], tf.shape(feat)[2]]), feat.dtype)
 
                 total_feat = feat + top_feat
                 total_feat = tf.transpose(total_feat, [0, 3, 1, 2])  # NHWC->NCHW
@@ -580,29 +816,44 @@ class RetinaNet():
         print('save model in:', path)
 
     def _create_summary_writer(self, summary_path):
-        self.summary_writer = tf.summary.FileWriter(summary_path, graph=self.sess.graph)
+        file_writer = tf.summary.FileWriter(summary_path, graph=self.sess.graph)
+        self.summary_writer = AsyncSummaryWriter(file_writer, self._render_summary)
 
     def _create_summary(self):
-        with tf.variable_scope('LOSS'):
-            tf.summary.scalar('total_loss', self.loss)
-            tf.summary.scalar('pred_cls_loss', self.cls_loss)
-            tf.summary.scalar('pred_reg_loss', self.reg_loss)
-            tf.summary.scalar('weight_decay_loss', self.weight_decay_loss)
-
-        with tf.variable_scope('LR'):
-            tf.summary.scalar('learning_rate', self.lr)
-
-        img_gt = draw_boxes_with_categories(self.images[0:1,...], 
-                                            boxes=self.ground_truth[0, :, :-1],
-                                            labels=self.ground_truth[0, :, -1])
-        img_det = draw_boxes_with_categories_and_scores(self.images[0:1,...], 
-                                                        boxes=self.detection_pred[1],
-                                                        labels=self.detection_pred[2],
-                                                        scores=self.detection_pred[0])
-
-        tf.summary.image('DETECT_CMP/final_detection', img_det)
-        tf.summary.image('DETECT_CMP/ground_truth', img_gt)
-        self.summary_op = tf.summary.merge_all()
+        # fetched with the train op of a summary step, rendered & written by self.summary_writer
+        self.summary_fetches = {
+            'LOSS/total_loss': self.loss,
+            'LOSS/pred_cls_loss': self.cls_loss,
+            'LOSS/pred_reg_loss': self.reg_loss,
+            'LOSS/weight_decay_loss': self.weight_decay_loss,
+            'LR/learning_rate': self.lr,
+            'image': self.images[0],
+            'ground_truth': self.ground_truth[0],
+            'detection': self.detection_pred,
+        }
+
+    def _render_summary(self, values):
+        """
+        runs on the summary thread
+        """
+        image = values['image']
+        if cfgs.data_format == 'channels_first':
+            image = np.transpose(image, [1, 2, 0])
+
+        ground_truth = values['ground_truth']
+        img_gt = draw_box_in_img.draw_boxes_with_label_and_scores(image,
+                                                                  boxes=ground_truth[:, :-1],
+                                                                  labels=ground_truth[:, -1],
+                                                                  scores=np.ones(ground_truth.shape[0]))
+        scores, boxes, labels = values['detection']
+        img_det = draw_box_in_img.draw_boxes_with_label_and_scores(image,
+                                                                   boxes=boxes,
+                                                                   labels=labels,
+                                                                   scores=scores)
+
+        scalars = {tag: value for tag, value in values.items() if '/' in tag}
+        return make_summary(scalars, {'DETECT_CMP/final_detection': img_det,
+                                      'DETECT_CMP/ground_truth': img_gt})
 
     def _get_restorer(self, ckpt_dir):
         restorer = None
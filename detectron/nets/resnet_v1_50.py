@@ -79,8 +79,9 @@ class ResNet():
         with tf.variable_scope(scope):
             # residual-branch
             with tf.variable_scope('residual'):
-                conv = common.bn_activation_conv(inputs, filters, 3, strides, is_training=self.is_training)  # maybe down sample
-                conv = common.bn_activation_conv(conv, filters, 3, 1, is_training=self.is_training)  # no down sample
+                conv = common.bn_activation_conv_chain(inputs, [(filters, 3, strides, False),  # maybe down sample
+                                                                (filters, 3, 1, False)],       # no down sample
+                                                       is_training=self.is_training)
 
             # identity-branch
             with tf.variable_scope('identity'):
@@ -95,9 +96,10 @@ class ResNet():
         with tf.variable_scope(scope):
             # residual-branch
             with tf.variable_scope('residual'):
-                conv = common.bn_activation_conv(inputs, filters, 1, 1, is_training=self.is_training)      # ?strides
-                conv = common.bn_activation_conv(conv, filters, 3, strides, is_training=self.is_training)  # ?1
-                conv = common.bn_activation_conv(conv, 4*filters, 1, 1, is_training=self.is_training)
+                conv = common.bn_activation_conv_chain(inputs, [(filters, 1, 1, False),          # ?strides
+                                                                (filters, 3, strides, False),    # ?1
+                                                                (4*filters, 1, 1, False)],
+                                                       is_training=self.is_training)
 
             # identity-branch
             with tf.variable_scope('identity'):
@@ -0,0 +1,106 @@
+# coding: utf-8
+
+import tensorflow as tf
+import numpy as np
+import functools
+import math
+from configs import cfgs
+
+# pyramid-levels p3-p7
+MIN_LEVEL = 3
+MAX_LEVEL = 7
+
+
+def featmap_shapes(input_shape):
+    """
+    feature map size of each pyramid-level for an input size
+    every stride 2 layer of the network uses 'same' padding: size -> ceil(size / 2)
+    input_shape: [h, w]
+    return: [(h, w), ...] for p3-p7
+    """
+    h, w = input_shape
+    shapes = []
+    for level in range(1, MAX_LEVEL + 1):
+        h = int(math.ceil(h / 2.))
+        w = int(math.ceil(w / 2.))
+        if level >= MIN_LEVEL:
+            shapes.append((h, w))
+    return shapes
+
+
+def generate_anchors(input_shape, featmap_shape, size):
+    """
+    get all anchors' y1x1, y2x2, yx, hw of one pyramid-level
+    input_shape: [h, w] of the network input
+    featmap_shape: [h, w] of this pyramid-level
+    size: base size of anchors in this layer
+    return: y1x1, y2x2, yx, hw, each HWAx2 float32
+    """
+    ph, pw = featmap_shape
+    downsampling_rate = float(input_shape[0]) / ph
+
+    # center yx of each cell, scaled back: HxWx1x2
+    tl_y = (np.arange(ph, dtype=np.float32) + 0.5) * downsampling_rate
+    tl_x = (np.arange(pw, dtype=np.float32) + 0.5) * downsampling_rate
+    tl_y, tl_x = np.meshgrid(tl_y, tl_x, indexing='ij')
+    tl_yx = np.stack([tl_y, tl_x], axis=-1)[:, :, np.newaxis, :]
+
+    # get all shapes for each anchor: 1x1xAx2
+    priors = []
+    for r in cfgs.aspect_ratios:
+        for s in cfgs.anchor_size:
+            # anchor shapes
+            priors.append([s*size*(r**0.5), s*size/(r**0.5)])
+    priors = np.reshape(np.asarray(priors, np.float32), [1, 1, -1, 2])
+
+    # HxWx1x2 - 1x1xAx2 -> HxWxAx2 -> HWAx2
+    abbox_y1x1 = np.reshape(tl_yx - priors / 2., [-1, 2]).astype(np.float32)
+    abbox_y2x2 = np.reshape(tl_yx + priors / 2., [-1, 2]).astype(np.float32)
+    abbox_yx = (abbox_y1x1 + abbox_y2x2) / 2.
+    abbox_hw = abbox_y2x2 - abbox_y1x1
+    return abbox_y1x1, abbox_y2x2, abbox_yx, abbox_hw
+
+
+@functools.lru_cache(maxsize=cfgs.anchor_cache_size)
+def get_anchors(input_shape):
+    """
+    anchors of all pyramid-levels for an input size, computed once per size
+    input_shape: (h, w) tuple
+    return: [(y1x1, y2x2, yx, hw), ...] for p3-p7, numpy arrays
+    """
+    input_shape = tuple(int(x) for x in input_shape)
+    return [generate_anchors(input_shape, featmap_shape, size)
+            for featmap_shape, size in zip(featmap_shapes(input_shape), cfgs.anchors)]
+
+
+def anchor_tensors(images):
+    """
+    anchors of all pyramid-levels for a batch of images
+    static input size: constants, no anchor ops run at all
+    dynamic input size: tf.py_func looking up the LRU cache of get_anchors
+    images: NHWC or NCHW tensor
+    return: [(y1x1, y2x2, yx, hw), ...] for p3-p7, each HWAx2
+    """
+    if cfgs.data_format == 'channels_last':
+        hw_axis = [1, 2]
+    else:
+        hw_axis = [2, 3]
+
+    static_shape = images.get_shape().as_list()
+    input_h, input_w = static_shape[hw_axis[0]], static_shape[hw_axis[1]]
+
+    if input_h is not None and input_w is not None:
+        with tf.name_scope('anchors'):
+            return [tuple(tf.constant(a) for a in level)
+                    for level in get_anchors((input_h, input_w))]
+
+    def _flat_anchors(input_shape):
+        return [a for level in get_anchors(tuple(input_shape)) for a in level]
+
+    input_shape = tf.gather(tf.shape(images), hw_axis)
+    num_levels = MAX_LEVEL - MIN_LEVEL + 1
+    flat = tf.py_func(_flat_anchors, [input_shape], [tf.float32] * (4 * num_levels),
+                      stateful=False, name='anchors')
+    for a in flat:
+        a.set_shape([None, 2])
+    return [tuple(flat[4*i: 4*i+4]) for i in range(num_levels)]
@@ -0,0 +1,68 @@
+# coding: utf-8
+
+import tensorflow as tf
+import numpy as np
+import threading, queue
+import cv2
+
+
+def make_summary(scalars, images):
+    """
+    summary proto from numpy values, no graph ops needed
+    :param scalars: {tag: float}
+    :param images: {tag: HxWx3 uint8 RGB}
+    """
+    values = [tf.Summary.Value(tag=tag, simple_value=float(value)) for tag, value in scalars.items()]
+    for tag, img in images.items():
+        _, png = cv2.imencode('.png', np.ascontiguousarray(img[:, :, ::-1]))
+        values.append(tf.Summary.Value(tag=tag, image=tf.Summary.Image(encoded_image_string=png.tobytes(),
+                                                                       height=img.shape[0],
+                                                                       width=img.shape[1],
+                                                                       colorspace=3)))
+    return tf.Summary(value=values)
+
+
+class AsyncSummaryWriter():
+    """
+    render & write summaries on a background thread, the training loop only hands over fetched values
+    render_fn(values) -> tf.Summary runs on the thread
+    """
+    def __init__(self, file_writer, render_fn, max_pending=4):
+        self.file_writer = file_writer
+        self.render_fn = render_fn
+        # bounded: training blocks only when max_pending summaries are behind
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    break
+                values, global_step = item
+                summary = values if isinstance(values, tf.Summary) else self.render_fn(values)
+                self.file_writer.add_summary(summary, global_step=global_step)
+                self.file_writer.flush()
+            except Exception as e:
+                print('summary of step {} failed: {}'.format(item[1], e))
+            finally:
+                self.queue.task_done()
+
+    def add(self, values, global_step):
+        self.queue.put((values, global_step))
+
+    def add_scalars(self, scalars, global_step):
+        # already numbers, nothing to render
+        self.queue.put((make_summary(scalars, {}), global_step))
+
+    def flush(self):
+        # wait until everything handed over is written
+        self.queue.join()
+        self.file_writer.flush()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.file_writer.close()
@@ -0,0 +1,139 @@
+# coding: utf-8
+
+import tensorflow as tf
+
+
+def multiclass_nms(boxes, scores, method, max_boxes_per_class, max_total_boxes,
+                   iou_threshold, score_threshold):
+    """
+    non max suppression of all classes
+    :param boxes: Nx4, [y1, x1, y2, x2]
+    :param scores: Nxclass, background excluded
+    :param method: 'loop', 'offset' or 'combined'
+    :return: scores M, boxes Mx4, class_id M
+    """
+    assert method in ['loop', 'offset', 'combined']
+    if method == 'loop':
+        return _nms_loop(boxes, scores, max_boxes_per_class, iou_threshold, score_threshold)
+    elif method == 'offset':
+        return _nms_offset(boxes, scores, max_total_boxes, iou_threshold, score_threshold)
+    else:
+        return _nms_combined(boxes, scores, max_boxes_per_class, max_total_boxes,
+                             iou_threshold, score_threshold)
+
+
+def _nms_loop(boxes, scores, max_boxes_per_class, iou_threshold, score_threshold):
+    """
+    one nms subgraph per class
+    """
+    num_classes = scores.get_shape().as_list()[-1]
+    filter_mask = tf.greater_equal(scores, score_threshold)
+
+    nms_scores = []
+    nms_class_id = []
+    nms_boxes = []
+    for i in range(num_classes):
+        # filter
+        scoresi = tf.boolean_mask(scores[:, i], filter_mask[:, i])
+        boxesi = tf.boolean_mask(boxes, filter_mask[:, i])
+
+        # nms
+        selected_indices = tf.image.non_max_suppression(
+            boxesi, scoresi, max_boxes_per_class, iou_threshold, name='nms'
+        )
+
+        nms_scores.append(tf.gather(scoresi, selected_indices))
+        nms_boxes.append(tf.gather(boxesi, selected_indices))
+        nms_class_id.append(tf.ones_like(selected_indices, tf.int32) * i)
+
+    nms_scores = tf.concat(nms_scores, axis=0)
+    nms_boxes = tf.concat(nms_boxes, axis=0)
+    nms_class_id = tf.concat(nms_class_id, axis=0)
+    return nms_scores, nms_boxes, nms_class_id
+
+
+def _nms_offset(boxes, scores, max_total_boxes, iou_threshold, score_threshold):
+    """
+    single nms over all classes, boxes of different classes are shifted apart
+    by class_id * (2 * max |coordinate| + 1) so they never overlap
+    note: max_total_boxes is shared by all classes, there is no per-class limit
+    """
+    # (anchor, class) pairs over score threshold
+    indices = tf.where(tf.greater_equal(scores, score_threshold))
+    candidate_scores = tf.gather_nd(scores, indices)
+    candidate_boxes = tf.gather(boxes, indices[:, 0])
+    candidate_class_id = tf.cast(indices[:, 1], tf.int32)
+
+    # shift boxes by class, coords lie in [-m, m], so 2m+1 apart never overlap
+    offset = 2. * tf.reduce_max(tf.abs(candidate_boxes)) + 1.
+    shifted_boxes = candidate_boxes + \
+        tf.expand_dims(tf.cast(candidate_class_id, tf.float32) * offset, axis=-1)
+
+    selected_indices = tf.image.non_max_suppression(
+        shifted_boxes, candidate_scores, max_total_boxes, iou_threshold, name='nms'
+    )
+
+    nms_scores = tf.gather(candidate_scores, selected_indices)
+    nms_boxes = tf.gather(candidate_boxes, selected_indices)
+    nms_class_id = tf.gather(candidate_class_id, selected_indices)
+    return nms_scores, nms_boxes, nms_class_id
+
+
+def _nms_combined(boxes, scores, max_boxes_per_class, max_total_boxes, iou_threshold, score_threshold):
+    """
+    tf.image.combined_non_max_suppression, all classes in one op
+    """
+    nms_boxes, nms_scores, nms_class_id, valid_detections = tf.image.combined_non_max_suppression(
+        boxes=tf.reshape(boxes, [1, -1, 1, 4]),  # boxes are shared by all classes
+        scores=tf.expand_dims(scores, axis=0),
+        max_output_size_per_class=max_boxes_per_class,
+        max_total_size=max_total_boxes,
+        iou_threshold=iou_threshold,
+        score_threshold=score_threshold,
+        pad_per_class=False,
+        clip_boxes=False,
+        name='nms'
+    )
+
+    # remove padding
+    num_valid = valid_detections[0]
+    nms_scores = nms_scores[0, :num_valid]
+    nms_boxes = nms_boxes[0, :num_valid]
+    nms_class_id = tf.cast(nms_class_id[0, :num_valid], tf.int32)
+    return nms_scores, nms_boxes, nms_class_id
+
+
+def pairwise_iou(y1x1_a, y2x2_a, y1x1_b, y2x2_b):
+    """
+    iou of every pair of boxes by broadcasting, no tiled copies
+    all intermediates are NxM, one per coordinate
+    :param y1x1_a, y2x2_a: Nx2, or BxNx2 for a batch
+    :param y1x1_b, y2x2_b: Mx2
+    :return: NxM, or BxNxM
+    """
+    # Nx1 against 1xM
+    y1_a, x1_a = tf.split(tf.expand_dims(y1x1_a, -2), 2, axis=-1)
+    y2_a, x2_a = tf.split(tf.expand_dims(y2x2_a, -2), 2, axis=-1)
+    y1_b, x1_b = tf.split(tf.expand_dims(y1x1_b, 0), 2, axis=-1)
+    y2_b, x2_b = tf.split(tf.expand_dims(y2x2_b, 0), 2, axis=-1)
+
+    inter_h = tf.maximum(tf.minimum(y2_a, y2_b) - tf.maximum(y1_a, y1_b), 0.)
+    inter_w = tf.maximum(tf.minimum(x2_a, x2_b) - tf.maximum(x1_a, x1_b), 0.)
+    inter_area = tf.squeeze(inter_h * inter_w, axis=-1)
+
+    area_a = tf.reduce_prod(y2x2_a - y1x1_a, axis=-1, keepdims=True)  # Nx1
+    area_b = tf.expand_dims(tf.reduce_prod(y2x2_b - y1x1_b, axis=-1), 0)  # 1xM
+    return inter_area / (area_a + area_b - inter_area)
+
+
+def argmax_matching(iou):
+    """
+    best matches between ground truth and anchors
+    :param iou: GxA, ground truth against anchors
+    :return: best anchor of each ground truth G,
+             best ground truth of each anchor A, and its iou A
+    """
+    best_anchor = tf.argmax(iou, axis=1)
+    best_gt = tf.argmax(iou, axis=0)
+    best_gt_iou = tf.reduce_max(iou, axis=0)
+    return best_anchor, best_gt, best_gt_iou
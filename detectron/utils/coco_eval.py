@@ -0,0 +1,157 @@
+# coding: utf-8
+
+import numpy as np
+from detectron.utils.voc_eval import VOCEvaluator, NAME_LABEL_MAP
+
+# COCO definitions: IoU thresholds 0.5:0.05:0.95, 101 recall points, object size by area in pixels
+IOU_THRESHOLDS = np.linspace(0.5, 0.95, 10)
+RECALL_THRESHOLDS = np.linspace(0., 1., 101)
+AREA_RANGES = [('all', 0., np.inf),
+               ('small', 0., 32.**2),
+               ('medium', 32.**2, 96.**2),
+               ('large', 96.**2, np.inf)]
+
+
+class COCOEvaluator():
+    """
+    COCO-style AP over IoU thresholds and object sizes, on VOC annotations
+    one IoU matrix per image serves every threshold and size range, matching is vectorized over both
+    difficult objects are treated like COCO crowd regions: matching them is neither TP nor FP
+    """
+    def __init__(self, test_annotation_path):
+        # reuse ground-truth loading & IoU of the VOC evaluator
+        self.voc = VOCEvaluator(test_annotation_path)
+        self.class_names = self.voc.class_names
+        self.num_ranges = len(AREA_RANGES)
+        self.num_thresholds = len(IOU_THRESHOLDS)
+
+        # per class, lists over images
+        self.num_pos = np.zeros([len(self.class_names), self.num_ranges], np.int64)
+        self.scores = [[] for _ in self.class_names]
+        self.tp = [[] for _ in self.class_names]
+        self.ignored = [[] for _ in self.class_names]
+        self.results = {}
+
+    @staticmethod
+    def _in_range(areas):
+        """
+        return: RxN, areas inside each size range
+        """
+        low = np.array([r[1] for r in AREA_RANGES])[:, np.newaxis]
+        high = np.array([r[2] for r in AREA_RANGES])[:, np.newaxis]
+        return (areas[np.newaxis, :] >= low) & (areas[np.newaxis, :] < high)
+
+    @staticmethod
+    def _areas(boxes):
+        return (boxes[:, 2] - boxes[:, 0] + 1.) * (boxes[:, 3] - boxes[:, 1] + 1.)
+
+    def add_image(self, img_id, dets):
+        """
+        :param img_id: image name without extension
+        :param dets: Nx6 [category, score, xmin, ymin, xmax, ymax]
+        """
+        gt_boxes, gt_labels, gt_difficult = self.voc.load_ground_truth(img_id)
+        gt_ignore = gt_difficult[np.newaxis, :] | ~self._in_range(self._areas(gt_boxes))  # RxG
+        for r in range(self.num_ranges):
+            np.add.at(self.num_pos[:, r], gt_labels[~gt_ignore[r]], 1)
+
+        dets = np.asarray(dets, np.float64).reshape([-1, 6])
+        if dets.shape[0] == 0:
+            return
+        dets = dets[np.argsort(-dets[:, 1], kind='mergesort')]
+        labels = dets[:, 0].astype(np.int64)
+        num_dets, num_gts = dets.shape[0], gt_boxes.shape[0]
+
+        # one matrix for every threshold & size range, pairs of different classes never match
+        overlaps = self.voc.iou_matrix(dets[:, 2:], gt_boxes)
+        overlaps[labels[:, np.newaxis] != gt_labels[np.newaxis, :]] = -1.
+
+        # RxTxN, per detection: matched a gt, matched an ignored gt
+        tp = np.zeros([self.num_ranges, self.num_thresholds, num_dets], np.bool_)
+        ignored = np.zeros([self.num_ranges, self.num_thresholds, num_dets], np.bool_)
+        gt_taken = np.zeros([self.num_ranges, self.num_thresholds, num_gts], np.bool_)
+        ignore_rtg = np.broadcast_to(gt_ignore[:, np.newaxis, :], gt_taken.shape)
+
+        # greedy by score, only detections that can match at the lowest threshold need it
+        best_overlap = overlaps.max(axis=1) if num_gts > 0 else np.zeros(num_dets) - 1.
+        for d in np.where(best_overlap >= IOU_THRESHOLDS[0])[0]:
+            above = overlaps[d][np.newaxis, np.newaxis, :] >= IOU_THRESHOLDS[np.newaxis, :, np.newaxis]
+            # a free regular gt first, else any ignored gt (ignored gts can be matched many times)
+            regular = np.where(above & ~ignore_rtg & ~gt_taken, overlaps[d], -1.)
+            fallback = np.where(above & ignore_rtg, overlaps[d], -1.)
+            j_regular = np.argmax(regular, axis=-1)
+            j_fallback = np.argmax(fallback, axis=-1)
+            has_regular = np.max(regular, axis=-1) >= 0.
+            has_fallback = np.max(fallback, axis=-1) >= 0.
+
+            tp[:, :, d] = has_regular
+            ignored[:, :, d] = ~has_regular & has_fallback
+            r_idx, t_idx = np.where(has_regular)
+            gt_taken[r_idx, t_idx, j_regular[r_idx, t_idx]] = True
+
+        # unmatched detections outside a size range don't count in it
+        out_of_range = ~self._in_range(self._areas(dets[:, 2:]))  # RxN
+        ignored |= ~tp & out_of_range[:, np.newaxis, :]
+
+        for cls_id in np.unique(labels):
+            mask = labels == cls_id
+            self.scores[cls_id].append(dets[mask, 1])
+            self.tp[cls_id].append(tp[..., mask])
+            self.ignored[cls_id].append(ignored[..., mask])
+
+    def _class_ap(self, cls_id):
+        """
+        return: RxT AP of one class, -1 where the class has no ground truth in a range
+        """
+        ap = -np.ones([self.num_ranges, self.num_thresholds])
+        if not self.scores[cls_id]:
+            ap[self.num_pos[cls_id] > 0] = 0.
+            return ap
+
+        order = np.argsort(-np.concatenate(self.scores[cls_id]), kind='mergesort')
+        tp = np.concatenate(self.tp[cls_id], axis=-1)[..., order]
+        ignored = np.concatenate(self.ignored[cls_id], axis=-1)[..., order]
+
+        # ignored detections add nothing, repeated points don't change the interpolation
+        tp_sum = np.cumsum(tp & ~ignored, axis=-1).astype(np.float64)
+        fp_sum = np.cumsum(~tp & ~ignored, axis=-1).astype(np.float64)
+        recall = tp_sum / np.maximum(self.num_pos[cls_id], 1)[:, np.newaxis, np.newaxis]
+        precision = tp_sum / np.maximum(tp_sum + fp_sum, np.finfo(np.float64).eps)
+        precision = np.maximum.accumulate(precision[..., ::-1], axis=-1)[..., ::-1]
+
+        for r in range(self.num_ranges):
+            if self.num_pos[cls_id, r] == 0:
+                continue
+            for t in range(self.num_thresholds):
+                inds = np.searchsorted(recall[r, t], RECALL_THRESHOLDS, side='left')
+                valid = inds < recall.shape[-1]
+                ap[r, t] = np.sum(precision[r, t][inds[valid]]) / len(RECALL_THRESHOLDS)
+        return ap
+
+    def evaluate(self, verbose=True):
+        """
+        return: dict of AP, AP50, AP75, AP_small, AP_medium, AP_large
+                per-class RxT APs in self.results[cls]
+        """
+        aps = np.stack([self._class_ap(NAME_LABEL_MAP[cls]) for cls in self.class_names])  # CxRxT
+        for cls, ap in zip(self.class_names, aps):
+            self.results[cls] = ap
+
+        def mean_ap(x):
+            x = x[x > -1]
+            return float(np.mean(x)) if x.size else -1.
+
+        t50 = np.argmin(np.abs(IOU_THRESHOLDS - 0.5))
+        t75 = np.argmin(np.abs(IOU_THRESHOLDS - 0.75))
+        metrics = {'AP': mean_ap(aps[:, 0]),
+                   'AP50': mean_ap(aps[:, 0, t50]),
+                   'AP75': mean_ap(aps[:, 0, t75])}
+        for r, (name, _, _) in enumerate(AREA_RANGES[1:], 1):
+            metrics['AP_' + name] = mean_ap(aps[:, r])
+
+        if verbose:
+            for cls, ap in zip(self.class_names, aps):
+                print("AP: {:.4f},  AP50: {:.4f},  AP75: {:.4f},  cls: {}".format(
+                    mean_ap(ap[0]), ap[0, t50], ap[0, t75], cls))
+            print(' '.join('{}: {:.4f}'.format(k, v) for k, v in metrics.items()))
+        return metrics
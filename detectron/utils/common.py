@@ -5,24 +5,84 @@ import math
 from configs import cfgs
 
 
-def _bn(inputs, is_training):
+def mixed_precision_getter(getter, name, shape=None, dtype=None, initializer=None,
+                           regularizer=None, trainable=True, *args, **kwargs):
+    """
+    custom_getter for mixed precision: trainable variables are stored in float32 (master weights),
+    layers running in float16 get a cast of them
+    """
+    storage_dtype = tf.float32 if trainable else dtype
+    variable = getter(name, shape, dtype=storage_dtype, initializer=initializer,
+                      regularizer=regularizer, trainable=trainable, *args, **kwargs)
+    if trainable and dtype != tf.float32:
+        variable = tf.cast(variable, dtype)
+    return variable
+
+def _bn(inputs, is_training, name=None):
+    # always in float32, also under mixed precision
+    dtype = inputs.dtype
+    inputs = tf.cast(inputs, tf.float32)
+    # batch statistics in training, moving averages at inference
     bn = tf.layers.batch_normalization(
         inputs=inputs,
         axis=3 if cfgs.data_format == 'channels_last' else 1,
-        training=True#is_training
+        training=is_training,
+        name=name
     )
-    return bn
+    return tf.cast(bn, dtype)
 
-def conv_bn_actibation(inputs, filters, ksize, strides,
-                        activation=tf.nn.relu, is_training=True):
-    # conv
-    conv = tf.layers.conv2d(inputs, filters, ksize, strides,
+def _conv_layer(filters, ksize, strides, pi_init=False, name=None):
+    # same layer & variable names as tf.layers.conv2d(..., name=name)
+    bias_initializer = tf.constant_initializer(-math.log((1 - cfgs.pi) / cfgs.pi)) if pi_init \
+        else tf.zeros_initializer()
+    return tf.layers.Conv2D(filters, ksize, strides,
                             padding='same',
                             data_format=cfgs.data_format,
-                            kernel_initializer=tf.variance_scaling_initializer()
-                            )
-    # bn
-    bn = _bn(conv, is_training)
+                            kernel_initializer=tf.variance_scaling_initializer(),
+                            bias_initializer=bias_initializer,
+                            name=name, _scope=name)
+
+def _bn_layer(name=None):
+    # same layer & variable names as tf.layers.batch_normalization(..., name=name)
+    return tf.layers.BatchNormalization(axis=3 if cfgs.data_format == 'channels_last' else 1,
+                                        name=name, _scope=name)
+
+def _folded_conv(inputs, conv_layer, bn_layer):
+    """
+    inference-only conv_layer followed by bn_layer, as one conv with bn folded into kernel & bias
+    variables are created by the layers themselves, checkpoints are interchangeable with the unfolded path
+    """
+    bn_layer(conv_layer(inputs), training=False)  # create variables only, output unused
+
+    # bn(x) = x*scale + offset, per output channel
+    scale = bn_layer.gamma * tf.rsqrt(bn_layer.moving_variance + bn_layer.epsilon)
+    offset = bn_layer.beta - bn_layer.moving_mean * scale
+    kernel = conv_layer.kernel * scale  # HWIO
+    bias = conv_layer.bias * scale + offset
+
+    strides = conv_layer.strides
+    if cfgs.data_format == 'channels_last':
+        conv = tf.nn.conv2d(inputs, kernel, [1, strides[0], strides[1], 1], 'SAME', data_format='NHWC')
+        return tf.nn.bias_add(conv, bias, data_format='NHWC')
+    conv = tf.nn.conv2d(inputs, kernel, [1, 1, strides[0], strides[1]], 'SAME', data_format='NCHW')
+    return tf.nn.bias_add(conv, bias, data_format='NCHW')
+
+def _folded_conv_bn(inputs, filters, ksize, strides):
+    return _folded_conv(inputs, _conv_layer(filters, ksize, strides), _bn_layer())
+
+def conv_bn_actibation(inputs, filters, ksize, strides,
+                        activation=tf.nn.relu, is_training=True):
+    if cfgs.fold_bn and not is_training:
+        bn = _folded_conv_bn(inputs, filters, ksize, strides)
+    else:
+        # conv
+        conv = tf.layers.conv2d(inputs, filters, ksize, strides,
+                                padding='same',
+                                data_format=cfgs.data_format,
+                                kernel_initializer=tf.variance_scaling_initializer()
+                                )
+        # bn
+        bn = _bn(conv, is_training)
     # activation
     if activation is not None:
         bn = activation(bn)
@@ -30,9 +90,11 @@ def conv_bn_actibation(inputs, filters, ksize, strides,
     return bn
 
 def bn_activation_conv(inputs, filters, ksize, strides,
-                        activation=tf.nn.relu, pi_init=False, is_training=True):
+                        activation=tf.nn.relu, pi_init=False, is_training=True,
+                        name=None, bn_name=None):
+    # names given: layers can be reused under a reusing variable scope
     # bn
-    bn = _bn(inputs, is_training)
+    bn = _bn(inputs, is_training, name=bn_name)
     # activation
     if activation is not None:
         bn = activation(bn)
@@ -41,14 +103,16 @@ def bn_activation_conv(inputs, filters, ksize, strides,
         conv = tf.layers.conv2d(bn, filters, ksize, strides,
                                 padding='same',
                                 data_format=cfgs.data_format,
-                                kernel_initializer=tf.variance_scaling_initializer()
+                                kernel_initializer=tf.variance_scaling_initializer(),
+                                name=name
                                 )
     else:
         conv = tf.layers.conv2d(bn, filters, ksize, strides,
                                 padding='same',
                                 data_format=cfgs.data_format,
                                 kernel_initializer=tf.variance_scaling_initializer(),
-                                bias_initializer=tf.constant_initializer(-math.log((1 - cfgs.pi) / cfgs.pi))
+                                bias_initializer=tf.constant_initializer(-math.log((1 - cfgs.pi) / cfgs.pi)),
+                                name=name
                                 )
         # kernel initializer:
         # tf.truncated_normal_initializer(stddev=0.01)
@@ -82,3 +146,29 @@ def dropout(bottom, prob, is_training, name):
         training=is_training,
         name=name
     )
+
+def bn_activation_conv_chain(inputs, blocks, is_training=True, names=None, bn_names=None):
+    """
+    bn_activation_conv blocks applied in sequence
+    :param blocks: list of (filters, ksize, strides, pi_init)
+    :param names, bn_names: per block conv & bn layer names, default auto-named
+    with cfgs.fold_bn in test mode, the bn of every block after the first is folded into the conv before it:
+    that conv's output has no other consumer. the first bn stays, its input is usually shared
+    """
+    names = names or [None] * len(blocks)
+    bn_names = bn_names or [None] * len(blocks)
+    if not cfgs.fold_bn or is_training:
+        for (filters, ksize, strides, pi_init), name, bn_name in zip(blocks, names, bn_names):
+            inputs = bn_activation_conv(inputs, filters, ksize, strides, pi_init=pi_init,
+                                        is_training=is_training, name=name, bn_name=bn_name)
+        return inputs
+
+    # layers are called in the unfolded order, so they get the unfolded variable names
+    conv = tf.nn.relu(_bn(inputs, is_training, name=bn_names[0]))
+    for i, (filters, ksize, strides, pi_init) in enumerate(blocks):
+        conv_layer = _conv_layer(filters, ksize, strides, pi_init, name=names[i])
+        if i + 1 < len(blocks):
+            conv = tf.nn.relu(_folded_conv(conv, conv_layer, _bn_layer(bn_names[i + 1])))
+        else:
+            conv = conv_layer(conv)
+    return conv
@@ -4,7 +4,6 @@ from __future__ import absolute_import, print_function, division
 
 import numpy as np
 
-from PIL import Image, ImageDraw, ImageFont
 import cv2
 
 # from libs.configs import cfgs
@@ -27,89 +26,135 @@ LABEL_NAME_MAP = {
     11:'Car_sales_invoice',
     12:'Others',
 }
-STANDARD_COLORS = [
-    'AliceBlue', 'Chartreuse', 'Aqua', 'Aquamarine', 'Azure', 'Beige', 'Bisque',
-    'BlanchedAlmond', 'BlueViolet', 'BurlyWood', 'CadetBlue', 'AntiqueWhite',
-    'Chocolate', 'Coral', 'CornflowerBlue', 'Cornsilk', 'Crimson', 'Cyan',
-    'DarkCyan', 'DarkGoldenRod', 'DarkGrey', 'DarkKhaki', 'DarkOrange',
-    'DarkOrchid', 'DarkSalmon', 'DarkSeaGreen', 'DarkTurquoise', 'DarkViolet',
-    'DeepPink', 'DeepSkyBlue', 'DodgerBlue', 'FireBrick', 'FloralWhite',
-    'ForestGreen', 'Fuchsia', 'Gainsboro', 'GhostWhite', 'Gold', 'GoldenRod',
-    'Salmon', 'Tan', 'HoneyDew', 'HotPink', 'IndianRed', 'Ivory', 'Khaki',
-    'Lavender', 'LavenderBlush', 'LawnGreen', 'LemonChiffon', 'LightBlue',
-    'LightCoral', 'LightCyan', 'LightGoldenRodYellow', 'LightGray', 'LightGrey',
-    'LightGreen', 'LightPink', 'LightSalmon', 'LightSeaGreen', 'LightSkyBlue',
-    'LightSlateGray', 'LightSlateGrey', 'LightSteelBlue', 'LightYellow', 'Lime',
-    'LimeGreen', 'Linen', 'Magenta', 'MediumAquaMarine', 'MediumOrchid',
-    'MediumPurple', 'MediumSeaGreen', 'MediumSlateBlue', 'MediumSpringGreen',
-    'MediumTurquoise', 'MediumVioletRed', 'MintCream', 'MistyRose', 'Moccasin',
-    'NavajoWhite', 'OldLace', 'Olive', 'OliveDrab', 'Orange', 'OrangeRed',
-    'Orchid', 'PaleGoldenRod', 'PaleGreen', 'PaleTurquoise', 'PaleVioletRed',
-    'PapayaWhip', 'PeachPuff', 'Peru', 'Pink', 'Plum', 'PowderBlue', 'Purple',
-    'Red', 'RosyBrown', 'RoyalBlue', 'SaddleBrown', 'Green', 'SandyBrown',
-    'SeaGreen', 'SeaShell', 'Sienna', 'Silver', 'SkyBlue', 'SlateBlue',
-    'SlateGray', 'SlateGrey', 'Snow', 'SpringGreen', 'SteelBlue', 'GreenYellow',
-    'Teal', 'Thistle', 'Tomato', 'Turquoise', 'Violet', 'Wheat', 'White',
-    'WhiteSmoke', 'Yellow', 'YellowGreen', 'LightBlue', 'LightGreen'
-]
-FONT = ImageFont.load_default()
-
-
-def draw_a_rectangel_in_img(draw_obj, box, color, width):
-    '''
-    use draw lines to draw rectangle. since the draw_rectangle func can not modify the width of rectangle
-    :param draw_obj:
-    :param box: [x1, y1, x2, y2]
-    :return:
-    '''
-    # x1, y1, x2, y2 = box[0], box[1], box[2], box[3]
-    # x1, y1, x2, y2 = box[2], box[0], box[3], box[1]
-    x1 = int(box[1] - box[3]/2)
-    y1 = int(box[0] - box[2]/2)
-    x2 = int(box[1] + box[3]/2)
-    y2 = int(box[0] + box[2]/2)
-    top_left, top_right = (x1, y1), (x2, y1)
-    bottom_left, bottom_right = (x1, y2), (x2, y2)
-
-    draw_obj.line(xy=[top_left, top_right],
-                  fill=color,
-                  width=width)
-    draw_obj.line(xy=[top_left, bottom_left],
-                  fill=color,
-                  width=width)
-    draw_obj.line(xy=[bottom_left, bottom_right],
-                  fill=color,
-                  width=width)
-    draw_obj.line(xy=[top_right, bottom_right],
-                  fill=color,
-                  width=width)
-
-
-def only_draw_scores(draw_obj, box, score, color):
-
-    # x, y = box[0], box[1]
-    # x, y = box[2], box[0]
-    x, y = int(box[1] - box[3]/2), int(box[0] - box[2]/2)
-    draw_obj.rectangle(xy=[x, y, x+60, y+10],
-                       fill=color)
-    draw_obj.text(xy=(x, y),
-                  text="obj:" +str(round(score, 2)),
-                  fill='black',
-                  font=FONT)
-
-
-def draw_label_with_scores(draw_obj, box, label, score, color):
-    txt = LABEL_NAME_MAP[label] + ':' + str(round(score, 2))
-
-    # x, y = box[0], box[1]
-    # x, y = box[2], box[0]
-    x, y = int(box[1] - box[3]/2), int(box[0] - box[2]/2)
-    draw_obj.rectangle(xy=[x, y, x + 6*len(txt), y + 10],
-                       fill=color)
-    draw_obj.text(xy=(x, y),
-                  text=txt,
-                  fill='black',
-                  font=FONT)
+# drawing style, colors are RGB
+LINE_WIDTH = 3
+TEXT_HEIGHT = 10
+BOX_COLOR = (255, 0, 0)  # red
+LABEL_COLOR = (128, 0, 128)  # purple
+TEXT_COLOR = (0, 0, 0)  # black
+ALPHA = 0.7  # opacity of drawings
+FONT_FACE = cv2.FONT_HERSHEY_SIMPLEX
+FONT_SCALE = 0.3
+
+# character -> bool bitmap of TEXT_HEIGHT rows, rendered once
+_glyphs = {}
+
+
+def _glyph(ch):
+    if ch not in _glyphs:
+        (w, _), _ = cv2.getTextSize(ch, FONT_FACE, FONT_SCALE, 1)
+        canvas = np.zeros([TEXT_HEIGHT, max(w, 1)], np.uint8)
+        cv2.putText(canvas, ch, (0, TEXT_HEIGHT - 2), FONT_FACE, FONT_SCALE, 255, 1)
+        _glyphs[ch] = canvas > 127
+    return _glyphs[ch]
+
+
+def _text_bitmap(txt):
+    return np.hstack([_glyph(ch) for ch in txt])
+
+
+def _rect_coverage(shape, n, y1, x1, y2, x2, weights):
+    """
+    sum of weights of the rectangles [y1, y2) x [x1, x2) of image n covering each pixel, all rectangles at once
+    corners go into a difference array, two cumsums integrate it
+    """
+    num, h, w = shape
+    y1, y2 = np.clip(y1, 0, h), np.clip(y2, 0, h)
+    x1, x2 = np.clip(x1, 0, w), np.clip(x2, 0, w)
+    y2, x2 = np.maximum(y2, y1), np.maximum(x2, x1)
+
+    diff = np.zeros([num, h + 1, w + 1], np.int32)
+    np.add.at(diff, (n, y1, x1), weights)
+    np.add.at(diff, (n, y1, x2), -weights)
+    np.add.at(diff, (n, y2, x1), -weights)
+    np.add.at(diff, (n, y2, x2), weights)
+    return np.cumsum(np.cumsum(diff, axis=1), axis=2)[:, :h, :w]
+
+
+def draw_boxes_batch(images, boxes, labels, scores, num_detections=None, bgr=False):
+    """
+    draw boxes, labels & scores into a batch of uint8 images in one pass, no copy
+    e.g. the padded outputs of RetinaNet.test_one_batch
+    :param images: NxHxWx3 uint8, modified in place
+    :param boxes: NxKx4 [y, x, h, w]
+    :param labels: NxK, ONLY_DRAW_BOXES entries (and padding) are skipped,
+                   ONLY_DRAW_BOXES_WITH_SCORES draws the score without box
+    :param scores: NxK
+    :param num_detections: N, or None for all K
+    :param bgr: images channels are BGR (cv2), else RGB
+    :return: images
+    """
+    num, h, w = images.shape[0], images.shape[1], images.shape[2]
+    boxes, scores = np.asarray(boxes), np.asarray(scores)
+    labels = np.asarray(labels).astype(np.int32)
+    keep = labels != ONLY_DRAW_BOXES
+    if num_detections is not None:
+        keep &= np.arange(labels.shape[1]) < np.asarray(num_detections).reshape([-1, 1])
+    # detections of all images flattened, n is the image of each
+    n = np.nonzero(keep)[0]
+    boxes, labels, scores = boxes[keep], labels[keep], scores[keep]
+    if boxes.shape[0] == 0:
+        return images
+
+    y1 = (boxes[:, 0] - boxes[:, 2]/2).astype(np.int64)
+    x1 = (boxes[:, 1] - boxes[:, 3]/2).astype(np.int64)
+    y2 = (boxes[:, 0] + boxes[:, 2]/2).astype(np.int64)
+    x2 = (boxes[:, 1] + boxes[:, 3]/2).astype(np.int64)
+
+    # 0: untouched, 1: box line, 2: label background, 3: text; later layers on top
+    layer = np.zeros([num, h, w], np.uint8)
+
+    # outlines: outer rectangle minus inner rectangle, of boxes with a category
+    with_box = labels != ONLY_DRAW_BOXES_WITH_SCORES
+    if np.any(with_box):
+        half = LINE_WIDTH // 2
+        bn, by1, bx1, by2, bx2 = n[with_box], y1[with_box], x1[with_box], y2[with_box], x2[with_box]
+        ones = np.ones_like(by1, np.int32)
+        coverage = _rect_coverage([num, h, w],
+                                  np.concatenate([bn, bn]),
+                                  np.concatenate([by1 - half, by1 + half + 1]),
+                                  np.concatenate([bx1 - half, bx1 + half + 1]),
+                                  np.concatenate([by2 + half + 1, by2 - half]),
+                                  np.concatenate([bx2 + half + 1, bx2 - half]),
+                                  np.concatenate([ones, -ones]))
+        layer[coverage > 0] = 1
+
+    # label backgrounds
+    texts = [('obj' if label == ONLY_DRAW_BOXES_WITH_SCORES else LABEL_NAME_MAP[label]) +
+             ':' + str(round(float(score), 2)) for label, score in zip(labels, scores)]
+    bitmaps = [_text_bitmap(txt) for txt in texts]
+    text_w = np.array([bitmap.shape[1] for bitmap in bitmaps], np.int64)
+    coverage = _rect_coverage([num, h, w], n, y1, x1, y1 + TEXT_HEIGHT, x1 + text_w, np.ones_like(y1, np.int32))
+    layer[coverage > 0] = 2
+
+    # text, cached glyphs pasted as masks, one paste per detection
+    for i, y, x, bitmap in zip(n, y1, x1, bitmaps):
+        top, left = max(y, 0), max(x, 0)
+        bottom, right = min(y + bitmap.shape[0], h), min(x + bitmap.shape[1], w)
+        if bottom <= top or right <= left:
+            continue
+        region = layer[i, top:bottom, left:right]
+        region[bitmap[top - y:bottom - y, left - x:right - x]] = 3
+
+    # blend every drawn pixel of the batch at once
+    colors = np.array([(0, 0, 0), BOX_COLOR, LABEL_COLOR, TEXT_COLOR], np.float32)
+    if bgr:
+        colors = colors[:, ::-1]
+    mask = layer > 0
+    images[mask] = (images[mask] * (1 - ALPHA) + colors[layer[mask]] * ALPHA).astype(np.uint8)
+    return images
+
+
+def draw_boxes_in_place(img, boxes, labels, scores, bgr=False):
+    """
+    draw_boxes_batch on one image
+    :param img: HxWx3 uint8, modified in place
+    :param boxes: Kx4 [y, x, h, w], labels: K, scores: K
+    :return: img
+    """
+    draw_boxes_batch(img[np.newaxis], np.asarray(boxes)[np.newaxis], np.asarray(labels)[np.newaxis],
+                     np.asarray(scores)[np.newaxis], bgr=bgr)
+    return img
 
 
 def draw_boxes_with_label_and_scores(img_array, boxes, labels, scores, in_graph=True):
@@ -119,32 +164,9 @@ def draw_boxes_with_label_and_scores(img_array, boxes, labels, scores, in_graph=
     #     else:
     #         img_array = img_array + np.array(cfgs.PIXEL_MEAN)
     img_array = img_array + [123.68, 116.779, 103.979]
-    img_array.astype(np.float32)
-    boxes = boxes.astype(np.int64)
-    labels = labels.astype(np.int32)
     img_array = np.array(img_array * 255 / np.max(img_array), dtype=np.uint8)
 
-    img_obj = Image.fromarray(img_array)
-    raw_img_obj = img_obj.copy()
-
-    draw_obj = ImageDraw.Draw(img_obj)
-    num_of_objs = 0
-    for box, a_label, a_score in zip(boxes, labels, scores):
-
-        # if a_label != NOT_DRAW_BOXES:  # 0
-        if a_label == ONLY_DRAW_BOXES:  # -1
-            continue
-        elif a_label == ONLY_DRAW_BOXES_WITH_SCORES:  # -2
-            only_draw_scores(draw_obj, box, a_score, color='purple')  # 'White'
-            continue
-        else:
-            num_of_objs += 1
-            draw_a_rectangel_in_img(draw_obj, box, color='red', width=3)#STANDARD_COLORS[a_label]
-            draw_label_with_scores(draw_obj, box, a_label, a_score, color='purple')  # 'White'
-
-    out_img_obj = Image.blend(raw_img_obj, img_obj, alpha=0.7)
-
-    return np.array(out_img_obj)
+    return draw_boxes_in_place(img_array, boxes, labels, scores)
 
 
 # if __name__ == '__main__':
@@ -177,10 +199,3 @@ def draw_boxes_with_label_and_scores(img_array, boxes, labels, scores, in_graph=
 #     cv2.imshow("te3", imm3)
 
 #     cv2.waitKey(0)
-
-
-
-
-
-
-
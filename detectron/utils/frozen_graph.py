@@ -0,0 +1,67 @@
+# coding: utf-8
+
+import tensorflow as tf
+import os
+
+# signature of graphs written by tools/export_graph.py
+INPUT_NAME = 'images'
+OUTPUT_NAMES = {
+    'scores': 'inference/detection_scores',
+    'boxes': 'inference/detection_boxes',
+    'classes': 'inference/detection_classes',
+    'num_detections': 'inference/num_detections',
+}
+# raw head outputs before decode & nms, used by post-training quantization
+HEAD_OUTPUT_NAMES = {
+    'box_encodings': 'inference/box_encodings',
+    'class_logits': 'inference/class_logits',
+}
+FROZEN_GRAPH_NAME = 'retinanet_frozen.pb'
+SIGNATURE_NAME = 'serving_default'
+
+
+def load_graph_def(pb_path):
+    graph_def = tf.GraphDef()
+    with tf.gfile.GFile(pb_path, 'rb') as f:
+        graph_def.ParseFromString(f.read())
+    return graph_def
+
+
+class FrozenDetector():
+    """
+    serve detections from an exported model, the model-building code is not needed
+    path: frozen graph .pb file, or SavedModel directory
+    """
+    def __init__(self, path):
+        self.graph = tf.Graph()
+        self.sess = tf.Session(graph=self.graph)
+
+        with self.graph.as_default():
+            if os.path.isdir(path):
+                # SavedModel, tensors come from the signature
+                meta_graph = tf.saved_model.loader.load(
+                    self.sess, [tf.saved_model.tag_constants.SERVING], path)
+                signature = meta_graph.signature_def[SIGNATURE_NAME]
+                input_name = signature.inputs[INPUT_NAME].name
+                output_names = {k: v.name for k, v in signature.outputs.items()}
+            else:
+                # frozen GraphDef, tensors come from the naming convention
+                tf.import_graph_def(load_graph_def(path), name='')
+                input_name = INPUT_NAME + ':0'
+                output_names = {k: v + ':0' for k, v in OUTPUT_NAMES.items()}
+
+        self.inputs = self.graph.get_tensor_by_name(input_name)
+        self.outputs = [self.graph.get_tensor_by_name(output_names[k])
+                        for k in ['scores', 'boxes', 'classes', 'num_detections']]
+        print('load frozen model from:', path)
+
+    def test_one_batch(self, imgs):
+        """
+        same outputs as RetinaNet.test_one_batch
+        imgs: NxHxWx3 uint8
+        return: scores NxK, boxes NxKx4 (yx, hw), labels NxK, num_detections N
+        """
+        return self.sess.run(self.outputs, feed_dict={self.inputs: imgs})
+
+    def close(self):
+        self.sess.close()
@@ -0,0 +1,148 @@
+# coding: utf-8
+
+import tensorflow as tf
+from tensorflow.python.client import timeline
+import numpy as np
+import os, re, json, time
+from collections import defaultdict
+
+# op name prefixes reported separately, anything else is 'other'
+SCOPES = ['feature_pyramid', 'subnets', 'inference']
+# every replica's iterator: IteratorGetNext, IteratorGetNext_1, ...
+INPUT_OPS = re.compile(r'IteratorGetNext(_\d+)?$')
+
+
+def op_scope(node_name):
+    """
+    feature_pyramid/... -> feature_pyramid, inference/gradients/subnets/... -> backward/subnets
+    replica towers count with the first one: [inference/gradients/]tower_1/feature_pyramid/... as without tower_1
+    """
+    parts = [part for part in node_name.split(':')[0].split('/') if not re.match(r'tower_\d+$', part)]
+    if 'gradients' in parts:
+        i = parts.index('gradients')
+        scope = parts[i + 1] if i + 1 < len(parts) - 1 else 'other'
+        return 'backward/' + (scope if scope in SCOPES else 'other')
+    if INPUT_OPS.match(parts[-1]):
+        return 'input'
+    return parts[0] if parts[0] in SCOPES else 'other'
+
+
+def peak_memory(run_metadata):
+    """
+    largest allocator usage seen by any node of the step, in bytes
+    """
+    peak = 0
+    for dev_stats in run_metadata.step_stats.dev_stats:
+        for node_stats in dev_stats.node_stats:
+            for mem in node_stats.memory:
+                peak = max(peak, mem.peak_bytes, mem.allocator_bytes_in_use)
+    return peak
+
+
+def analyze_step_stats(step_stats):
+    """
+    :return: {scope: {'time': op seconds, 'memory': output bytes}}, input wait seconds
+    """
+    scopes = defaultdict(lambda: {'time': 0., 'memory': 0})
+    input_wait = 0.
+    for dev_stats in step_stats.dev_stats:
+        for node_stats in dev_stats.node_stats:
+            scope = op_scope(node_stats.node_name)
+            seconds = node_stats.op_end_rel_micros / 1e6
+            scopes[scope]['time'] += seconds
+            scopes[scope]['memory'] += sum(output.tensor_description.allocation_description.requested_bytes
+                                           for output in node_stats.output)
+            if scope == 'input':
+                input_wait = max(input_wait, node_stats.all_end_rel_micros / 1e6)
+    return dict(scopes), input_wait
+
+
+class StepProfiler():
+    """
+    opt-in training profiler, a step is one optimizer update of batch_size images
+    every step: wall time & images/sec
+    every `interval` steps: full RunMetadata trace -> chrome timeline file, per-scope op time & memory,
+    input-pipeline wait vs compute
+    """
+    def __init__(self, profile_path, interval, batch_size):
+        self.profile_path = profile_path
+        self.interval = interval
+        self.batch_size = batch_size
+        if not tf.gfile.Exists(profile_path):
+            tf.gfile.MakeDirs(profile_path)
+
+        self.step_times = []
+        self.traces = []
+        self.last_steps, self.last_time = 0, time.time()
+
+    def run_options(self, global_step):
+        """
+        return: options & run_metadata for sess.run, both None on untraced steps
+        """
+        if global_step % self.interval != 0:
+            return None, None
+        return tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE), tf.RunMetadata()
+
+    def add_step(self, global_step, step_time, run_metadata=None, trace_time=None):
+        """
+        :param step_time: seconds of the whole update, all accumulation_steps batches
+        :param trace_time: seconds of the traced sess.run alone, default step_time
+        """
+        self.step_times.append(step_time)
+        if run_metadata is None:
+            return
+
+        # input wait & scope times come from the traced run only, compute is measured against it
+        trace_time = step_time if trace_time is None else trace_time
+        scopes, input_wait = analyze_step_stats(run_metadata.step_stats)
+        self.traces.append({'step': global_step,
+                            'step_time': trace_time,
+                            'input_wait': input_wait,
+                            'compute': trace_time - input_wait,
+                            'scopes': scopes})
+
+        trace = timeline.Timeline(run_metadata.step_stats)
+        with open(os.path.join(self.profile_path, 'timeline_{:d}.json'.format(global_step)), 'w') as f:
+            f.write(trace.generate_chrome_trace_format(show_memory=True))
+
+    def images_per_sec(self):
+        """
+        throughput since the previous call
+        """
+        now = time.time()
+        steps = len(self.step_times) - self.last_steps
+        images_per_sec = steps * self.batch_size / max(now - self.last_time, 1e-8)
+        self.last_steps, self.last_time = len(self.step_times), now
+        return images_per_sec
+
+    def report(self):
+        """
+        print & write profile_path/report.json, averages over traced runs
+        """
+        summary = {'num_steps': len(self.step_times),
+                   'mean_step_time': float(np.mean(self.step_times)) if self.step_times else 0.,
+                   'num_traced_steps': len(self.traces)}
+        if self.traces:
+            summary['mean_input_wait'] = float(np.mean([t['input_wait'] for t in self.traces]))
+            summary['mean_compute'] = float(np.mean([t['compute'] for t in self.traces]))
+            scope_names = sorted(set(name for t in self.traces for name in t['scopes']))
+            summary['scopes'] = {name: {k: float(np.mean([t['scopes'].get(name, {k: 0})[k] for t in self.traces]))
+                                        for k in ['time', 'memory']}
+                                 for name in scope_names}
+        summary['mean_images_per_sec'] = self.batch_size / summary['mean_step_time'] if self.step_times else 0.
+
+        with open(os.path.join(self.profile_path, 'report.json'), 'w') as f:
+            json.dump({'summary': summary, 'traces': self.traces}, f, indent=2)
+
+        print('-' * 25, 'profile', '-' * 25)
+        print('steps: {:d}, mean step: {:.4f}s, {:.2f} images/sec'.format(
+            summary['num_steps'], summary['mean_step_time'], summary['mean_images_per_sec']))
+        if self.traces:
+            print('traced steps: {:d}, input wait: {:.4f}s, compute: {:.4f}s'.format(
+                summary['num_traced_steps'], summary['mean_input_wait'], summary['mean_compute']))
+            total = sum(v['time'] for v in summary['scopes'].values())
+            for name, v in sorted(summary['scopes'].items(), key=lambda x: -x[1]['time']):
+                print('  {:<28s} op time {:.4f}s ({:5.1f}%), outputs {:.1f}MB'.format(
+                    name, v['time'], 100. * v['time'] / max(total, 1e-8), v['memory'] / 2.**20))
+        print('report & timelines in:', self.profile_path)
+        return summary
@@ -0,0 +1,195 @@
+# coding: utf-8
+
+import tensorflow as tf
+import numpy as np
+import cv2
+from configs import cfgs
+from detectron.utils import anchors
+from detectron.utils import frozen_graph
+
+
+def representative_dataset(image_paths, input_shape):
+    """
+    calibration images for post-training quantization, same preprocessing as test_net
+    :param image_paths: list of image files
+    :param input_shape: [h, w]
+    :return: generator function for TFLiteConverter.representative_dataset
+    """
+    def gen():
+        for path in image_paths:
+            img = cv2.imread(path)
+            img = cv2.resize(img, (input_shape[1], input_shape[0]), interpolation=cv2.INTER_LINEAR)
+            yield [np.expand_dims(img, 0).astype(np.uint8)]
+    return gen
+
+
+def quantize_frozen_graph(pb_path, input_shape, calibration_paths):
+    """
+    post-training quantization of backbone and heads (everything before decode & nms)
+    weights are int8, activation ranges are calibrated on calibration_paths,
+    ops without an int8 kernel stay in float
+    :param pb_path: frozen graph written by tools/export_graph.py
+    :param input_shape: [h, w]
+    :param calibration_paths: list of image files
+    :return: tflite model, bytes
+    """
+    converter = tf.lite.TFLiteConverter.from_frozen_graph(
+        pb_path,
+        input_arrays=[frozen_graph.INPUT_NAME],
+        output_arrays=[frozen_graph.HEAD_OUTPUT_NAMES['box_encodings'],
+                       frozen_graph.HEAD_OUTPUT_NAMES['class_logits']],
+        input_shapes={frozen_graph.INPUT_NAME: [1, input_shape[0], input_shape[1], 3]})
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = representative_dataset(calibration_paths, input_shape)
+    return converter.convert()
+
+
+def py_cpu_nms(boxes, scores, max_boxes, iou_threshold):
+    """
+    greedy nms, boxes: Nx4 [y1, x1, y2, x2], scores: N
+    return: kept indices, by descending score
+    """
+    y1, x1, y2, x2 = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+    areas = (y2 - y1) * (x2 - x1)
+    order = np.argsort(-scores)
+
+    keep = []
+    while order.size > 0 and len(keep) < max_boxes:
+        i = order[0]
+        keep.append(i)
+        iy1 = np.maximum(y1[i], y1[order[1:]])
+        ix1 = np.maximum(x1[i], x1[order[1:]])
+        iy2 = np.minimum(y2[i], y2[order[1:]])
+        ix2 = np.minimum(x2[i], x2[order[1:]])
+        inter = np.maximum(iy2 - iy1, 0.) * np.maximum(ix2 - ix1, 0.)
+        iou = inter / (areas[i] + areas[order[1:]] - inter)
+        order = order[1:][iou <= iou_threshold]
+    return np.asarray(keep, np.int64)
+
+
+def postprocess_numpy(box_encodings, class_logits, input_shape):
+    """
+    numpy version of RetinaNet._postprocess_one_image, for one image
+    box_encodings: Ax4 (yx, hw deltas), class_logits: Axclass
+    return: scores K, boxes Kx4 (yx, hw), class_id K, num_detections, padded like RetinaNet
+    """
+    input_h, input_w = input_shape
+    num_fg = cfgs.num_classes - 1
+
+    confidence = []
+    dpbbox_y1x1y2x2 = []
+    start = 0
+    for _, _, abbox_yx, abbox_hw in anchors.get_anchors(tuple(input_shape)):
+        end = start + abbox_yx.shape[0]
+        logits = class_logits[start:end]
+        pbbox_yx = box_encodings[start:end, :2]
+        pbbox_hw = box_encodings[start:end, 2:]
+        start = end
+
+        # softmax, drop anchors predicted as background
+        conf = np.exp(logits - np.max(logits, axis=-1, keepdims=True))
+        conf /= np.sum(conf, axis=-1, keepdims=True)
+        conf_mask = np.argmax(conf, axis=-1) < num_fg
+        conf = conf[:, :num_fg] * conf_mask[:, np.newaxis]
+
+        # keep top-k candidates of this level
+        if cfgs.pre_nms_top_k is not None and conf.shape[0] > cfgs.pre_nms_top_k:
+            top_k = np.argpartition(-np.max(conf, axis=-1), cfgs.pre_nms_top_k)[:cfgs.pre_nms_top_k]
+            conf, pbbox_yx, pbbox_hw = conf[top_k], pbbox_yx[top_k], pbbox_hw[top_k]
+            abbox_yx, abbox_hw = abbox_yx[top_k], abbox_hw[top_k]
+
+        # decode
+        dpbbox_yx = pbbox_yx * abbox_hw + abbox_yx
+        dpbbox_hw = np.exp(pbbox_hw) * abbox_hw
+        confidence.append(conf)
+        dpbbox_y1x1y2x2.append(np.concatenate([dpbbox_yx - dpbbox_hw / 2., dpbbox_yx + dpbbox_hw / 2.], axis=-1))
+
+    confidence = np.concatenate(confidence, axis=0)
+    dpbbox_y1x1y2x2 = np.concatenate(dpbbox_y1x1y2x2, axis=0)
+
+    # nms per class
+    scores, bbox, class_id = [], [], []
+    for i in range(num_fg):
+        mask = confidence[:, i] >= cfgs.nms_score_threshold
+        scoresi = confidence[mask, i]
+        bboxi = dpbbox_y1x1y2x2[mask]
+        keep = py_cpu_nms(bboxi, scoresi, cfgs.nms_max_boxes, cfgs.nms_iou_threshold)
+        scores.append(scoresi[keep])
+        bbox.append(bboxi[keep])
+        class_id.append(np.ones_like(keep, np.int32) * i)
+    scores = np.concatenate(scores).astype(np.float32)
+    bbox = np.concatenate(bbox).reshape([-1, 4]).astype(np.float32)
+    class_id = np.concatenate(class_id).astype(np.int32)
+
+    # clip, to yx, hw
+    bbox_y1x1 = np.clip(bbox[:, :2], 0., [input_h, input_w])
+    bbox_y2x2 = np.clip(bbox[:, 2:], 0., [input_h, input_w])
+    bbox = np.concatenate([(bbox_y1x1 + bbox_y2x2) / 2., bbox_y2x2 - bbox_y1x1], axis=-1)
+
+    # pad
+    max_detections = num_fg * cfgs.nms_max_boxes
+    num_detections = scores.shape[0]
+    num_pad = max_detections - num_detections
+    scores = np.pad(scores, [0, num_pad])
+    bbox = np.pad(bbox, [[0, num_pad], [0, 0]])
+    class_id = np.pad(class_id, [0, num_pad], constant_values=-1)
+    return scores, bbox, class_id, num_detections
+
+
+class FrozenHeadDetector():
+    """
+    float baseline for TFLiteDetector: the frozen graph up to the head outputs, decode & nms in numpy
+    both models share postprocess_numpy, so their difference is the quantization only
+    """
+    def __init__(self, pb_path):
+        self.graph = tf.Graph()
+        self.sess = tf.Session(graph=self.graph)
+        with self.graph.as_default():
+            tf.import_graph_def(frozen_graph.load_graph_def(pb_path), name='')
+        self.inputs = self.graph.get_tensor_by_name(frozen_graph.INPUT_NAME + ':0')
+        self.outputs = [self.graph.get_tensor_by_name(frozen_graph.HEAD_OUTPUT_NAMES[k] + ':0')
+                        for k in ['box_encodings', 'class_logits']]
+        print('load frozen model from:', pb_path)
+
+    def test_one_batch(self, imgs):
+        """
+        same outputs as RetinaNet.test_one_batch
+        """
+        box_encodings, class_logits = self.sess.run(self.outputs, feed_dict={self.inputs: imgs})
+        results = [postprocess_numpy(box_encodings[i], class_logits[i], imgs.shape[1:3])
+                   for i in range(imgs.shape[0])]
+        return [np.stack(x) for x in zip(*results)]
+
+    def close(self):
+        self.sess.close()
+
+
+class TFLiteDetector():
+    """
+    serve detections from a quantized tflite model, decode & nms run in numpy
+    """
+    def __init__(self, model_path, num_threads=None):
+        self.interpreter = tf.lite.Interpreter(model_path=model_path)
+        if num_threads is not None and hasattr(self.interpreter, 'set_num_threads'):
+            self.interpreter.set_num_threads(num_threads)
+        self.interpreter.allocate_tensors()
+
+        self.input_index = self.interpreter.get_input_details()[0]['index']
+        self.input_shape = self.interpreter.get_input_details()[0]['shape'][1:3]
+        outputs = {d['name']: d['index'] for d in self.interpreter.get_output_details()}
+        self.box_index = outputs[frozen_graph.HEAD_OUTPUT_NAMES['box_encodings']]
+        self.class_index = outputs[frozen_graph.HEAD_OUTPUT_NAMES['class_logits']]
+        print('load tflite model from:', model_path)
+
+    def test_one_batch(self, imgs):
+        """
+        same outputs as RetinaNet.test_one_batch, images run one at a time
+        """
+        results = []
+        for img in imgs:
+            self.interpreter.set_tensor(self.input_index, np.expand_dims(img, 0))
+            self.interpreter.invoke()
+            box_encodings = self.interpreter.get_tensor(self.box_index)[0]
+            class_logits = self.interpreter.get_tensor(self.class_index)[0]
+            results.append(postprocess_numpy(box_encodings, class_logits, self.input_shape))
+        return [np.stack(x) for x in zip(*results)]
@@ -0,0 +1,76 @@
+# coding: utf-8
+
+import tensorflow as tf
+from configs import cfgs
+from detectron.utils import box_ops
+
+# anchors between the thresholds are ignored by the loss
+POS_IOU_THRESHOLD = 0.5
+NEG_IOU_THRESHOLD = 0.4
+IGNORE_LABEL = -1
+
+
+def _batch_gather(params, indices):
+    """
+    params: BxGx..., indices: BxA -> BxAx...
+    """
+    batch_size = tf.shape(indices)[0]
+    num_indices = tf.shape(indices)[1]
+    batch_indices = tf.tile(tf.expand_dims(tf.range(batch_size, dtype=indices.dtype), 1), [1, num_indices])
+    return tf.gather_nd(params, tf.stack([batch_indices, indices], axis=-1))
+
+
+def assign_targets(ground_truth, abbox_y1x1, abbox_y2x2, abbox_yx, abbox_hw):
+    """
+    classification and regression targets of every anchor, for a batch of images
+    each gt gets its best anchor, other anchors are positive with iou > 0.5,
+    negative with iou < 0.4, ignored otherwise
+    ground_truth: BxGx5, (ycenter, xcenter, h, w, class_id), padding rows are -1
+    abbox_*: Ax2
+    return: labels BxA int32, class_id for positive, num_classes-1 (background) for negative,
+            IGNORE_LABEL for ignored anchors
+            reg_targets BxAx4 (yx, hw) deltas, zeros for non-positive anchors
+    """
+    gbbox_yx = ground_truth[..., 0:2]
+    gbbox_hw = ground_truth[..., 2:4]
+    class_id = tf.cast(ground_truth[..., 4], tf.int32)
+    gt_mask = tf.cast(ground_truth[..., 4] >= 0., tf.float32)  # BxG, padding rows are 0
+    gbbox_y1x1 = gbbox_yx - gbbox_hw / 2.
+    gbbox_y2x2 = gbbox_yx + gbbox_hw / 2.
+
+    # BxGxA, iou of padding rows is -1 so they never match
+    gaIoU = box_ops.pairwise_iou(gbbox_y1x1, gbbox_y2x2, abbox_y1x1, abbox_y2x2)
+    gaIoU = gaIoU * tf.expand_dims(gt_mask, -1) - (1. - tf.expand_dims(gt_mask, -1))
+    num_anchors = tf.shape(abbox_yx)[0]
+
+    # best gt of each anchor
+    best_gt = tf.argmax(gaIoU, axis=1, output_type=tf.int32)  # BxA
+    best_gt_iou = tf.reduce_max(gaIoU, axis=1)  # BxA
+
+    # best anchor of each valid gt, forced positive
+    best_anchor = tf.argmax(gaIoU, axis=2, output_type=tf.int32)  # BxG
+    best_onehot = tf.one_hot(best_anchor, num_anchors) * tf.expand_dims(gt_mask, -1)  # BxGxA
+    is_best = tf.reduce_max(best_onehot, axis=1) > 0.  # BxA
+    best_owner = tf.argmax(best_onehot, axis=1, output_type=tf.int32)  # BxA
+    assigned_gt = tf.where(is_best, best_owner, best_gt)
+
+    pos_mask = tf.logical_or(is_best, best_gt_iou > POS_IOU_THRESHOLD)
+    neg_mask = tf.logical_and(tf.logical_not(is_best), best_gt_iou < NEG_IOU_THRESHOLD)
+
+    # labels
+    assigned_class_id = _batch_gather(class_id, assigned_gt)
+    labels = tf.where(pos_mask, assigned_class_id,
+                      tf.where(neg_mask,
+                               tf.ones_like(assigned_class_id) * (cfgs.num_classes - 1),
+                               tf.ones_like(assigned_class_id) * IGNORE_LABEL))
+
+    # regression targets, padding rows have hw -1, keep log finite
+    assigned_yx = _batch_gather(gbbox_yx, assigned_gt)
+    assigned_hw = tf.maximum(_batch_gather(gbbox_hw, assigned_gt), 1e-8)
+    truth_pbbox_yx = (assigned_yx - abbox_yx) / abbox_hw
+    truth_pbbox_hw = tf.log(assigned_hw / abbox_hw)
+    reg_targets = tf.concat([truth_pbbox_yx, truth_pbbox_hw], axis=-1)
+    reg_targets = tf.where(tf.tile(tf.expand_dims(pos_mask, -1), [1, 1, 4]),
+                           reg_targets, tf.zeros_like(reg_targets))
+
+    return tf.stop_gradient(labels), tf.stop_gradient(reg_targets)
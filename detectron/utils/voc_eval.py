@@ -9,7 +9,11 @@ from __future__ import print_function
 
 import xml.etree.ElementTree as ET
 import os
+import time
+import json
 import pickle
+import hashlib
+import multiprocessing
 import numpy as np
 
 NAME_LABEL_MAP = {
@@ -86,6 +90,100 @@ def parse_rec(filename):
     return objects
 
 
+def _annotation_cache_path(annopath):
+    key = hashlib.md5(os.path.abspath(annopath).encode('utf-8')).hexdigest()[:12]
+    return os.path.join(cfgs.eval_save_path, 'annotations_{}.npz'.format(key))
+
+
+def _read_annotation_cache(cache_path):
+    """
+    return: {imagename: (mtime, objects)}
+    """
+    if not os.path.exists(cache_path):
+        return {}
+    try:
+        with np.load(cache_path) as archive:
+            files, mtimes, offsets = archive['files'], archive['mtimes'], archive['offsets']
+            names, poses = archive['name'], archive['pose']
+            truncated, difficult, bbox = archive['truncated'], archive['difficult'], archive['bbox']
+    except (IOError, ValueError, KeyError):
+        print('ignore broken annotation cache:', cache_path)
+        return {}
+
+    entries = {}
+    for i, imagename in enumerate(files):
+        objects = []
+        for j in range(offsets[i], offsets[i + 1]):
+            objects.append({'name': str(names[j]),
+                            'pose': str(poses[j]),
+                            'truncated': int(truncated[j]),
+                            'difficult': int(difficult[j]),
+                            'bbox': [int(x) for x in bbox[j]]})
+        entries[str(imagename)] = (float(mtimes[i]), objects)
+    return entries
+
+
+def _write_annotation_cache(cache_path, entries):
+    files = sorted(entries.keys())
+    objects = [obj for imagename in files for obj in entries[imagename][1]]
+    offsets = np.cumsum([0] + [len(entries[imagename][1]) for imagename in files])
+
+    if not os.path.exists(os.path.dirname(cache_path)):
+        os.makedirs(os.path.dirname(cache_path))
+    tmp_path = cache_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f,
+                 files=np.array(files, np.str_),
+                 mtimes=np.array([entries[imagename][0] for imagename in files], np.float64),
+                 offsets=offsets.astype(np.int64),
+                 name=np.array([obj['name'] for obj in objects], np.str_),
+                 pose=np.array([obj['pose'] for obj in objects], np.str_),
+                 truncated=np.array([obj['truncated'] for obj in objects], np.int32),
+                 difficult=np.array([obj['difficult'] for obj in objects], np.int32),
+                 bbox=np.array([obj['bbox'] for obj in objects], np.int32).reshape([-1, 4]))
+    os.replace(tmp_path, cache_path)
+
+
+_annotation_memo = {}
+
+
+def load_annotations(annopath, imagenames=None, use_cache=None):
+    """
+    parse_rec of many annotations, through a persistent cache
+    the cache is a .npz archive per annotation directory, an xml is parsed again only when its mtime changes
+    :param annopath: annotation directory
+    :param imagenames: image names without extension, None means every xml in annopath
+    :param use_cache: default cfgs.annotation_cache
+    :return: {imagename: objects}
+    """
+    if use_cache is None:
+        use_cache = cfgs.annotation_cache
+    if imagenames is None:
+        imagenames = [item[:-len('.xml')] for item in os.listdir(annopath) if item.endswith('.xml')]
+    if not use_cache:
+        return {imagename: parse_rec(os.path.join(annopath, imagename + '.xml')) for imagename in imagenames}
+
+    cache_path = _annotation_cache_path(annopath)
+    if cache_path not in _annotation_memo:
+        _annotation_memo[cache_path] = _read_annotation_cache(cache_path)
+    entries = _annotation_memo[cache_path]
+
+    recs = {}
+    num_parsed = 0
+    for imagename in imagenames:
+        xmlpath = os.path.join(annopath, imagename + '.xml')
+        mtime = os.path.getmtime(xmlpath)
+        if imagename not in entries or entries[imagename][0] != mtime:
+            entries[imagename] = (mtime, parse_rec(xmlpath))
+            num_parsed += 1
+        recs[imagename] = entries[imagename][1]
+
+    if num_parsed > 0:
+        print('parse {:d} annotations, update cache: {}'.format(num_parsed, cache_path))
+        _write_annotation_cache(cache_path, entries)
+    return recs
+
+
 def voc_ap(rec, prec, use_07_metric=False):
     """ ap = voc_ap(rec, prec, [use_07_metric])
     Compute VOC AP given precision and recall.
@@ -108,8 +206,7 @@ def voc_ap(rec, prec, use_07_metric=False):
         mpre = np.concatenate(([0.], prec, [0.]))
 
         # compute the precision envelope
-        for i in range(mpre.size - 1, 0, -1):
-            mpre[i - 1] = np.maximum(mpre[i - 1], mpre[i])
+        mpre = np.maximum.accumulate(mpre[::-1])[::-1]
 
         # to calculate area under PR curve, look for points
         # where X axis (recall) changes value
@@ -121,7 +218,7 @@ def voc_ap(rec, prec, use_07_metric=False):
 
 
 def voc_eval(detpath, annopath, test_imgid_list, cls_name, ovthresh=0.5,
-             use_07_metric=False, use_diff=False):
+             use_07_metric=False, use_diff=False, recs=None):
     '''
 
     :param detpath:
@@ -131,6 +228,7 @@ def voc_eval(detpath, annopath, test_imgid_list, cls_name, ovthresh=0.5,
     :param ovthresh:
     :param use_07_metric:
     :param use_diff:
+    :param recs: parsed annotations from load_annotations, loaded here if None
     :return:
     '''
     # 1. parse xml to get gtboxes
@@ -138,12 +236,8 @@ def voc_eval(detpath, annopath, test_imgid_list, cls_name, ovthresh=0.5,
     # read list of images
     imagenames = test_imgid_list
 
-    recs = {}
-    for i, imagename in enumerate(imagenames):
-        recs[imagename] = parse_rec(os.path.join(annopath, imagename+'.xml'))
-        # if i % 100 == 0:
-        #   print('Reading annotation for {:d}/{:d}'.format(
-        #     i + 1, len(imagenames)))
+    if recs is None:
+        recs = load_annotations(annopath, imagenames)
 
     # 2. get gtboxes for this class.
     class_recs = {}
@@ -235,39 +329,147 @@ def voc_eval(detpath, annopath, test_imgid_list, cls_name, ovthresh=0.5,
     return rec, prec, ap
 
 
-def do_python_eval(test_imgid_list, test_annotation_path):
-    AP_list = []
+_worker_recs = None
+
+
+def _init_eval_worker(recs):
+    # annotations are sent once per worker, not once per class
+    global _worker_recs
+    _worker_recs = recs
+
+
+def _eval_one_class(args):
+    # the settings come with the task: a spawned worker imports cfgs anew, without the caller's changes
+    cls, test_imgid_list, test_annotation_path, detpath, use_07_metric = args
+    start = time.time()
+    recall, precision, AP = voc_eval(detpath=detpath,
+                                     test_imgid_list=test_imgid_list,
+                                     cls_name=cls,
+                                     annopath=test_annotation_path,
+                                     use_07_metric=use_07_metric,
+                                     recs=_worker_recs)
+    return cls, recall, precision, AP, time.time() - start
+
+
+def save_pr_curves(results, save_dir):
+    """
+    P-R curves as images (all classes & one per class) and raw values, no display needed
+    :param results: {cls: (recall, precision, AP)}
+    """
+    import matplotlib
+    matplotlib.use('Agg')
     import matplotlib.pyplot as plt
-    import matplotlib.colors as colors
-    color_list = list(colors.cnames.keys())[::6]
 
-    for cls, index in NAME_LABEL_MAP.items():
-        if cls == 'back_ground':
-            continue
-        recall, precision, AP = voc_eval(detpath=cfgs.eval_save_path,
-                                         test_imgid_list=test_imgid_list,
-                                         cls_name=cls,
-                                         annopath=test_annotation_path,
-                                         use_07_metric=cfgs.use_07_metric)
+    if not os.path.exists(save_dir):
+        os.makedirs(save_dir)
+
+    fig_all = plt.figure()
+    for cls, (recall, precision, AP) in results.items():
+        fig = plt.figure()
+        for f in [fig, fig_all]:
+            plt.figure(f.number)
+            plt.plot(recall, precision, label='{} ({:.4f})'.format(cls, AP))
+        plt.figure(fig.number)
+        plt.xlabel('recall')
+        plt.ylabel('precision')
+        plt.title('P-R Curve: ' + cls)
+        plt.savefig(os.path.join(save_dir, 'pr_' + cls + '.png'))
+        plt.close(fig)
+
+    plt.figure(fig_all.number)
+    plt.xlabel('recall')
+    plt.ylabel('precision')
+    plt.title('P-R Curve')
+    plt.legend(loc='upper right', fontsize='x-small')
+    plt.savefig(os.path.join(save_dir, 'pr_curve.png'))
+    plt.close(fig_all)
+
+    np.savez(os.path.join(save_dir, 'pr_curves.npz'),
+             **{cls + '_' + k: v for cls, (recall, precision, _) in results.items()
+                for k, v in [('recall', recall), ('precision', precision)]})
+
+
+def do_python_eval(test_imgid_list, test_annotation_path, plot=True, save_dir=None, num_workers=None):
+    """
+    :param plot: show P-R curves in a window
+    :param save_dir: headless mode, P-R curves & summary.json are written here, nothing is shown
+    :param num_workers: processes evaluating classes in parallel, default cfgs.eval_workers
+                        spawned processes: the calling script needs a __main__ guard, and each worker
+                        re-imports it (TensorFlow for test_net.py), only worth it for many classes
+    :return: mAP
+    """
+    start = time.time()
+    if num_workers is None:
+        num_workers = cfgs.eval_workers
+    if save_dir is not None:
+        plot = False
+    if plot:
+        import matplotlib.pyplot as plt
+        import matplotlib.colors as colors
+        color_list = list(colors.cnames.keys())[::6]
+
+    # parse annotations once for all classes
+    recs = load_annotations(test_annotation_path, test_imgid_list)
+    parse_time = time.time() - start
+
+    tasks = [(cls, test_imgid_list, test_annotation_path, cfgs.eval_save_path, cfgs.use_07_metric)
+             for cls, _ in sorted(NAME_LABEL_MAP.items(), key=lambda x: x[1]) if cls != 'back_ground']
+    if num_workers is not None and num_workers > 1:
+        # spawned, not forked: the caller may hold a TF session, forking its threads can deadlock
+        pool = multiprocessing.get_context('spawn').Pool(num_workers, initializer=_init_eval_worker, initargs=(recs,))
+        class_results = pool.map(_eval_one_class, tasks)
+        pool.close()
+        pool.join()
+    else:
+        _init_eval_worker(recs)
+        class_results = [_eval_one_class(task) for task in tasks]
+
+    AP_list = []
+    results = {}
+    summary = {'classes': {}}
+    for cls, recall, precision, AP, cost in class_results:
         AP_list += [AP]
+        results[cls] = (recall, precision, AP)
+        final_recall = float(recall[-1]) if recall.size else 0.
+        final_precision = float(precision[-1]) if precision.size else 0.
+        summary['classes'][cls] = {'AP': float(AP),
+                                   'recall': final_recall,
+                                   'precision': final_precision,
+                                   'num_detections': int(recall.size),
+                                   'time': cost}
 
         # print
         print("Rec: {:.4f},  Pre: {:.4f},  AP: {:.4f},  cls: {}".format(
-            recall[-1], precision[-1], AP, cls))
+            final_recall, final_precision, AP, cls))
 
         # plot
-        plt.plot(recall, precision, label=cls, color=color_list[index])
-        plt.xlabel('recall')
-        plt.ylabel('precision')
-        plt.title('P-R Curve')
-        plt.legend(loc='upper right')
-        
-    plt.show()
+        if plot:
+            plt.plot(recall, precision, label=cls, color=color_list[NAME_LABEL_MAP[cls]])
+            plt.xlabel('recall')
+            plt.ylabel('precision')
+            plt.title('P-R Curve')
+            plt.legend(loc='upper right')
+
+    if plot:
+        plt.show()
     # plt.savefig(cfgs.VERSION+'.jpg')
     print("mAP is : {}".format(np.mean(AP_list)))
 
-
-def voc_evaluate_detections(all_boxes, test_annotation_path, test_imgid_list):
+    if save_dir is not None:
+        save_pr_curves(results, save_dir)
+        summary.update({'mAP': float(np.mean(AP_list)),
+                        'use_07_metric': bool(cfgs.use_07_metric),
+                        'num_images': len(test_imgid_list),
+                        'num_workers': num_workers or 1,
+                        'time': {'parse_annotations': parse_time,
+                                 'total': time.time() - start}})
+        with open(os.path.join(save_dir, 'summary.json'), 'w') as f:
+            json.dump(summary, f, indent=2)
+        print('save P-R curves & summary in:', save_dir)
+    return np.mean(AP_list)
+
+
+def voc_evaluate_detections(all_boxes, test_annotation_path, test_imgid_list, plot=True):
     '''
 
     :param all_boxes: is a list. each item reprensent the detections of a img.
@@ -280,4 +482,133 @@ def voc_evaluate_detections(all_boxes, test_annotation_path, test_imgid_list):
 
     write_voc_results_file(all_boxes, test_imgid_list=test_imgid_list,
                            det_save_dir=cfgs.eval_save_path)
-    do_python_eval(test_imgid_list, test_annotation_path=test_annotation_path)
+    return do_python_eval(test_imgid_list, test_annotation_path=test_annotation_path, plot=plot)
+
+
+class VOCEvaluator():
+    """
+    in-memory evaluation, same metric as voc_eval without the detection files
+    detections are added image by image while testing, matching is vectorized per image
+    """
+    def __init__(self, test_annotation_path, ovthresh=0.5, use_07_metric=None, use_diff=False):
+        self.annopath = test_annotation_path
+        self.ovthresh = ovthresh
+        self.use_07_metric = cfgs.use_07_metric if use_07_metric is None else use_07_metric
+        self.use_diff = use_diff
+        self.recs = None
+
+        self.class_names = [cls for cls, _ in sorted(NAME_LABEL_MAP.items(), key=lambda x: x[1])
+                            if cls != 'back_ground']
+        self.num_pos = np.zeros(len(self.class_names), np.int64)
+        self.scores, self.tp, self.fp, self.labels = [], [], [], []
+        self.results = {}
+
+    def load_ground_truth(self, img_id):
+        """
+        return: boxes Gx4 [xmin, ymin, xmax, ymax], labels G, difficult G
+        """
+        if self.recs is None:
+            # every annotation of the directory at once, one cache update
+            self.recs = load_annotations(self.annopath)
+        objects = [obj for obj in self.recs[img_id]
+                   if obj['name'] in NAME_LABEL_MAP and obj['name'] != 'back_ground']
+        boxes = np.array([obj['bbox'] for obj in objects], np.float64).reshape([-1, 4])
+        labels = np.array([NAME_LABEL_MAP[obj['name']] for obj in objects], np.int64)
+        difficult = np.array([obj['difficult'] for obj in objects], np.bool_)
+        if self.use_diff:
+            difficult[:] = False
+        return boxes, labels, difficult
+
+    @staticmethod
+    def iou_matrix(dets, gts):
+        """
+        pairwise overlaps, pixel-inclusive like voc_eval
+        dets: Nx4, gts: Gx4 [xmin, ymin, xmax, ymax]
+        return: NxG
+        """
+        ixmin = np.maximum(dets[:, np.newaxis, 0], gts[np.newaxis, :, 0])
+        iymin = np.maximum(dets[:, np.newaxis, 1], gts[np.newaxis, :, 1])
+        ixmax = np.minimum(dets[:, np.newaxis, 2], gts[np.newaxis, :, 2])
+        iymax = np.minimum(dets[:, np.newaxis, 3], gts[np.newaxis, :, 3])
+        inters = np.maximum(ixmax - ixmin + 1., 0.) * np.maximum(iymax - iymin + 1., 0.)
+
+        det_areas = (dets[:, 2] - dets[:, 0] + 1.) * (dets[:, 3] - dets[:, 1] + 1.)
+        gt_areas = (gts[:, 2] - gts[:, 0] + 1.) * (gts[:, 3] - gts[:, 1] + 1.)
+        return inters / (det_areas[:, np.newaxis] + gt_areas[np.newaxis, :] - inters)
+
+    def add_image(self, img_id, dets):
+        """
+        match the detections of one image against its ground truth
+        :param img_id: image name without extension
+        :param dets: Nx6 [category, score, xmin, ymin, xmax, ymax]
+        """
+        gt_boxes, gt_labels, gt_difficult = self.load_ground_truth(img_id)
+        np.add.at(self.num_pos, gt_labels[~gt_difficult], 1)
+
+        dets = np.asarray(dets, np.float64).reshape([-1, 6])
+        if dets.shape[0] == 0:
+            return
+        dets = dets[np.argsort(-dets[:, 1], kind='mergesort')]
+        labels = dets[:, 0].astype(np.int64)
+
+        # all classes in one matrix, pairs of different classes never match
+        overlaps = self.iou_matrix(dets[:, 2:], gt_boxes)
+        overlaps[labels[:, np.newaxis] != gt_labels[np.newaxis, :]] = -np.inf
+        if gt_boxes.shape[0] > 0:
+            jmax = np.argmax(overlaps, axis=1)
+            ovmax = overlaps[np.arange(dets.shape[0]), jmax]
+        else:
+            jmax = np.zeros(dets.shape[0], np.int64)
+            ovmax = -np.inf * np.ones(dets.shape[0])
+
+        # like voc_eval: a detection only competes for its best gt, the highest score takes it,
+        # detections matching a difficult gt are ignored
+        matched = ovmax > self.ovthresh
+        difficult = np.zeros(dets.shape[0], np.bool_)
+        difficult[matched] = gt_difficult[jmax[matched]]
+        candidates = np.where(matched & ~difficult)[0]
+        _, first = np.unique(jmax[candidates], return_index=True)
+
+        tp = np.zeros(dets.shape[0])
+        tp[candidates[first]] = 1.
+        fp = 1. - tp
+        fp[difficult] = 0.
+
+        self.scores.append(dets[:, 1])
+        self.tp.append(tp)
+        self.fp.append(fp)
+        self.labels.append(labels)
+
+    def evaluate(self, verbose=True):
+        """
+        AP of every class from the accumulated detections
+        return: mAP, results in self.results[cls] = (rec, prec, ap)
+        """
+        scores = np.concatenate(self.scores) if self.scores else np.zeros([0])
+        tp = np.concatenate(self.tp) if self.tp else np.zeros([0])
+        fp = np.concatenate(self.fp) if self.fp else np.zeros([0])
+        labels = np.concatenate(self.labels) if self.labels else np.zeros([0], np.int64)
+
+        # sort once by class then score, every class is a contiguous slice
+        order = np.lexsort((-scores, labels))
+        tp, fp, labels = tp[order], fp[order], labels[order]
+        bounds = np.searchsorted(labels, np.arange(len(self.class_names) + 1))
+
+        AP_list = []
+        for i, cls in enumerate(self.class_names):
+            cls_id = NAME_LABEL_MAP[cls]
+            cls_tp = np.cumsum(tp[bounds[cls_id]:bounds[cls_id + 1]])
+            cls_fp = np.cumsum(fp[bounds[cls_id]:bounds[cls_id + 1]])
+            rec = cls_tp / float(self.num_pos[cls_id])
+            prec = cls_tp / np.maximum(cls_tp + cls_fp, np.finfo(np.float64).eps)
+            ap = voc_ap(rec, prec, self.use_07_metric)
+            self.results[cls] = (rec, prec, ap)
+            AP_list += [ap]
+
+            if verbose and rec.size > 0:
+                print("Rec: {:.4f},  Pre: {:.4f},  AP: {:.4f},  cls: {}".format(
+                    rec[-1], prec[-1], ap, cls))
+
+        if verbose:
+            print("mAP is : {}".format(np.mean(AP_list)))
+        return np.mean(AP_list)
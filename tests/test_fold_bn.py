@@ -0,0 +1,85 @@
+# coding: utf-8
+import tensorflow as tf
+import numpy as np
+import sys, os, tempfile
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from configs import cfgs
+from detectron.models.retinanet import RetinaNet
+
+
+class FoldBNTest(tf.test.TestCase):
+    """
+    cfgs.fold_bn must keep the checkpoint variable names and the outputs of the unfolded test graph
+    random weights with random BatchNorm statistics, so folding is not the identity
+    """
+    batch_size = 2
+    input_shape = [128, 128]
+
+    @classmethod
+    def setUpClass(cls):
+        cls.saved_fold_bn = cfgs.fold_bn
+        cfgs.fold_bn = False
+        rng = np.random.RandomState(0)
+        with tf.Graph().as_default():
+            retinanet = RetinaNet('test', restore=False)
+            for var in tf.global_variables():
+                shape = var.get_shape().as_list()
+                if var.op.name.endswith(('moving_mean', 'beta')):
+                    var.load(rng.uniform(-0.5, 0.5, shape).astype(np.float32), retinanet.sess)
+                elif var.op.name.endswith(('moving_variance', 'gamma')):
+                    var.load(rng.uniform(0.5, 1.5, shape).astype(np.float32), retinanet.sess)
+            cls.ckpt_path = tf.train.Saver().save(retinanet.sess, os.path.join(tempfile.mkdtemp(), 'random'))
+            retinanet.sess.close()
+
+        if cfgs.data_format == 'channels_last':
+            shape = [cls.batch_size] + cls.input_shape + [3]
+        else:
+            shape = [cls.batch_size, 3] + cls.input_shape
+        cls.imgs = rng.randint(0, 256, shape).astype(np.uint8)
+
+        cls.outputs = {fold_bn: cls._run(fold_bn) for fold_bn in [False, True]}
+
+    @classmethod
+    def tearDownClass(cls):
+        cfgs.fold_bn = cls.saved_fold_bn
+
+    @classmethod
+    def _run(cls, fold_bn):
+        """
+        return: variable names, head outputs (box_encodings, class_logits), detections
+        """
+        cfgs.fold_bn = fold_bn
+        with tf.Graph().as_default() as graph:
+            retinanet = RetinaNet('test', restore=False)
+            retinanet.load_weight(cls.ckpt_path)
+            names = sorted(var.op.name for var in tf.global_variables())
+            heads = retinanet.sess.run([graph.get_tensor_by_name('inference/box_encodings:0'),
+                                        graph.get_tensor_by_name('inference/class_logits:0')],
+                                       feed_dict={retinanet.inputs: cls.imgs})
+            detections = retinanet.test_one_batch(cls.imgs)
+            retinanet.sess.close()
+        return names, heads, detections
+
+    def test_variable_names(self):
+        ckpt_names = sorted(name for name, _ in tf.train.list_variables(self.ckpt_path))
+        self.assertEqual(self.outputs[False][0], ckpt_names)
+        self.assertEqual(self.outputs[True][0], ckpt_names)
+
+    def test_head_outputs(self):
+        for folded, unfolded in zip(self.outputs[True][1], self.outputs[False][1]):
+            self.assertAllClose(folded, unfolded, rtol=1e-3, atol=1e-3)
+
+    def test_detections(self):
+        scores, boxes, labels, num_detections = self.outputs[False][2]
+        folded_scores, folded_boxes, folded_labels, folded_num_detections = self.outputs[True][2]
+        self.assertAllEqual(folded_num_detections, num_detections)
+        for i in range(self.batch_size):
+            n = num_detections[i]
+            self.assertAllEqual(folded_labels[i, :n], labels[i, :n])
+            self.assertAllClose(folded_scores[i, :n], scores[i, :n], atol=1e-3)
+            self.assertAllClose(folded_boxes[i, :n], boxes[i, :n], atol=1e-3 * max(self.input_shape))
+
+
+if __name__ == '__main__':
+    tf.test.main()
@@ -0,0 +1,24 @@
+# coding: utf-8
+import sys, glob
+sys.path.append('../')
+
+from configs import cfgs
+from datasets.voc_tfrecord_utils import benchmark_generator
+
+# compare one epoch of input time, full-res jpeg tfrecords vs pre-resized cache tfrecords
+# usage: python benchmark_cache.py "<full-res tfrecords glob>" "<cached tfrecords glob>" raw|jpeg
+full_data = sorted(glob.glob(sys.argv[1]))
+cache_data = sorted(glob.glob(sys.argv[2]))
+image_cache = sys.argv[3] if len(sys.argv) > 3 else 'raw'
+
+cfgs.repeat_dataset = False
+
+# no warmup: the whole epoch is timed
+cfgs.image_cache = None
+_, full_cost, _ = benchmark_generator(full_data, num_batches=None, warmup_batches=0)
+
+cfgs.image_cache = image_cache
+_, cache_cost, _ = benchmark_generator(cache_data, num_batches=None, warmup_batches=0)
+
+print('per-epoch input time: full-res jpeg {:.1f}s, {} cache {:.1f}s, speedup {:.2f}x'.format(
+    full_cost, image_cache, cache_cost, full_cost / cache_cost))
@@ -0,0 +1,51 @@
+# coding: utf-8
+import numpy as np
+import sys, os, time
+sys.path.append('../')
+
+from detectron.utils.voc_eval import voc_evaluate_detections, VOCEvaluator, parse_rec, NAME_LABEL_MAP
+from detectron.utils.coco_eval import COCOEvaluator
+from benchmarks.synthetic import random_detections
+
+# evaluation time, file-based voc_evaluate_detections vs in-memory VOCEvaluator
+# detections are synthetic: jittered ground truth plus random false positives
+# usage: python benchmark_eval.py [detections per image] [annotation dir]
+if "__main__" == __name__:
+    dets_per_image = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    xmlroot = sys.argv[2] if len(sys.argv) > 2 else '../datasets/data/voc_tickets_test/Annotations/'
+
+    test_imgid_list = sorted([item.split('.')[0] for item in os.listdir(xmlroot) if item.endswith('.xml')])
+
+    ground_truth = []
+    for img_id in test_imgid_list:
+        objects = [obj for obj in parse_rec(os.path.join(xmlroot, img_id + '.xml')) if obj['name'] in NAME_LABEL_MAP]
+        ground_truth.append(
+            np.array([[NAME_LABEL_MAP[obj['name']]] + obj['bbox'] for obj in objects], np.float64).reshape([-1, 5]))
+    # random boxes span each image's largest gt coordinate
+    all_boxes = random_detections(ground_truth, dets_per_image, np.random.RandomState(0), image_size=None)
+
+    start = time.time()
+    file_mAP = voc_evaluate_detections(all_boxes, xmlroot, test_imgid_list, plot=False)
+    file_cost = time.time() - start
+
+    start = time.time()
+    evaluator = VOCEvaluator(xmlroot)
+    for img_id, dets in zip(test_imgid_list, all_boxes):
+        evaluator.add_image(img_id, dets)
+    memory_mAP = evaluator.evaluate(verbose=False)
+    memory_cost = time.time() - start
+
+    start = time.time()
+    coco_evaluator = COCOEvaluator(xmlroot)
+    for img_id, dets in zip(test_imgid_list, all_boxes):
+        coco_evaluator.add_image(img_id, dets)
+    coco_metrics = coco_evaluator.evaluate(verbose=False)
+    coco_cost = time.time() - start
+
+    print('-' * 50)
+    print('{:d} images, {:d} detections/image'.format(len(test_imgid_list), dets_per_image))
+    print('file-based: mAP {:.4f}, {:.2f}s'.format(file_mAP, file_cost))
+    print('in-memory: mAP {:.4f}, {:.2f}s, speedup {:.2f}x'.format(memory_mAP, memory_cost, file_cost / memory_cost))
+    print('in-memory COCO-style, 10 IoU thresholds x 4 sizes: AP {:.4f}, AP50 {:.4f}, {:.2f}s'.format(
+        coco_metrics['AP'], coco_metrics['AP50'], coco_cost))
+    # small mAP differences come from the rounding in the detection files
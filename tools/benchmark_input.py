@@ -0,0 +1,16 @@
+# coding: utf-8
+import sys, glob
+sys.path.append('../')
+
+from datasets.voc_tfrecord_utils import benchmark_generator
+
+# usage: python benchmark_input.py "../datasets/data/train_*.tfrecord" [num_batches]
+pattern = sys.argv[1] if len(sys.argv) > 1 else '../datasets/data/train_*.tfrecord'
+num_batches = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+data = sorted(glob.glob(pattern))
+
+results = {}
+for mode in ['serial', 'parallel']:
+    results[mode], _, _ = benchmark_generator(data, mode=mode, num_batches=num_batches)
+
+print('speedup of parallel over serial: {:.2f}x'.format(results['parallel'] / results['serial']))
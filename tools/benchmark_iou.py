@@ -0,0 +1,86 @@
+# coding: utf-8
+import sys, time
+import numpy as np
+import tensorflow as tf
+
+sys.path.append('../')
+from configs import cfgs
+from detectron.utils import anchors
+from detectron.utils import box_ops
+from detectron.utils.profiler import peak_memory
+
+# time and memory of gt x anchor iou + matching for one image, tiled vs broadcast
+# usage: python benchmark_iou.py [num_runs]
+num_runs = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+input_shape = cfgs.augment_config['output_shape']
+
+
+def tiled_iou(gbbox_y1x1, gbbox_y2x2, abbox_y1x1, abbox_y2x2):
+    """
+    previous implementation of _compute_one_image_loss, for comparison
+    """
+    abbox_hw = abbox_y2x2 - abbox_y1x1
+    gbbox_hw = gbbox_y2x2 - gbbox_y1x1
+    abbox_hwti = tf.reshape(abbox_hw, [1, -1, 2])
+    abbox_y1x1ti = tf.reshape(abbox_y1x1, [1, -1, 2])
+    abbox_y2x2ti = tf.reshape(abbox_y2x2, [1, -1, 2])
+    ashape = tf.shape(abbox_hwti)
+
+    gbbox_hwti = tf.reshape(gbbox_hw, [-1, 1, 2])
+    gbbox_y1x1ti = tf.reshape(gbbox_y1x1, [-1, 1, 2])
+    gbbox_y2x2ti = tf.reshape(gbbox_y2x2, [-1, 1, 2])
+    gshape = tf.shape(gbbox_hwti)
+
+    abbox_hwti = tf.tile(abbox_hwti, [gshape[0], 1, 1])
+    abbox_y1x1ti = tf.tile(abbox_y1x1ti, [gshape[0], 1, 1])
+    abbox_y2x2ti = tf.tile(abbox_y2x2ti, [gshape[0], 1, 1])
+    gbbox_hwti = tf.tile(gbbox_hwti, [1, ashape[1], 1])
+    gbbox_y1x1ti = tf.tile(gbbox_y1x1ti, [1, ashape[1], 1])
+    gbbox_y2x2ti = tf.tile(gbbox_y2x2ti, [1, ashape[1], 1])
+
+    gaIoU_y1x1ti = tf.maximum(abbox_y1x1ti, gbbox_y1x1ti)
+    gaIoU_y2x2ti = tf.minimum(abbox_y2x2ti, gbbox_y2x2ti)
+    gaIoU_area = tf.reduce_prod(tf.maximum(gaIoU_y2x2ti - gaIoU_y1x1ti, 0), axis=-1)
+    aarea = tf.reduce_prod(abbox_hwti, axis=-1)
+    garea = tf.reduce_prod(gbbox_hwti, axis=-1)
+    gaIoU = gaIoU_area / (aarea + garea - gaIoU_area)
+
+    agIoU = tf.transpose(gaIoU)
+    return tf.argmax(gaIoU, axis=1), tf.argmax(agIoU, axis=1), tf.reduce_max(agIoU, axis=1)
+
+
+def broadcast_iou(gbbox_y1x1, gbbox_y2x2, abbox_y1x1, abbox_y2x2):
+    iou = box_ops.pairwise_iou(gbbox_y1x1, gbbox_y2x2, abbox_y1x1, abbox_y2x2)
+    return box_ops.argmax_matching(iou)
+
+
+abbox_y1x1 = np.concatenate([level[0] for level in anchors.get_anchors(tuple(input_shape))])
+abbox_y2x2 = np.concatenate([level[1] for level in anchors.get_anchors(tuple(input_shape))])
+print('anchors per image: {:d}'.format(abbox_y1x1.shape[0]))
+
+for num_gt in [1, 10, 20, 60]:
+    gbbox_yx = np.random.uniform(0., input_shape[0], [num_gt, 2]).astype(np.float32)
+    gbbox_hw = np.random.uniform(10., 300., [num_gt, 2]).astype(np.float32)
+    gbbox_y1x1 = gbbox_yx - gbbox_hw / 2.
+    gbbox_y2x2 = gbbox_yx + gbbox_hw / 2.
+
+    for name, fn in [('tiled', tiled_iou), ('broadcast', broadcast_iou)]:
+        with tf.Graph().as_default():
+            gy1x1 = tf.placeholder(tf.float32, [None, 2])
+            gy2x2 = tf.placeholder(tf.float32, [None, 2])
+            matching = fn(gy1x1, gy2x2, tf.constant(abbox_y1x1), tf.constant(abbox_y2x2))
+            feed_dict = {gy1x1: gbbox_y1x1, gy2x2: gbbox_y2x2}
+
+            with tf.Session() as sess:
+                # memory of one traced run
+                run_options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+                run_metadata = tf.RunMetadata()
+                sess.run(matching, feed_dict=feed_dict, options=run_options, run_metadata=run_metadata)
+
+                start = time.time()
+                for _ in range(num_runs):
+                    sess.run(matching, feed_dict=feed_dict)
+                cost = (time.time() - start) / num_runs
+
+        print('gt: {:3d}, {:>9s}: {:.2f}ms, peak memory {:.1f}MB'.format(
+            num_gt, name, cost * 1000, peak_memory(run_metadata) / 2.**20))
@@ -0,0 +1,21 @@
+# coding: utf-8
+import sys
+import numpy as np
+
+sys.path.append('../')
+from configs import cfgs
+from benchmarks.synthetic import random_candidates
+from benchmarks.bench_postprocess import time_nms, NMS_METHODS
+
+# nms latency of each method, random candidates, num_classes from cfgs
+# usage: python benchmark_nms.py [num_runs]
+num_runs = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+num_classes = cfgs.num_classes - 1
+rng = np.random.RandomState(0)
+
+for num_candidates in [1000, 5000, 20000]:
+    boxes, scores = random_candidates(num_candidates, num_classes, rng)
+    for method in NMS_METHODS:
+        cost, num_ops = time_nms(boxes, scores, method, num_runs)
+        print('candidates: {:6d}, method: {:>8s}, graph ops: {:4d}, latency: {:.2f}ms'.format(
+            num_candidates, method, num_ops, cost * 1000))
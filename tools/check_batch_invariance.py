@@ -0,0 +1,66 @@
+# coding: utf-8
+import tensorflow as tf
+import numpy as np
+import sys, os, tempfile
+sys.path.append('../')
+
+from configs import cfgs
+from detectron.models.retinanet import RetinaNet
+
+# regression check: detections of an image must not depend on the rest of its batch, exits non-zero on mismatch
+# BatchNorm folding is checked by tests/test_fold_bn.py
+# usage: python check_batch_invariance.py [checkpoint] [batch_size]
+ckpt_path = sys.argv[1] if len(sys.argv) > 1 else None
+batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+input_h, input_w = cfgs.test_input_shape or [500, 500]
+
+rng = np.random.RandomState(0)
+if cfgs.data_format == 'channels_last':
+    imgs = rng.randint(0, 256, [batch_size, input_h, input_w, 3]).astype(np.uint8)
+else:
+    imgs = rng.randint(0, 256, [batch_size, 3, input_h, input_w]).astype(np.uint8)
+
+# without a checkpoint, save random weights so every graph below uses the same ones
+if ckpt_path is None:
+    with tf.Graph().as_default():
+        retinanet = RetinaNet('test', restore=False)
+        ckpt_path = tf.train.Saver().save(retinanet.sess, os.path.join(tempfile.mkdtemp(), 'random'))
+        retinanet.sess.close()
+
+
+def detect():
+    """
+    return: per image, detections of the whole batch and of the image alone
+    """
+    with tf.Graph().as_default():
+        retinanet = RetinaNet('test', restore=False)
+        retinanet.load_weight(ckpt_path)
+        batched = retinanet.test_one_batch(imgs)
+        single = [retinanet.test_one_batch(imgs[i:i+1]) for i in range(batch_size)]
+        retinanet.sess.close()
+
+    batched = [[x[i] for x in batched] for i in range(batch_size)]
+    single = [[x[0] for x in outputs] for outputs in single]
+    return batched, single
+
+
+def same_detections(a, b, atol=1e-3):
+    scores_a, boxes_a, labels_a, num_a = a
+    scores_b, boxes_b, labels_b, num_b = b
+    if num_a != num_b:
+        return False
+    return (np.allclose(scores_a[:num_a], scores_b[:num_b], atol=atol)
+            and np.allclose(boxes_a[:num_a], boxes_b[:num_b], atol=atol * max(input_h, input_w))
+            and np.array_equal(labels_a[:num_a], labels_b[:num_b]))
+
+
+batched, single = detect()
+
+failures = 0
+for i in range(batch_size):
+    ok = same_detections(batched[i], single[i])
+    print('image {:d}, batch of {:d} vs alone: {}'.format(i, batch_size, 'ok' if ok else 'MISMATCH'))
+    failures += not ok
+
+print('{:d} mismatches'.format(failures))
+sys.exit(1 if failures else 0)
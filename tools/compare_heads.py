@@ -0,0 +1,48 @@
+# coding: utf-8
+import tensorflow as tf
+import numpy as np
+import sys, time, glob
+sys.path.append('../')
+
+from configs import cfgs
+from detectron.models.retinanet import RetinaNet
+from datasets.voc_tfrecord_utils import get_generator
+
+# parameter count & train step time of per-level heads vs shared heads, random weights
+# usage: python compare_heads.py "../datasets/data/train_*.tfrecord" [num_steps]
+pattern = sys.argv[1] if len(sys.argv) > 1 else '../datasets/data/train_*.tfrecord'
+num_steps = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+warmup_steps = 3
+data = sorted(glob.glob(pattern))
+
+cfgs.repeat_dataset = True
+
+
+def measure(share_head_weights, share_head_bn=False):
+    cfgs.share_head_weights = share_head_weights
+    cfgs.share_head_bn = share_head_bn
+
+    with tf.Graph().as_default():
+        retinanet = RetinaNet('train', get_generator(data), restore=False)
+        num_params = sum([np.prod(v.get_shape().as_list()) for v in tf.trainable_variables()
+                          if 'subnets' in v.name])
+
+        for _ in range(warmup_steps):
+            retinanet.sess.run(retinanet.train_op)
+        start = time.time()
+        for _ in range(num_steps):
+            retinanet.sess.run(retinanet.train_op)
+        step_time = (time.time() - start) / num_steps
+        retinanet.sess.close()
+    return num_params, step_time
+
+
+results = [('per-level heads', measure(False)),
+           ('shared heads, per-level bn', measure(True)),
+           ('shared heads, shared bn', measure(True, True))]
+
+print('-' * 50)
+base_params, base_time = results[0][1]
+for name, (num_params, step_time) in results:
+    print('{}: head params {:d} ({:.2f}x), step {:.1f}ms ({:.2f}x)'.format(
+        name, int(num_params), num_params / base_params, step_time * 1000, base_time / step_time))
@@ -0,0 +1,75 @@
+# coding: utf-8
+import tensorflow as tf
+import numpy as np
+import sys, os, time, tempfile
+sys.path.append('../')
+
+from configs import cfgs
+from detectron.models.retinanet import RetinaNet
+from detectron.utils.profiler import peak_memory
+from datasets.voc_tfrecord_utils import get_synthetic_generator
+
+# mixed precision vs float32 training on a small synthetic dataset, same initial weights & batches:
+# loss curves, step time, peak memory. exits non-zero when the curves differ
+# usage: python compare_precision.py [num_steps]
+precision = 'float16'
+num_steps = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+num_batches = 8  # dataset size, repeated
+tolerance = 0.05  # relative difference of the final smoothed loss
+smooth = 10
+
+cfgs.repeat_dataset = True
+cfgs.summary_path = os.path.join(tempfile.mkdtemp(), 'summaries')
+init_ckpt = os.path.join(tempfile.mkdtemp(), 'init')
+
+
+def train_curve(precision):
+    cfgs.precision = precision
+    with tf.Graph().as_default():
+        retinanet = RetinaNet('train', get_synthetic_generator(num_batches), restore=False)
+        sess = retinanet.sess
+
+        # float32 run stores its initial weights, the other run starts from them
+        if precision == 'float32':
+            tf.train.Saver().save(sess, init_ckpt)
+        else:
+            saved = set(name for name, _ in tf.train.list_variables(init_ckpt))
+            tf.train.Saver([v for v in tf.global_variables() if v.op.name in saved]).restore(sess, init_ckpt)
+
+        losses, times = [], []
+        for step in range(num_steps):
+            start = time.time()
+            _, loss = sess.run([retinanet.train_op, retinanet.loss])
+            times.append(time.time() - start)
+            losses.append(loss)
+
+        run_metadata = tf.RunMetadata()
+        sess.run(retinanet.train_op, options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE),
+                 run_metadata=run_metadata)
+        retinanet.summary_writer.close()
+        sess.close()
+    # first steps include warmup
+    return np.array(losses), np.median(times[3:] or times), peak_memory(run_metadata)
+
+
+results = {name: train_curve(name) for name in ['float32', precision]}
+
+fp32_loss, fp32_time, fp32_memory = results['float32']
+mixed_loss, mixed_time, mixed_memory = results[precision]
+relative = np.abs(mixed_loss - fp32_loss) / np.maximum(np.abs(fp32_loss), 1e-8)
+final_fp32, final_mixed = np.mean(fp32_loss[-smooth:]), np.mean(mixed_loss[-smooth:])
+final_relative = abs(final_mixed - final_fp32) / max(abs(final_fp32), 1e-8)
+
+print('-' * 50)
+print('step  {:>10s} {:>10s}'.format('float32', precision))
+for step in range(0, num_steps, max(num_steps // 10, 1)):
+    print('{:4d}  {:10.4f} {:10.4f}'.format(step, fp32_loss[step], mixed_loss[step]))
+print('loss difference: mean {:.2%}, max {:.2%}, final (last {:d} steps) {:.2%}'.format(
+    np.mean(relative), np.max(relative), smooth, final_relative))
+print('step time: {:.1f}ms -> {:.1f}ms ({:.2f}x)'.format(fp32_time * 1000, mixed_time * 1000, fp32_time / mixed_time))
+print('peak memory: {:.1f}MB -> {:.1f}MB ({:+.1%})'.format(
+    fp32_memory / 2.**20, mixed_memory / 2.**20, mixed_memory / max(fp32_memory, 1) - 1.))
+
+ok = np.all(np.isfinite(mixed_loss)) and final_relative <= tolerance
+print('loss curves {}'.format('match' if ok else 'DIFFER'))
+sys.exit(0 if ok else 1)
@@ -4,10 +4,15 @@ sys.path.append('../')
 
 from detectron.utils import voc_eval
 
-imgroot = '../datasets/data/voc_tickets_test/JPEGImages/'
-xmlroot = '../datasets/data/voc_tickets_test/Annotations/'
-test_imgid_list = [item for item in os.listdir(imgroot)
-                        if item.endswith(('.jpg', 'jpeg', '.png', '.tif', '.tiff'))]
-test_imgid_list = [item.split('.')[0] for item in test_imgid_list]
+# usage: python do_eval.py [output dir]
+# with an output dir, evaluation is headless: P-R curves and summary.json are written there
+if "__main__" == __name__:
+    save_dir = sys.argv[1] if len(sys.argv) > 1 else None
 
-voc_eval.do_python_eval(test_imgid_list, test_annotation_path=xmlroot)
\ No newline at end of file
+    imgroot = '../datasets/data/voc_tickets_test/JPEGImages/'
+    xmlroot = '../datasets/data/voc_tickets_test/Annotations/'
+    test_imgid_list = [item for item in os.listdir(imgroot)
+                            if item.endswith(('.jpg', 'jpeg', '.png', '.tif', '.tiff'))]
+    test_imgid_list = [item.split('.')[0] for item in test_imgid_list]
+
+    voc_eval.do_python_eval(test_imgid_list, test_annotation_path=xmlroot, save_dir=save_dir)
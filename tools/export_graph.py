@@ -0,0 +1,100 @@
+# coding: utf-8
+import cv2
+import tensorflow as tf
+from tensorflow.tools.graph_transforms import TransformGraph
+import numpy as np
+import sys, os, time
+
+sys.path.append('../')
+from detectron.models.retinanet import RetinaNet
+from detectron.utils import frozen_graph
+from configs import cfgs
+
+# export the test graph as a frozen GraphDef and a SavedModel
+# usage: python export_graph.py [checkpoint] [export_dir]
+if "__main__" == __name__:
+    if len(sys.argv) > 1:
+        cfgs.test_checkpoint = sys.argv[1]
+    export_dir = sys.argv[2] if len(sys.argv) > 2 else cfgs.export_path
+
+    # a static input size makes the anchors graph constants. with a dynamic size they come from a tf.py_func,
+    # whose callback lives only in this process: the exported model could not be loaded anywhere else
+    cfgs.test_input_shape = cfgs.test_input_shape or [500, 500]
+
+    output_node_names = list(frozen_graph.OUTPUT_NAMES.values()) + list(frozen_graph.HEAD_OUTPUT_NAMES.values())
+
+    # build test graph, restore
+    start = time.time()
+    retinanet = RetinaNet('test')
+    print('build & restore: {:.2f}s'.format(time.time() - start))
+
+    # variables -> constants, keep only what the outputs need
+    graph_def = retinanet.sess.graph.as_graph_def()
+    graph_def = tf.graph_util.convert_variables_to_constants(retinanet.sess, graph_def, output_node_names)
+    num_nodes = len(graph_def.node)
+
+    # strip training nodes, fold constants (mean, anchors)
+    # BatchNorm is not folded here: the graph transforms only match Conv2D -> BatchNorm, every bn here follows
+    # a BiasAdd or ReLU. cfgs.fold_bn folds bn into conv weights when the test graph is built
+    # Identity nodes stay: nms runs in a tf.map_fn while-loop, whose frames pivot on Identity ops
+    input_shape = '-1,{},{},3'.format(*cfgs.test_input_shape)
+    transforms = [
+        'strip_unused_nodes(type=uint8, shape="{}")'.format(input_shape),
+        'remove_nodes(op=CheckNumerics)',
+        'fold_constants(ignore_errors=true)',
+        'sort_by_execution_order',
+    ]
+    graph_def = TransformGraph(graph_def, [frozen_graph.INPUT_NAME], output_node_names, transforms)
+    print('graph nodes: {:d} -> {:d}, BatchNorm nodes: {:d}'.format(
+        num_nodes, len(graph_def.node), sum(1 for node in graph_def.node if node.op.startswith('FusedBatchNorm'))))
+    # the check below runs in this process, where py_func callbacks are registered, it would not catch them
+    py_funcs = [node.name for node in graph_def.node if node.op in ('PyFunc', 'PyFuncStateless', 'EagerPyFunc')]
+    assert not py_funcs, 'exported graph depends on python callbacks: {}'.format(py_funcs)
+
+    # frozen GraphDef
+    if not tf.gfile.Exists(export_dir):
+        tf.gfile.MakeDirs(export_dir)
+    pb_path = os.path.join(export_dir, frozen_graph.FROZEN_GRAPH_NAME)
+    with tf.gfile.GFile(pb_path, 'wb') as f:
+        f.write(graph_def.SerializeToString())
+    print('save frozen graph in:', pb_path)
+
+    # SavedModel with a named signature
+    saved_model_dir = os.path.join(export_dir, 'saved_model', str(int(time.time())))
+    with tf.Graph().as_default() as graph:
+        tf.import_graph_def(graph_def, name='')
+        inputs = {frozen_graph.INPUT_NAME: graph.get_tensor_by_name(frozen_graph.INPUT_NAME + ':0')}
+        outputs = {k: graph.get_tensor_by_name(v + ':0') for k, v in frozen_graph.OUTPUT_NAMES.items()}
+        signature = tf.saved_model.signature_def_utils.predict_signature_def(inputs, outputs)
+
+        with tf.Session(graph=graph) as sess:
+            builder = tf.saved_model.builder.SavedModelBuilder(saved_model_dir)
+            builder.add_meta_graph_and_variables(
+                sess, [tf.saved_model.tag_constants.SERVING],
+                signature_def_map={frozen_graph.SIGNATURE_NAME: signature})
+            builder.save()
+    print('save SavedModel in:', saved_model_dir)
+
+    # the exported models must give the detections of the checkpoint, on a test image (random if there is none)
+    imgroot = '../datasets/data/voc_tickets_test/JPEGImages/'
+    input_h, input_w = cfgs.test_input_shape
+    img_names = sorted(os.listdir(imgroot)) if os.path.isdir(imgroot) else []
+    if img_names:
+        img = cv2.resize(cv2.imread(os.path.join(imgroot, img_names[0])), (input_w, input_h), interpolation=cv2.INTER_LINEAR)
+    else:
+        img = np.random.RandomState(0).randint(0, 256, [input_h, input_w, 3]).astype(np.uint8)
+    imgs = img[np.newaxis]
+    scores, boxes, labels, num_detections = retinanet.test_one_batch(imgs)
+
+    for path in [pb_path, saved_model_dir]:
+        detector = frozen_graph.FrozenDetector(path)
+        exp_scores, exp_boxes, exp_labels, exp_num_detections = detector.test_one_batch(imgs)
+        detector.close()
+
+        n = num_detections[0]
+        # constant folding changes the float rounding only
+        assert exp_num_detections[0] == n and np.array_equal(exp_labels[0, :n], labels[0, :n]) \
+            and np.allclose(exp_scores[0, :n], scores[0, :n], atol=1e-3) \
+            and np.allclose(exp_boxes[0, :n], boxes[0, :n], atol=1e-2), \
+            'exported model differs from the checkpoint: {}'.format(path)
+        print('check {}: {:d} detections match the checkpoint'.format(path, n))
@@ -0,0 +1,46 @@
+# coding: utf-8
+import cv2
+import numpy as np
+import sys, os, time
+
+sys.path.append('../')
+from detectron.utils.frozen_graph import FrozenDetector
+from detectron.utils import draw_box_in_img
+from configs import cfgs
+
+# detect with an exported model, no graph building
+# usage: python infer.py <frozen .pb or SavedModel dir> <image dir>
+if "__main__" == __name__:
+    model_path = sys.argv[1]
+    imgroot = sys.argv[2]
+
+    start = time.time()
+    detector = FrozenDetector(model_path)
+    print('startup: {:.2f}s'.format(time.time() - start))
+
+    imgname_list = [item for item in os.listdir(imgroot)
+                    if item.endswith(('.jpg', 'jpeg', '.png', '.tif', '.tiff'))]
+    input_h, input_w = cfgs.test_input_shape or [500, 500]
+
+    if not os.path.exists(cfgs.test_save_path):
+        os.makedirs(cfgs.test_save_path)
+
+    for a_img_name in imgname_list:
+        raw_img = cv2.imread(os.path.join(imgroot, a_img_name))
+        resized_img = cv2.resize(raw_img, (input_w, input_h), interpolation=cv2.INTER_LINEAR)
+
+        start = time.time()
+        scores, boxes, categories, num_detections = detector.test_one_batch(np.expand_dims(resized_img, 0))
+        cost = time.time() - start
+
+        detected_scores = scores[0, :num_detections[0]]
+        detected_boxes = boxes[0, :num_detections[0]]
+        detected_categories = categories[0, :num_detections[0]]
+        print('{}: {:d} detections, {:.1f}ms'.format(a_img_name, num_detections[0], cost * 1000))
+
+        draw_box_in_img.draw_boxes_in_place(resized_img,
+                                            boxes=detected_boxes,
+                                            labels=detected_categories,
+                                            scores=detected_scores,
+                                            bgr=True)
+        cv2.imwrite(cfgs.test_save_path + '/' + a_img_name.split('.')[0] + '.jpg', resized_img)
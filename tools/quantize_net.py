@@ -0,0 +1,89 @@
+# coding: utf-8
+import cv2
+import numpy as np
+import sys, os, time, random
+
+sys.path.append('../')
+from detectron.utils import frozen_graph
+from detectron.utils import quantization
+from detectron.utils.voc_eval import voc_evaluate_detections
+from configs import cfgs
+
+# post-training quantization of an exported model, mAP & latency of fp32 vs int8
+# both run the same numpy decode & nms (quantization.postprocess_numpy), only the heads differ
+# usage: python quantize_net.py [num_calibration_images]
+if "__main__" == __name__:
+    num_calibration = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+
+    imgroot = '../datasets/data/voc_tickets_test/JPEGImages/'
+    xmlroot = '../datasets/data/voc_tickets_test/Annotations/'
+    pb_path = os.path.join(cfgs.export_path, frozen_graph.FROZEN_GRAPH_NAME)
+    tflite_path = os.path.join(cfgs.export_path, 'retinanet_int8.tflite')
+    input_h, input_w = cfgs.test_input_shape or [500, 500]
+
+    real_test_imgname_list = [item for item in os.listdir(imgroot)
+                             if item.endswith(('.jpg', 'jpeg', '.png', '.tif', '.tiff'))]
+    # annotations are looked up by image id, <id>.xml
+    test_imgid_list = [item.split('.')[0] for item in real_test_imgname_list]
+
+    # calibrate & convert
+    random.seed(0)
+    calibration_names = random.sample(real_test_imgname_list, min(num_calibration, len(real_test_imgname_list)))
+    start = time.time()
+    tflite_model = quantization.quantize_frozen_graph(
+        pb_path, [input_h, input_w], [os.path.join(imgroot, name) for name in calibration_names])
+    with open(tflite_path, 'wb') as f:
+        f.write(tflite_model)
+    print('calibrate on {:d} images & convert: {:.1f}s, save in: {}'.format(
+        len(calibration_names), time.time() - start, tflite_path))
+
+
+    def evaluate(detector):
+        """
+        run detector on the test set, same pre/post-processing as test_net
+        return: mAP, mean latency per image in seconds
+        """
+        all_boxes = []
+        latency = []
+        for a_img_name in real_test_imgname_list:
+            raw_img = cv2.imread(os.path.join(imgroot, a_img_name))
+            raw_h, raw_w = raw_img.shape[0], raw_img.shape[1]
+            resized_img = cv2.resize(raw_img, (input_w, input_h), interpolation=cv2.INTER_LINEAR)
+
+            start = time.time()
+            scores, boxes, categories, num_detections = detector.test_one_batch(np.expand_dims(resized_img, 0))
+            latency.append(time.time() - start)
+
+            detected_scores = scores[0, :num_detections[0]]
+            detected_boxes = boxes[0, :num_detections[0]]
+            detected_categories = categories[0, :num_detections[0]]
+
+            # [y, x, h, w] -> xmin, ymin, xmax, ymax, back to origin size
+            ymin = (detected_boxes[:, 0] - detected_boxes[:, 2]/2.) * raw_h / input_h
+            ymax = (detected_boxes[:, 0] + detected_boxes[:, 2]/2.) * raw_h / input_h
+            xmin = (detected_boxes[:, 1] - detected_boxes[:, 3]/2.) * raw_w / input_w
+            xmax = (detected_boxes[:, 1] + detected_boxes[:, 3]/2.) * raw_w / input_w
+            boxes = np.transpose(np.stack([xmin, ymin, xmax, ymax]))
+
+            all_boxes.append(np.hstack((detected_categories.reshape(-1, 1),
+                                        detected_scores.reshape(-1, 1),
+                                        boxes)))
+
+        mAP = voc_evaluate_detections(all_boxes=all_boxes,
+                                      test_annotation_path=xmlroot,
+                                      test_imgid_list=test_imgid_list,
+                                      plot=False)
+        # first image includes warmup
+        return mAP, np.mean(latency[1:] or latency)
+
+
+    results = {}
+    for name, detector in [('fp32', quantization.FrozenHeadDetector(pb_path)),
+                           ('int8', quantization.TFLiteDetector(tflite_path))]:
+        results[name] = evaluate(detector)
+
+    print('-' * 50)
+    for name, (mAP, latency) in results.items():
+        print('{}: mAP {:.4f}, latency {:.1f}ms/image'.format(name, mAP, latency * 1000))
+    print('int8 vs fp32: mAP {:+.4f}, speedup {:.2f}x'.format(
+        results['int8'][0] - results['fp32'][0], results['fp32'][1] / results['int8'][1]))
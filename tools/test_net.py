@@ -1,100 +1,238 @@
-# coding: utf-8 
-import cv2 
-import tensorflow as tf 
+# coding: utf-8
+import cv2
+import tensorflow as tf
 import numpy as np
-import sys, os
+import sys, os, time
+import threading, queue
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 
 sys.path.append('../')
 from detectron.models.retinanet import RetinaNet
-from detectron.utils.voc_eval import voc_evaluate_detections
+from detectron.utils.voc_eval import voc_evaluate_detections, VOCEvaluator
+from detectron.utils.coco_eval import COCOEvaluator
 from detectron.utils import draw_box_in_img
 from configs import cfgs
 
-# build graph, create session, restore
-retinanet = RetinaNet('test')
+# pipelined test: decode/resize (thread pool) -> inference (main thread) -> draw/write (threads),
+# stages joined by bounded queues
+# usage: python test_net.py [--no-vis]
+if "__main__" == __name__:
+    if '--no-vis' in sys.argv:
+        cfgs.test_visualize = False
 
-# get image file list
-imgroot = '../datasets/data/voc_tickets_test/JPEGImages/'
-xmlroot = '../datasets/data/voc_tickets_test/Annotations/'
+    # build graph, create session, restore
+    retinanet = RetinaNet('test')
 
-real_test_imgname_list = [item for item in os.listdir(imgroot)
-                         if item.endswith(('.jpg', 'jpeg', '.png', '.tif', '.tiff'))]
+    # get image file list
+    imgroot = '../datasets/data/voc_tickets_test/JPEGImages/'
+    xmlroot = '../datasets/data/voc_tickets_test/Annotations/'
 
-# run prediction for each img
-all_boxes = []
-pbar = tqdm(real_test_imgname_list)
+    real_test_imgname_list = [item for item in os.listdir(imgroot)
+                             if item.endswith(('.jpg', 'jpeg', '.png', '.tif', '.tiff'))]
+    input_h, input_w = cfgs.test_input_shape or [500, 500]
 
-for a_img_name in pbar:
-    # read image
-    raw_img = cv2.imread(os.path.join(imgroot, a_img_name))#[:, :, ::-1] # BGR2RGB
-    raw_h, raw_w = raw_img.shape[0], raw_img.shape[1]
+    if cfgs.test_visualize and not os.path.exists(cfgs.test_save_path):
+        os.makedirs(cfgs.test_save_path)
 
-    # resize image
-    resized_img = cv2.resize(raw_img, (500, 500), interpolation=cv2.INTER_LINEAR)
+    # seconds spent per stage, decode & visualize are summed over their threads
+    timing = {'decode': 0., 'wait_input': 0., 'inference': 0., 'postprocess': 0., 'visualize': 0., 'wait_output': 0.}
+    timing_lock = threading.Lock()
 
-    # 
-    detected_scores, detected_boxes, detected_categories = retinanet.test_one_batch(np.expand_dims(resized_img, 0))
 
-    # draw & save show
-    if True:
-        # show_indices = detected_scores >= cfgs.vis_score
-        # show_scores = detected_scores[show_indices]
-        # show_boxes = detected_boxes[show_indices]
-        # show_categories = detected_categories[show_indices]
-
-        final_detections = draw_box_in_img.draw_boxes_with_label_and_scores(resized_img,
-                                                                            boxes=detected_boxes,
-                                                                            labels=detected_categories,
-                                                                            scores=detected_scores,
-                                                                            in_graph=False)
-        if not os.path.exists(cfgs.test_save_path):
-            os.makedirs(cfgs.test_save_path)
-
-        cv2.imwrite(cfgs.test_save_path + '/' + a_img_name.split('.')[0] + '.jpg',
-                    final_detections[:, :, ::-1])
-
-    # [y, x, h, w] -> xmin, ymin, xmax, ymax
-    ymin = detected_boxes[:, 0] - detected_boxes[:, 2]/2.
-    ymax = detected_boxes[:, 0] + detected_boxes[:, 2]/2.
-    xmin = detected_boxes[:, 1] - detected_boxes[:, 3]/2.
-    xmax = detected_boxes[:, 1] + detected_boxes[:, 3]/2.
-
-    # height & width of resized image. attention!!! shape is HWC not NHWC
-    resized_h, resized_w = resized_img.shape[0], resized_img.shape[1]
-
-    # back to origin size
-    xmin = xmin * raw_w / resized_w
-    xmax = xmax * raw_w / resized_w
+    def add_time(stage, start):
+        with timing_lock:
+            timing[stage] += time.time() - start
 
-    ymin = ymin * raw_h / resized_h
-    ymax = ymax * raw_h / resized_h
 
-    # 1xN (stack along axis=0) -> 4xN (transpose) -> Nx4
-    boxes = np.transpose(np.stack([xmin, ymin, xmax, ymax]))
-    
-    # stack as a detection results
-    dets = np.hstack(
-                        (detected_categories.reshape(-1, 1),
-                         detected_scores.reshape(-1, 1),
-                         boxes)
-                    )
+    def load_image(a_img_name):
+        """
+        return: None if the image can't be decoded
+        """
+        start = time.time()
+        # read image
+        raw_img = cv2.imread(os.path.join(imgroot, a_img_name))#[:, :, ::-1] # BGR2RGB
+        if raw_img is None:
+            add_time('decode', start)
+            return None
+        raw_h, raw_w = raw_img.shape[0], raw_img.shape[1]
 
-    all_boxes.append(dets)
-    pbar.set_description("Eval image %s" % a_img_name)
+        # resize image
+        resized_img = cv2.resize(raw_img, (input_w, input_h), interpolation=cv2.INTER_LINEAR)
+        add_time('decode', start)
+        return a_img_name, raw_h, raw_w, resized_img
 
 
-# # save all detections as .pkl file
-# save_dir = cfgs.eval_save_path
-# if not os.path.exists(save_dir):
-#     os.makedirs(save_dir)
-
-# fw = open(os.path.join(save_dir, 'detections.pkl'), 'w')
-# pickle.dump(all_boxes, fw)
-
-
-# do evaluation
-voc_evaluate_detections(all_boxes=all_boxes,
-                        test_annotation_path=xmlroot,
-                        test_imgid_list=real_test_imgname_list)
-
+    def save_visualization(a_img_name, resized_img, detected_boxes, detected_categories, detected_scores):
+        start = time.time()
+        # show_indices = detected_scores >= cfgs.vis_score
+        # resized_img is not used after this stage, draw on it directly
+        draw_box_in_img.draw_boxes_in_place(resized_img,
+                                            boxes=detected_boxes,
+                                            labels=detected_categories,
+                                            scores=detected_scores,
+                                            bgr=True)
+        cv2.imwrite(cfgs.test_save_path + '/' + a_img_name.split('.')[0] + '.jpg', resized_img)
+        add_time('visualize', start)
+
+
+    def to_voc_detections(detected_boxes, detected_scores, detected_categories, raw_h, raw_w):
+        """
+        [y, x, h, w] on the resized image -> [category, score, xmin, ymin, xmax, ymax] on the raw image
+        """
+        ymin = (detected_boxes[:, 0] - detected_boxes[:, 2]/2.) * raw_h / input_h
+        ymax = (detected_boxes[:, 0] + detected_boxes[:, 2]/2.) * raw_h / input_h
+        xmin = (detected_boxes[:, 1] - detected_boxes[:, 3]/2.) * raw_w / input_w
+        xmax = (detected_boxes[:, 1] + detected_boxes[:, 3]/2.) * raw_w / input_w
+
+        # 1xN (stack along axis=0) -> 4xN (transpose) -> Nx4
+        boxes = np.transpose(np.stack([xmin, ymin, xmax, ymax]))
+        return np.hstack((detected_categories.reshape(-1, 1),
+                          detected_scores.reshape(-1, 1),
+                          boxes))
+
+
+    # stage 1: decode in the thread pool, futures queued in order, at most test_queue_size in flight
+    io_pool = ThreadPoolExecutor(cfgs.test_io_threads)
+    decode_queue = queue.Queue(maxsize=cfgs.test_queue_size)
+    stop_feeding = threading.Event()
+
+    def feed_images():
+        for a_img_name in real_test_imgname_list:
+            if stop_feeding.is_set():
+                break
+            decode_queue.put((a_img_name, io_pool.submit(load_image, a_img_name)))
+        decode_queue.put(None)
+
+    # stage 3: draw & write in worker threads
+    write_queue = queue.Queue(maxsize=cfgs.test_queue_size)
+
+    def write_images():
+        while True:
+            item = write_queue.get()
+            if item is None:
+                break
+            # a failed write loses one image, the writer keeps taking items until its end mark
+            try:
+                save_visualization(*item)
+            except Exception as e:
+                print('fail to save visualization of {}: {}'.format(item[0], e))
+
+    feeder = threading.Thread(target=feed_images, daemon=True)
+    writers = []
+    if cfgs.test_visualize:
+        writers = [threading.Thread(target=write_images, daemon=True) for _ in range(cfgs.test_io_threads)]
+    for t in [feeder] + writers:
+        t.start()
+
+
+    def next_batch():
+        start = time.time()
+        batch = []
+        while len(batch) < cfgs.test_batch_size:
+            item = decode_queue.get()
+            if item is None:
+                decode_queue.put(None)  # keep the end mark for the next call
+                break
+            a_img_name, future = item
+            result = future.result()
+            if result is None:
+                print('skip undecodable image:', a_img_name)
+                skipped.append(a_img_name)
+                continue
+            batch.append(result)
+        add_time('wait_input', start)
+        return batch
+
+
+    # stage 2: inference & evaluation in the main thread
+    all_boxes = []
+    test_imgname_list = []  # decoded images, in the order of all_boxes
+    skipped = []
+    if cfgs.streaming_eval:
+        evaluator = VOCEvaluator(xmlroot)
+    if cfgs.coco_eval:
+        coco_evaluator = COCOEvaluator(xmlroot)
+    pbar = tqdm(total=len(real_test_imgname_list))
+    total_start = time.time()
+
+    try:
+        while True:
+            batch = next_batch()
+            if not batch:
+                break
+
+            start = time.time()
+            scores, boxes, categories, num_detections = retinanet.test_one_batch(np.stack([item[3] for item in batch]))
+            add_time('inference', start)
+
+            for i, (a_img_name, raw_h, raw_w, resized_img) in enumerate(batch):
+                start = time.time()
+                detected_scores = scores[i, :num_detections[i]]
+                detected_boxes = boxes[i, :num_detections[i]]
+                detected_categories = categories[i, :num_detections[i]]
+
+                # stack as a detection results
+                dets = to_voc_detections(detected_boxes, detected_scores, detected_categories, raw_h, raw_w)
+                if cfgs.streaming_eval:
+                    evaluator.add_image(a_img_name.split('.')[0], dets)
+                else:
+                    all_boxes.append(dets)
+                    test_imgname_list.append(a_img_name)
+                if cfgs.coco_eval:
+                    coco_evaluator.add_image(a_img_name.split('.')[0], dets)
+                add_time('postprocess', start)
+
+                # draw & save show
+                if cfgs.test_visualize:
+                    start = time.time()
+                    write_queue.put((a_img_name, resized_img, detected_boxes, detected_categories, detected_scores))
+                    add_time('wait_output', start)
+
+                pbar.update(1)
+                pbar.set_description("Eval image %s" % a_img_name)
+    finally:
+        # stop & drain every stage, also when the loop above raised
+        start = time.time()
+        stop_feeding.set()
+        while feeder.is_alive() or not decode_queue.empty():
+            try:
+                item = decode_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is not None:
+                item[1].cancel()
+        for _ in writers:
+            write_queue.put(None)
+        for t in [feeder] + writers:
+            t.join()
+        io_pool.shutdown()
+        add_time('wait_output', start)
+        pbar.close()
+
+    total_time = time.time() - total_start
+    num_images = len(real_test_imgname_list) - len(skipped)
+    print('{:d} images in {:.2f}s, {:.2f} images/sec, {:d} undecodable skipped'.format(
+        num_images, total_time, num_images / max(total_time, 1e-8), len(skipped)))
+    for stage, cost in timing.items():
+        print('  {}: {:.2f}s'.format(stage, cost))
+
+
+    # # save all detections as .pkl file
+    # save_dir = cfgs.eval_save_path
+    # if not os.path.exists(save_dir):
+    #     os.makedirs(save_dir)
+
+    # fw = open(os.path.join(save_dir, 'detections.pkl'), 'w')
+    # pickle.dump(all_boxes, fw)
+
+
+    # do evaluation
+    if cfgs.streaming_eval:
+        evaluator.evaluate()
+    else:
+        voc_evaluate_detections(all_boxes=all_boxes,
+                                test_annotation_path=xmlroot,
+                                test_imgid_list=test_imgname_list)
+    if cfgs.coco_eval:
+        coco_evaluator.evaluate()
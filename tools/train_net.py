@@ -22,7 +22,12 @@ def train(epochs):
         '../../Object-Detection-API-Tensorflow/data/train_00010-of-00010.tfrecord'
         ]
 
-    trainset = get_generator(data)
+    # data-parallel replicas read disjoint shards of the tfrecord list
+    if cfgs.num_replicas > 1:
+        assert len(data) >= cfgs.num_replicas, 'need a tfrecord file per replica at least'
+        trainset = [get_generator(data[i::cfgs.num_replicas]) for i in range(cfgs.num_replicas)]
+    else:
+        trainset = get_generator(data)
 
     # build network
     retinanet = RetinaNet('train', trainset)